@@ -0,0 +1,23 @@
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Benchmarks on synthetic data. Run from the top level directory of the
+repository:
+
+    python -m bench.run /tmp/bench -o bench.json   # all the stages
+    python -m bench.synth /tmp/synth               # synthetic data only
+    python -m bench.aggregate                      # aggregation only
+"""
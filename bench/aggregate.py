@@ -0,0 +1,77 @@
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Compare util.avg against the per-segment loop it replaced.
+
+Usage:
+    python -m bench.aggregate -n 1000000
+"""
+import time
+import argparse
+import numpy as np
+from prep import nwin
+from util import avg, aggregate, reducers
+
+
+def loop_avg(labels, preds):
+    preds_len = preds.shape[0] // nwin
+    post_preds = np.zeros(preds_len, np.float32)
+    post_labels = np.zeros(preds_len, np.float32)
+    for i in range(preds_len):
+        post_preds[i] = np.mean(preds[nwin*i:nwin*(i+1)])
+        post_labels[i] = labels[nwin*i]
+        assert post_labels[i] == np.mean(labels[nwin*i:nwin*(i+1)])
+    return (post_labels, post_preds)
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+
+def run(nwindows, seed=0):
+    """
+    Return the time taken in seconds by each implementation for nwindows
+    windows.
+    """
+    rng = np.random.RandomState(seed)
+    nsegs = nwindows // nwin
+    labels = np.repeat(rng.randint(2, size=nsegs), nwin).astype(np.int32)
+    preds = rng.uniform(size=nsegs * nwin).astype(np.float32)
+    times = {}
+    (ref_labels, ref_preds), times['loop'] = timed(loop_avg, labels, preds)
+    (new_labels, new_preds), times['mean'] = timed(avg, labels, preds)
+    assert np.array_equal(ref_labels, new_labels)
+    assert np.allclose(ref_preds, new_preds, atol=1e-6)
+    for reducer in reducers[1:]:
+        times[reducer] = timed(aggregate, preds, reducer=reducer)[1]
+    # Segments of 1 to 2 * nwin windows
+    counts = rng.randint(1, 2 * nwin + 1, size=nwindows // nwin)
+    ragged = rng.uniform(size=counts.sum()).astype(np.float32)
+    for reducer in reducers:
+        times['ragged ' + reducer] = timed(aggregate, ragged, counts, reducer)[1]
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--nwindows', type=int, default=10**6, help='number of windows')
+    args = parser.parse_args()
+    times = run(args.nwindows)
+    for name in sorted(times, key=times.get):
+        print('%-16s %8.4fs %8.1fx' % (name, times[name], times['loop'] / times[name]))
@@ -0,0 +1,190 @@
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Time each stage of the pipeline on synthetic data and save the results as
+JSON for comparison across commits.
+
+The stages are the conversion of .mat files into .wav files, building the
+index files, loading batches with SingleLoader, MultiLoader and WavLoader
+and the aggregation of predictions along with the AUC. Stages whose
+dependencies are missing are recorded as skipped.
+
+Usage:
+    python -m bench.run /tmp/bench -o bench.json
+"""
+import os
+import glob
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+import multiprocessing
+import numpy as np
+from prep import nwin
+from bench import aggregate, synth
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+
+def commit():
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def data_paths(data_dir, subjects):
+    paths = []
+    for subj in subjects:
+        for template in ['train_%d', 'test_%d', 'test_%d_new']:
+            path = os.path.join(data_dir, template % subj)
+            paths.append((path, template == 'train_%d'))
+    return paths
+
+
+def bench_prep(data_dir, subjects, nprocs):
+    from prep import extract_all, manifest_name, native_fs
+    paths = data_paths(data_dir, subjects)
+    for path, training in paths:
+        for filename in glob.glob(os.path.join(path, '*.wav')):
+            os.remove(filename)
+        if os.path.exists(os.path.join(path, manifest_name)):
+            os.remove(os.path.join(path, manifest_name))
+    nfiles = sum(len(glob.glob(os.path.join(path, '*.mat'))) for path, training in paths)
+    seconds = timed(extract_all, paths, native_fs, nprocs)[1]
+    return dict(segments=nfiles, seconds=seconds, segments_per_sec=nfiles / seconds)
+
+
+def bench_index(data_dir, subjects):
+    import catalog
+    from indexer import make_indexes
+    for path, training in data_paths(data_dir, subjects):
+        for filename in glob.glob(os.path.join(path, '*-index.csv')):
+            os.remove(filename)
+        for filename in glob.glob(os.path.join(path, 'catalog-*')):
+            os.remove(filename)
+    catalog.loaded.clear()
+    result = {}
+    for subj in subjects:
+        train_dir = os.path.join(data_dir, 'train_%d' % subj)
+        result['subject %d' % subj] = timed(make_indexes, train_dir, subj, [0])[1]
+    result['seconds'] = sum(result.values())
+    return result
+
+
+def bench_loader(data_dir, subj, name, nbatches, bsz):
+    from neon.backends import gen_backend
+    import loader
+    gen_backend(backend='cpu', batch_size=bsz)
+    train_dir = os.path.join(data_dir, 'train_%d' % subj)
+    if name == 'SingleLoader':
+        data = loader.SingleLoader(train_dir, subj, 0, True, True)
+    else:
+        data = getattr(loader, name)(train_dir, subj, list(range(16)), True, True)
+    count = 0
+    start = time.time()
+    while count < nbatches:
+        for batch in data:
+            count += 1
+            if count == nbatches:
+                break
+    seconds = time.time() - start
+    return dict(batches=count, batch_size=bsz, seconds=seconds, batches_per_sec=count / seconds)
+
+
+def bench_score(nwindows):
+    from util import score
+    times = aggregate.run(nwindows)
+    rng = np.random.RandomState(0)
+    nsegs = nwindows // nwin
+    labels = np.repeat(rng.randint(2, size=nsegs), nwin)
+    preds = rng.uniform(size=len(labels)).astype(np.float32)
+    times['score'] = timed(score, labels, preds)[1]
+    return dict(windows=nwindows, seconds=times)
+
+
+def run_stage(results, name, func, *args):
+    print('Running %s...' % name)
+    try:
+        results[name] = func(*args)
+    except ImportError as error:
+        print('Skipping %s: %s' % (name, error))
+        results[name] = dict(skipped=str(error))
+    print(json.dumps(results[name], sort_keys=True))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_dir', help='directory for the synthetic data')
+    parser.add_argument('-o', '--output', default='bench.json', help='JSON file to write')
+    parser.add_argument('-subj', '--subjects', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('-train', '--ntrain', type=int, default=60,
+                        help='training segments per subject')
+    parser.add_argument('-test', '--ntest', type=int, default=12,
+                        help='segments per subject in test_N and in test_N_new')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='number of processes for the conversion')
+    parser.add_argument('-batches', '--nbatches', type=int, default=20,
+                        help='number of batches to load with each loader')
+    parser.add_argument('-z', '--batch_size', type=int, default=32)
+    parser.add_argument('-windows', '--nwindows', type=int, default=10**6,
+                        help='number of predictions to aggregate')
+    parser.add_argument('-keep', '--keep', action='store_true',
+                        help='keep the synthetic data for the next run')
+    args = parser.parse_args()
+
+    config = dict((key, value) for key, value in vars(args).items()
+                  if key not in ('data_dir', 'output', 'keep'))
+    results = dict(commit=commit(), time=time.strftime('%Y-%m-%d %H:%M:%S'),
+                   python=platform.python_version(), machine=platform.machine(),
+                   cpus=multiprocessing.cpu_count(), config=config)
+    # Only directories created by this script are reused or deleted.
+    marker = os.path.join(args.data_dir, 'bench-data.json')
+    scale = dict(subjects=args.subjects, ntrain=args.ntrain, ntest=args.ntest)
+    if os.path.exists(args.data_dir):
+        assert os.path.exists(marker), '%s was not created by bench.run' % args.data_dir
+    if os.path.exists(marker) and json.load(open(marker)) == scale:
+        print('Reusing the synthetic data in %s' % args.data_dir)
+    else:
+        if os.path.exists(args.data_dir):
+            shutil.rmtree(args.data_dir)
+        count, seconds = timed(synth.generate, args.data_dir, args.subjects,
+                               args.ntrain, args.ntest, args.ntest)
+        print('Generated %d files in %.1fs' % (count, seconds))
+        with open(marker, 'w') as fd:
+            json.dump(scale, fd)
+
+    stages = results['stages'] = {}
+    run_stage(stages, 'prep', bench_prep, args.data_dir, args.subjects, args.jobs)
+    run_stage(stages, 'index', bench_index, args.data_dir, args.subjects)
+    for name in ['SingleLoader', 'MultiLoader', 'WavLoader']:
+        run_stage(stages, name, bench_loader, args.data_dir, args.subjects[0], name,
+                  args.nbatches, args.batch_size)
+    run_stage(stages, 'score', bench_score, args.nwindows)
+
+    with open(args.output, 'w') as fd:
+        json.dump(results, fd, indent=2, sort_keys=True)
+    print('Wrote %s' % args.output)
+    if not args.keep:
+        shutil.rmtree(args.data_dir)
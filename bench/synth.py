@@ -0,0 +1,134 @@
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Generate a synthetic data set with the layout of the Kaggle data.
+
+Every subject gets train_N, test_N and test_N_new directories of .mat
+files holding a dataStruct with the same fields as the real files, along
+with train_and_test_data_labels_safe.csv and sample_submission.csv. The
+segments of an hour are numbered consecutively as in the real data and
+a few segments are all zeros (dropouts), which prep.py skips or keeps as
+it does for the real ones.
+
+Usage:
+    python -m bench.synth /tmp/synth -train 60 -test 12
+"""
+import os
+import argparse
+import numpy as np
+from scipy import io
+from prep import native_fs
+
+
+nchans = 16
+# Segments per hour
+seq_len = 6
+
+
+def segment(rng, label, nsamples):
+    """
+    Return (samples, channels) of noise with a low frequency rhythm whose
+    amplitude depends on the label.
+    """
+    dat = rng.standard_normal((nsamples, nchans)).astype(np.float32) * 20
+    t = np.arange(nsamples, dtype=np.float32) / native_fs
+    freqs = rng.uniform(1, 30, size=nchans).astype(np.float32)
+    dat += (10 + 10 * label) * np.sin(2 * np.pi * t[:, np.newaxis] * freqs)
+    return dat
+
+
+def write_mat(filename, dat, seq):
+    fields = [('data', 'O'), ('iEEGsamplingRate', 'O'), ('nSamplesSegment', 'O'),
+              ('channelIndices', 'O'), ('sequence', 'O')]
+    ds = np.zeros((1, 1), dtype=fields)
+    ds[0, 0]['data'] = dat
+    ds[0, 0]['iEEGsamplingRate'] = np.array([[native_fs]], dtype=np.float64)
+    ds[0, 0]['nSamplesSegment'] = np.array([[dat.shape[0]]], dtype=np.float64)
+    ds[0, 0]['channelIndices'] = np.arange(1, nchans + 1, dtype=np.float64)[np.newaxis]
+    ds[0, 0]['sequence'] = np.array([[seq]], dtype=np.float64)
+    io.savemat(filename, {'dataStruct': ds})
+
+
+def generate(data_dir, subjects=(1, 2, 3), ntrain=60, ntest=12, nnew=12,
+             preictal=0.2, dropout=0.05, nsamples=10 * 60 * native_fs, seed=0):
+    """
+    Write ntrain training segments, ntest old test segments and nnew test
+    segments per subject to data_dir, of which about the fraction preictal
+    is preictal and the fraction dropout is all zeros. Returns the number
+    of .mat files written.
+    """
+    rng = np.random.RandomState(seed)
+    safety = []
+    subm = []
+    count = 0
+    for subj in subjects:
+        for template, nsegs in [('train_%d', ntrain), ('test_%d', ntest), ('test_%d_new', nnew)]:
+            path = os.path.join(data_dir, template % subj)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            # Whole hours of either class, as in the real data
+            nhours = -(-nsegs // seq_len)
+            hour_labels = (rng.uniform(size=nhours) < preictal).astype(int)
+            hour_labels[0] = 1
+            # Training segments are numbered separately for each class.
+            counts = [0, 0]
+            for i in range(nsegs):
+                label = hour_labels[i // seq_len]
+                counts[label] += 1
+                if template == 'train_%d':
+                    name = '%d_%d_%d.mat' % (subj, counts[label], label)
+                elif template == 'test_%d':
+                    name = '%d_%d.mat' % (subj, i + 1)
+                else:
+                    name = 'new_%d_%d.mat' % (subj, i + 1)
+                if rng.uniform() < dropout:
+                    dat = np.zeros((nsamples, nchans), dtype=np.float32)
+                else:
+                    dat = segment(rng, label, nsamples)
+                write_mat(os.path.join(path, name), dat, i % seq_len + 1)
+                count += 1
+                if template == 'test_%d_new':
+                    subm.append(name)
+                else:
+                    safe = 0 if dat.max() == 0 else 1
+                    safety.append('%s,%d,%d' % (name, label, safe))
+    with open(os.path.join(data_dir, 'train_and_test_data_labels_safe.csv'), 'w') as fd:
+        fd.write('image,class,safe\n')
+        fd.write('\n'.join(safety) + '\n')
+    with open(os.path.join(data_dir, 'sample_submission.csv'), 'w') as fd:
+        fd.write('File,Class\n')
+        fd.write(''.join('%s,0\n' % name for name in subm))
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_dir', help='directory to create')
+    parser.add_argument('-subj', '--subjects', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('-train', '--ntrain', type=int, default=60,
+                        help='training segments per subject')
+    parser.add_argument('-test', '--ntest', type=int, default=12,
+                        help='segments per subject in test_N and in test_N_new')
+    parser.add_argument('-preictal', '--preictal', type=float, default=0.2,
+                        help='fraction of preictal hours')
+    parser.add_argument('-dropout', '--dropout', type=float, default=0.05,
+                        help='fraction of all-zero segments')
+    parser.add_argument('-seed', '--seed', type=int, default=0)
+    args = parser.parse_args()
+    count = generate(args.data_dir, args.subjects, args.ntrain, args.ntest, args.ntest,
+                     args.preictal, args.dropout, seed=args.seed)
+    print('Wrote %d files to %s' % (count, args.data_dir))
@@ -0,0 +1,168 @@
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Catalog of the windows available in a data directory.
+
+The directory is scanned once and the fields encoded in the file names
+(subject, segment, hour and label) are parsed along with the safety flag
+into NumPy columns with one row per window. The catalog is saved in the
+directory and reused until prep.py updates the directory or the safety
+file changes.
+"""
+import os
+import numpy as np
+import store
+from prep import nwin, manifest_name
+
+
+safety_name = 'train_and_test_data_labels_safe.csv'
+columns = ['names', 'wins', 'subjs', 'segms', 'hours', 'labels', 'safe']
+# Catalogs loaded by this process
+loaded = {}
+
+
+def safety_file(path):
+    par_dir = os.path.dirname(os.path.normpath(path))
+    return os.path.join(par_dir, safety_name)
+
+
+def load_safety_flags(path):
+    filename = safety_file(path)
+    if not os.path.exists(filename):
+        return {}
+    safety_info = np.loadtxt(filename, dtype=str, delimiter=',', skiprows=1, ndmin=2)
+    return {line[0].split('.')[0]: line[2] == '1' for line in safety_info}
+
+
+def parse(name):
+    """
+    Return the subject, segment and label encoded in a segment name such as
+    1_10_1 (training), 1_10 (old test) or new_1_10 (test). The label is -1
+    if it is unknown.
+    """
+    tokens = name.split('_')
+    if tokens[0] == 'new':
+        return int(tokens[1]), int(tokens[2]), -1
+    if len(tokens) == 3:
+        return int(tokens[0]), int(tokens[1]), int(tokens[2])
+    return int(tokens[0]), int(tokens[1]), -1
+
+
+def scan(path, use_store):
+    """
+    Return the (segment name, window) pairs found in path.
+    """
+    if use_store:
+        # The stores at all the sampling rates hold the same segments (see prep.store_all()).
+        names = store.available(path)
+        assert len(names) > 0, 'No sample store found in %s' % path
+        names = store.Store(path, names[0]).segment_names()
+        return [(name, win) for name in names for win in range(nwin)]
+    names = set()
+    for filename in os.listdir(path):
+        if not filename.endswith('.wav'):
+            continue
+        # Each recording is saved as the file of its first window (see prep.recname()).
+        name, win = filename.split('.')[:2]
+        if win == '0':
+            names.add(name)
+    return [(name, win) for name in sorted(names) for win in range(nwin)]
+
+
+def signature(path, use_store):
+    """
+    Return the mtimes of the files that are rewritten by prep.py whenever
+    the contents of path change, or None if there is no such file.
+    """
+    if use_store:
+        names = store.available(path)
+        if len(names) == 0:
+            return None
+        filename = store.prefix(path, names[0]) + '.npz'
+    else:
+        filename = os.path.join(path, manifest_name)
+    if not os.path.exists(filename):
+        return None
+    sfile = safety_file(path)
+    return np.array([os.stat(filename).st_mtime,
+                     os.stat(sfile).st_mtime if os.path.exists(sfile) else 0])
+
+
+class Catalog(object):
+    def __init__(self, path, use_store=False):
+        self.path = path
+        self.use_store = use_store
+        filename = os.path.join(path, 'catalog-%s.npz' % ('store' if use_store else 'wav'))
+        sig = signature(path, use_store)
+        if sig is not None and os.path.exists(filename):
+            saved = np.load(filename)
+            if np.array_equal(saved['signature'], sig):
+                for col in columns:
+                    setattr(self, col, saved[col])
+                return
+        print('Creating %s...' % filename)
+        self.build(path, use_store)
+        if sig is None:
+            return
+        # Concurrent runs may rebuild the same catalog.
+        tmpfile = filename + '.tmp.' + str(os.getpid())
+        with open(tmpfile, 'wb') as fd:
+            np.savez(fd, signature=sig, **{col: getattr(self, col) for col in columns})
+        os.rename(tmpfile, filename)
+
+    def build(self, path, use_store):
+        pairs = scan(path, use_store)
+        assert len(pairs) > 0, 'No .wav files found in %s' % path
+        flags = load_safety_flags(path)
+        segm_names = sorted(set(name for name, win in pairs))
+        fields = dict((name, parse(name)) for name in segm_names)
+        self.names = np.array([name for name, win in pairs])
+        self.wins = np.array([win for name, win in pairs], dtype=np.int16)
+        self.subjs = np.array([fields[name][0] for name, win in pairs], dtype=np.int8)
+        self.segms = np.array([fields[name][1] for name, win in pairs], dtype=np.int32)
+        self.labels = np.array([fields[name][2] for name, win in pairs], dtype=np.int8)
+        self.hours = self.segms - (self.segms - 1) % 6
+        self.safe = np.array([flags.get(name, False) for name, win in pairs], dtype=bool)
+
+    def __len__(self):
+        return len(self.names)
+
+    def filenames(self, rows, elec, prefix=''):
+        """
+        Return the names of the windows of the given rows and electrode. They
+        are those of .wav files for the first window only (see prep.py).
+        """
+        names = np.char.add(prefix, self.names[rows])
+        names = np.char.add(names, '.')
+        names = np.char.add(names, self.wins[rows].astype(str))
+        return np.char.add(names, '.' + str(elec) + '.wav')
+
+    def sort_keys(self):
+        """
+        Return keys that sort the rows in the same order as their file names.
+        """
+        keys = np.char.add(np.char.add(self.names, '.'), self.wins.astype(str))
+        return np.char.add(keys, '.')
+
+
+def get(path, use_store=False):
+    """
+    Return the catalog of path, loading or building it at most once.
+    """
+    key = (os.path.normpath(path), use_store)
+    if key not in loaded:
+        loaded[key] = Catalog(path, use_store)
+    return loaded[key]
@@ -0,0 +1,167 @@
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Save the state of training every few epochs and resume from it.
+
+The model is saved with the states of its layers, which include those of
+the optimizer (the sums of squared gradients of Adagrad), to
+<dir>/<name>.<epoch>.prm. The number of epochs done, the evaluations so
+far, a key that identifies the settings of the run and a hash of the
+parameters are saved to <dir>/<name>.<epoch>.json, which is written last.
+A checkpoint is valid if its key matches that of the run and its
+parameters match the hash. Training resumes from the latest valid
+checkpoint and the others are deleted as the run goes on.
+
+The outputs of the model on the test set are saved next to the checkpoint
+they were computed from, so a run that has finished only reads them.
+"""
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+from neon import logger
+from neon.callbacks.callbacks import Callback
+
+
+def file_hash(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def run_key(**settings):
+    """
+    Return a key for the settings of a run, which must be JSON serializable.
+    """
+    return hashlib.md5(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Checkpoint(Callback):
+    """
+    Save the model every freq epochs, after the last epoch and when training
+    stops early, keeping the latest keep checkpoints. state holds the state
+    of the checkpoint that was last saved or loaded.
+    """
+    def __init__(self, path, name, key, num_epochs, evaluator=None, freq=1, keep=2):
+        super(Checkpoint, self).__init__()
+        self.path = path
+        self.name = name
+        self.key = key
+        self.num_epochs = num_epochs
+        self.evaluator = evaluator
+        self.freq = freq
+        self.keep = keep
+        self.state = None
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Concurrent runs may create it at the same time.
+            if not os.path.isdir(path):
+                raise
+
+    def base(self, epoch):
+        return os.path.join(self.path, '%s.%s' % (self.name, epoch))
+
+    def saved(self):
+        """
+        Return the epochs of the checkpoints on disk, latest first.
+        """
+        epochs = []
+        for filename in glob.glob(self.base('*') + '.json'):
+            epoch = os.path.basename(filename)[len(self.name) + 1:-len('.json')]
+            if epoch.isdigit():
+                epochs.append(int(epoch))
+        return sorted(epochs, reverse=True)
+
+    def remove(self, epoch):
+        base = self.base(epoch)
+        # The state goes first, so that it never names missing parameters.
+        os.remove(base + '.json')
+        for filename in glob.glob(base + '.*'):
+            os.remove(filename)
+
+    def on_epoch_end(self, callback_data, model, epoch):
+        if (epoch + 1) % self.freq != 0 and epoch + 1 < self.num_epochs and not model.finished:
+            return
+        base = self.base(epoch + 1)
+        model.save_params(base + '.prm.tmp', keep_states=True)
+        state = dict(epoch=epoch + 1, key=self.key, stopped=bool(model.finished),
+                     params=file_hash(base + '.prm.tmp'))
+        if self.evaluator is not None:
+            state['history'] = self.evaluator.history
+        os.rename(base + '.prm.tmp', base + '.prm')
+        with open(base + '.json.tmp', 'w') as fd:
+            json.dump(state, fd)
+        os.rename(base + '.json.tmp', base + '.json')
+        self.state = state
+        for old in self.saved()[self.keep:]:
+            self.remove(old)
+
+    def resume(self, model, dataset, cost):
+        """
+        Load the latest valid checkpoint, if there is one, into model and
+        return its state. The model is initialized for dataset and cost
+        first. Checkpoints of runs with other settings are deleted.
+        """
+        for epoch in self.saved():
+            base = self.base(epoch)
+            try:
+                with open(base + '.json') as fd:
+                    state = json.load(fd)
+            except ValueError:
+                state = {}
+            if state.get('key') != self.key:
+                logger.display('Removing %s, saved with other settings' % base)
+                self.remove(epoch)
+                continue
+            if not os.path.exists(base + '.prm') or file_hash(base + '.prm') != state['params']:
+                logger.display('Removing %s, which is incomplete' % base)
+                self.remove(epoch)
+                continue
+            model.initialize(dataset, cost)
+            model.load_params(base + '.prm', load_states=True)
+            # Training continues with the next epoch.
+            model.epoch_index = state['epoch']
+            self.state = state
+            return state
+        return None
+
+    def finished(self):
+        """
+        Return whether the model in the last checkpoint is done training.
+        """
+        return self.state is not None and (self.state['stopped'] or
+                                           self.state['epoch'] >= self.num_epochs)
+
+    def outputs_file(self):
+        return self.base(self.state['epoch']) + '.' + self.state['params'][:12] + '.npy'
+
+    def load_outputs(self):
+        """
+        Return the outputs saved for the last checkpoint, or None.
+        """
+        if self.state is None or not os.path.exists(self.outputs_file()):
+            return None
+        return np.load(self.outputs_file())
+
+    def save_outputs(self, outputs):
+        filename = self.outputs_file()
+        with open(filename + '.tmp', 'wb') as fd:
+            np.save(fd, outputs)
+        os.rename(filename + '.tmp', filename)
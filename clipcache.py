@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+In-memory caches of the spectrograms of samples, bounded by a memory budget.
+
+LRUCache lives in the memory of the process and evicts the least recently
+used sample when the budget is reached. SharedCache keeps the samples in
+a file under /dev/shm so that concurrent runs on the same machine share
+one copy. It is direct-mapped: every sample has one slot, determined by
+its key, and a sample replaces whatever occupied its slot.
+
+The spectrograms are kept as uint8, like in the caches of speccache.py.
+
+The files of a shared cache outlive the runs that use it. Creating one
+removes those of the same namespace but another version of the data, and
+    ./clipcache.py clean
+removes all of them once no run is using them.
+"""
+import os
+import glob
+import hashlib
+import argparse
+import threading
+import collections
+import numpy as np
+
+
+prefix = 'sp2016-'
+
+
+def create_cache(namespace, shape, budget, shared=False, version=''):
+    """
+    Return a cache for samples of the given shape that uses up to budget
+    bytes. Caches with the same namespace and version, which together
+    should identify the contents of a sample, are shared between processes
+    if shared is set.
+    """
+    if shared:
+        return SharedCache(namespace, shape, budget, version)
+    return LRUCache(shape, budget)
+
+
+def clean(shm_dir='/dev/shm'):
+    """
+    Remove the files of all the shared caches and return their names.
+    """
+    filenames = sorted(glob.glob(os.path.join(shm_dir, prefix + '*')))
+    for filename in filenames:
+        os.remove(filename)
+    return filenames
+
+
+class LRUCache(object):
+    def __init__(self, shape, budget):
+        self.shape = tuple(shape)
+        self.capacity = max(1, int(budget // np.prod(self.shape)))
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = dict(hits=0, misses=0, evictions=0)
+
+    def get(self, key, out):
+        """
+        Copy the sample with the given key to out and return True, or
+        return False if it is not in the cache.
+        """
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                self.stats['misses'] += 1
+                return False
+            self.items[key] = item
+            self.stats['hits'] += 1
+        out[:] = item
+        return True
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                return
+            if len(self.items) < self.capacity:
+                item = np.empty(self.shape, dtype=np.uint8)
+            else:
+                # Reuse the memory of the least recently used sample.
+                item = self.items.popitem(last=False)[1]
+                self.stats['evictions'] += 1
+            np.copyto(item, value, casting='unsafe')
+            self.items[key] = item
+
+    def report(self):
+        return report(self.stats, len(self.items), self.capacity)
+
+
+class SharedCache(object):
+    """
+    A writer marks a slot as empty before it overwrites the data and
+    readers check the key of the slot again after copying the data, so a
+    sample that changes while it is read counts as a miss.
+    """
+    def __init__(self, namespace, shape, budget, version='', shm_dir='/dev/shm'):
+        self.shape = tuple(shape)
+        self.capacity = max(1, int(budget // np.prod(self.shape)))
+        family = os.path.join(shm_dir, '%s%s-' % (prefix, namespace))
+        base = '%s%s-%d' % (family, version, self.capacity)
+        if not os.path.exists(base + '.tags'):
+            self.remove_stale(family, family + version + '-')
+            self.create(base)
+        self.data = np.memmap(base + '.dat', dtype=np.uint8, mode='r+',
+                              shape=(self.capacity,) + self.shape)
+        self.tags = np.memmap(base + '.tags', dtype=np.int64, mode='r+', shape=(self.capacity,))
+        self.stats = dict(hits=0, misses=0, evictions=0)
+
+    def remove_stale(self, family, current):
+        """
+        Remove the files of the caches of this namespace whose names do not
+        start with current. Runs that still use them keep their mappings.
+        """
+        for filename in glob.glob(family + '*'):
+            if not filename.startswith(current):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    # Removed by a concurrent run
+                    pass
+
+    def create(self, base):
+        pid = str(os.getpid())
+        data = np.memmap(base + '.dat.' + pid, dtype=np.uint8, mode='w+',
+                         shape=(self.capacity,) + self.shape)
+        tags = np.memmap(base + '.tags.' + pid, dtype=np.int64, mode='w+', shape=(self.capacity,))
+        del data, tags
+        # The tags file is renamed last; its presence means the cache is ready.
+        os.rename(base + '.dat.' + pid, base + '.dat')
+        os.rename(base + '.tags.' + pid, base + '.tags')
+
+    def lookup(self, key):
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+        # Zero marks an empty slot.
+        tag = int(digest[:15], 16) | 1
+        return tag, tag % self.capacity
+
+    def get(self, key, out):
+        tag, slot = self.lookup(key)
+        if self.tags[slot] == tag:
+            out[:] = self.data[slot]
+            if self.tags[slot] == tag:
+                self.stats['hits'] += 1
+                return True
+        self.stats['misses'] += 1
+        return False
+
+    def put(self, key, value):
+        tag, slot = self.lookup(key)
+        if self.tags[slot] == tag:
+            return
+        if self.tags[slot] != 0:
+            self.stats['evictions'] += 1
+        self.tags[slot] = 0
+        np.copyto(self.data[slot], value, casting='unsafe')
+        self.tags[slot] = tag
+
+    def report(self):
+        return report(self.stats, int(np.count_nonzero(self.tags)), self.capacity)
+
+
+def report(stats, count, capacity):
+    lookups = stats['hits'] + stats['misses']
+    rate = 100.0 * stats['hits'] / lookups if lookups > 0 else 0
+    return ('%d hits, %d misses (%.1f%% hit rate), %d evictions, %d of %d samples cached' %
+            (stats['hits'], stats['misses'], rate, stats['evictions'], count, capacity))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['clean'])
+    parser.add_argument('-dir', '--shm_dir', default='/dev/shm',
+                        help='directory of the shared caches')
+    args = parser.parse_args()
+    for filename in clean(args.shm_dir):
+        print('Removed %s' % filename)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Estimate the AUC of a subject's model by k-fold cross-validation.
+
+The hours of each class are split into k blocks of consecutive hours and
+each fold holds out one block, so the segments of an hour are never split
+between training and validation (see Indexer). The folds are trained
+concurrently by model.py processes within the given core and memory
+budgets. They read the same memory-mapped .wav files or stores, which the
+OS keeps in memory once for all of them; with -sample_cache and
+-shared_cache the spectrograms are also shared (see clipcache.py).
+
+The AUC of each fold and that of the predictions of all folds pooled are
+printed and saved in <output>/cv.json.
+
+Usage:
+    ./crossval.py /path/to/data/train_1 /path/to/output -folds 5 -cores 16 -- -store
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+from pipeline import Job, Scheduler, here
+from indexer import make_fold_indexes, read_index, fold_suffix
+from util import score, segment_counts
+
+
+def build(args, subj, elec):
+    data_dir = os.path.abspath(args.data_dir)
+    out_dir = os.path.abspath(args.out_dir)
+    use_store = args.format != 'wav'
+
+    def make_indexes():
+        make_fold_indexes(data_dir, subj, elec, args.folds, use_store)
+    jobs = [Job('index', make_indexes)]
+    model_cmd = [os.path.join(here, 'model.py'), '-r', '0', '-z', str(args.batch_size),
+                 '-v', '--no_progress_bar', '-elec', str(args.elec), '-w', data_dir,
+                 '-fs', str(args.sampling_freq), '-validate', '-eval', '1']
+    if args.backend is not None:
+        model_cmd += ['-b', args.backend]
+    if args.format == 'store':
+        model_cmd.append('-store')
+    elif args.format == 'cache':
+        model_cmd.append('-cache')
+    model_cmd += args.model_args
+    code = [os.path.join(here, 'model.py'), os.path.join(here, 'loader.py')]
+    for index in range(args.folds):
+        fold_dir = os.path.join(out_dir, 'fold-%d' % index)
+        jobs.append(Job('fold-%d' % index,
+                        model_cmd + ['-fold', str(index), str(args.folds), '-out', fold_dir],
+                        deps=['index'], cores=args.job_cores, mem=args.job_mem, inputs=code,
+                        outputs=[os.path.join(fold_dir, 'eval.%d.npy' % subj)]))
+    return jobs
+
+
+def report(args, subj, elec):
+    """
+    Return the AUC of each fold and of all the folds pooled.
+    """
+    result = dict(folds=[])
+    all_labels = []
+    all_preds = []
+    all_counts = []
+    for index in range(args.folds):
+        set_name = 'eval-%d-%d%s' % (subj, elec, fold_suffix((index, args.folds)))
+        filenames, labels = read_index(os.path.join(args.data_dir, set_name + '-index.csv'))
+        preds = np.load(os.path.join(args.out_dir, 'fold-%d' % index, 'eval.%d.npy' % subj))
+        counts = segment_counts(filenames)
+        result['folds'].append(score(labels, preds, counts))
+        print('Fold %d AUC %.4f (%d segments)' % (index, result['folds'][-1], len(counts)))
+        all_labels.append(labels)
+        all_preds.append(preds)
+        all_counts.append(counts)
+    result['pooled'] = score(np.concatenate(all_labels), np.concatenate(all_preds),
+                             np.concatenate(all_counts))
+    result['mean'] = float(np.mean(result['folds']))
+    result['std'] = float(np.std(result['folds']))
+    print('Pooled AUC %.4f, mean %.4f std %.4f' % (result['pooled'], result['mean'], result['std']))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_dir', help='train_N directory of a subject')
+    parser.add_argument('out_dir', help='directory for the predictions and logs')
+    parser.add_argument('-folds', '--folds', type=int, default=5, help='number of folds')
+    parser.add_argument('-cores', '--cores', type=int, default=multiprocessing.cpu_count(),
+                        help='number of cores to use in total')
+    parser.add_argument('-mem', '--mem', type=float, default=16, help='GB of memory to use in total')
+    parser.add_argument('-job_cores', '--job_cores', type=int, default=None,
+                        help='cores used by each fold (default: an equal share)')
+    parser.add_argument('-job_mem', '--job_mem', type=float, default=2,
+                        help='GB of memory used by each fold')
+    parser.add_argument('-format', '--format', choices=['wav', 'store', 'cache'], default='wav',
+                        help='data format (see run.sh)')
+    parser.add_argument('-fs', '--sampling_freq', type=int, default=400,
+                        help='sampling rate in Hz to train at')
+    parser.add_argument('-elec', '--elec', type=int, default=-1, help='electrode index or -1')
+    parser.add_argument('-z', '--batch_size', type=int, default=64)
+    parser.add_argument('-b', '--backend', default='cpu', help='neon backend')
+    parser.add_argument('model_args', nargs=argparse.REMAINDER,
+                        help='extra arguments for model.py, after --')
+    args = parser.parse_args()
+    if args.model_args[:1] == ['--']:
+        args.model_args = args.model_args[1:]
+    if args.job_cores is None:
+        args.job_cores = max(1, args.cores // args.folds)
+    subj = int(os.path.normpath(args.data_dir)[-1])
+    # The loaders only read the index files of the first electrode.
+    elec = 0 if args.elec == -1 else args.elec
+
+    log_dir = os.path.join(args.out_dir, 'logs')
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    scheduler = Scheduler(build(args, subj, elec), args.cores, args.mem, log_dir)
+    start = time.time()
+    success = scheduler.run()
+    seconds = time.time() - start
+    for job in scheduler.jobs:
+        print('%-12s %-10s %8.1fs' % (job.name, job.status, job.seconds))
+    if not success:
+        print('Some folds failed; see %s' % log_dir)
+        sys.exit(1)
+    result = report(args, subj, elec)
+    result['seconds'] = dict((job.name, round(job.seconds, 1)) for job in scheduler.jobs)
+    result['seconds']['total'] = round(seconds, 1)
+    with open(os.path.join(args.out_dir, 'cv.json'), 'w') as fd:
+        json.dump(result, fd, indent=2, sort_keys=True)
+    print('Total %.1fs' % seconds)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Train the models of several subjects in one process and write the
+submission from the predictions in memory.
+
+This does what model.py followed by subm.py do, but neon and the backend
+are initialized once, index files and stores are read once per process and,
+with -sample_cache, the validation and full runs of a subject share one
+cache of spectrograms. The predictions and models are still saved to the
+output directory. A subject whose runs fail does not stop the others; the
+process exits with an error at the end.
+
+Usage:
+    ./driver.py -w </path/to/data> -r 0 -z 64 -elec -1 -eval 1 -subj 1 2 3
+"""
+
+import os
+import sys
+import copy
+import time
+import traceback
+from neon import NervanaObject, logger
+from neon.util.argparser import NeonArgparser
+from model import add_arguments, get_elecs, make_loaders, run, test_index
+from util import segment_counts
+import subm
+
+
+def main(args):
+    data_dir = os.path.normpath(args.data_dir)
+    # -eval only applies to validation runs; the test sets are unlabeled.
+    full_args = copy.copy(args)
+    full_args.callback_args = dict((key, val) for key, val in args.callback_args.items()
+                                   if key != 'eval_freq')
+    eval_results = []
+    test_results = []
+    failed = []
+    for subj in args.subjects:
+        train_dir = os.path.join(data_dir, 'train_%d' % subj)
+        cache = None
+        for mode in args.modes:
+            start = time.time()
+            validate_mode = mode == 'validate'
+            run_args = args if validate_mode else full_args
+            # Every run starts from the same random state, as in separate processes.
+            NervanaObject.be.rng_reset()
+            try:
+                tain, test = make_loaders(run_args, train_dir, subj, validate_mode, cache)
+                cache = getattr(tain, 'cache', None)
+                preds = run(run_args, train_dir, subj, validate_mode, tain, test, args.out_dir)
+                filenames, labels = test_index(test, train_dir, subj, get_elecs(args),
+                                               validate_mode)
+            except Exception:
+                logger.display(traceback.format_exc())
+                logger.display('Subject %d %s run failed' % (subj, mode))
+                failed.append((subj, mode))
+                continue
+            if validate_mode:
+                eval_results.append((subj, labels, preds, segment_counts(filenames)))
+            else:
+                test_results.append((subj, preds, segment_counts(filenames)))
+            logger.display('Subject %d %s run took %.1fs' % (subj, mode, time.time() - start))
+
+    # subm.py expects the subjects in the order of sample_submission.csv.
+    eval_results.sort(key=lambda result: result[0])
+    test_results.sort(key=lambda result: result[0])
+    if len(eval_results) > 0:
+        subm.validate(eval_results)
+    if [subj for subj, preds, counts in test_results] == [1, 2, 3]:
+        subm.submit(data_dir, test_results)
+    return failed
+
+
+if __name__ == '__main__':
+    parser = NeonArgparser(__doc__)
+    add_arguments(parser)
+    parser.add_argument('-subj', '--subjects', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('-modes', '--modes', nargs='+', choices=['validate', 'full'],
+                        default=['validate', 'full'], help='runs to do for each subject')
+    args = parser.parse_args()
+    assert not args.validate_mode, 'Use -modes validate instead of -validate'
+    assert args.workers == 1, 'Use model.py to train with several workers'
+    logger.warn('Overriding --epochs option')
+    failed = main(args)
+    if len(failed) > 0:
+        logger.display('Failed runs: %s' % ', '.join('%d %s' % run for run in failed))
+        sys.exit(1)
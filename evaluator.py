@@ -0,0 +1,135 @@
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Evaluate a model on the validation set while it trains.
+"""
+import time
+import numpy as np
+from neon import logger
+from neon.callbacks.callbacks import Callback
+from prep import nwin
+from util import score
+
+
+def subsample(labels, fraction):
+    """
+    Return the rows of an evenly spaced selection of about fraction of the
+    segments of each class. Every segment keeps all its windows.
+    """
+    segm_labels = labels[::nwin]
+    segms = []
+    for label in np.unique(segm_labels):
+        candidates = np.where(segm_labels == label)[0]
+        count = max(1, int(round(fraction * len(candidates))))
+        picks = np.linspace(0, len(candidates) - 1, count).round().astype(int)
+        segms.append(candidates[np.unique(picks)])
+    segms = np.sort(np.concatenate(segms))
+    return (segms[:, np.newaxis] * nwin + np.arange(nwin)).ravel()
+
+
+def cross_entropy(labels, preds):
+    """
+    Return the mean of CrossEntropyBinary over both outputs of the model.
+    """
+    preds = np.clip(preds, 1e-7, 1 - 1e-7)
+    return -2 * np.mean(labels * np.log(preds) + (1 - labels) * np.log(1 - preds))
+
+
+class Evaluator(Callback):
+    """
+    Compute the cost and the AUC on eval_set every interval epochs from a
+    single forward pass, given the labels of eval_set. If fraction is less than
+    1, the same subsample of the segments is used every time (loaders derived
+    from BaseLoader only). If patience is nonzero, training stops once the
+    AUC has not improved for that many evaluations. If profiler is set to
+    a profiler.Profiler, the time taken by each evaluation is recorded.
+    The epoch, cost and AUC of every evaluation are kept in history.
+    """
+    def __init__(self, subj, eval_set, labels, interval=1, fraction=1.0, patience=0):
+        super(Evaluator, self).__init__()
+        self.subj = subj
+        self.eval_set = eval_set
+        self.interval = interval
+        self.patience = patience
+        self.labels = labels
+        if fraction < 1:
+            assert hasattr(eval_set, 'iterate'), 'Subsampling is not available with -neon_specgram'
+            self.rows = subsample(self.labels, fraction)
+        else:
+            self.rows = None
+        self.best_auc = 0
+        self.best_epoch = -1
+        # Predictions on the whole set from the last evaluation
+        self.preds = None
+        self.epoch = -1
+        self.profiler = None
+        # Evaluations since the best AUC
+        self.stale = 0
+        self.history = []
+
+    def restore(self, history):
+        """
+        Continue from the evaluations of an earlier run that was checkpointed.
+        """
+        for entry in history:
+            self.update(entry['epoch'], entry['auc'])
+        self.history = list(history)
+
+    def on_train_begin(self, callback_data, model, epochs):
+        callback_data.create_dataset('cost/loss', (epochs // self.interval,))
+        callback_data['cost/loss'].attrs['time_markers'] = 'epoch_freq'
+        callback_data['cost/loss'].attrs['epoch_freq'] = self.interval
+
+    def predict(self, model):
+        if self.rows is None:
+            return model.get_outputs(self.eval_set)[:, 1], self.labels
+        bsz = self.be.bsz
+        nrows = len(self.rows)
+        batches = [self.rows[np.arange(start, start + bsz) % nrows]
+                   for start in range(0, nrows, bsz)]
+        preds = np.empty(len(batches) * bsz, dtype=np.float32)
+        for i, (x, t) in enumerate(self.eval_set.iterate(batches)):
+            preds[i * bsz:(i + 1) * bsz] = model.fprop(x, inference=True).get()[1]
+        return preds[:nrows], self.labels[self.rows]
+
+    def on_epoch_end(self, callback_data, model, epoch):
+        if (epoch + 1) % self.interval != 0:
+            return
+        start = time.time()
+        preds, labels = self.predict(model)
+        if self.profiler is not None:
+            self.profiler.add('eval', start, time.time(), 'eval')
+        if self.rows is None:
+            self.preds, self.epoch = preds, epoch
+        cost = cross_entropy(labels, preds)
+        auc = score(labels, preds)
+        callback_data['cost/loss'][epoch // self.interval] = cost
+        logger.display('Eval cost %.4f AUC %.4f for subject %d epoch %d\n' %
+                       (cost, auc, self.subj, epoch))
+        self.history.append(dict(epoch=epoch, cost=float(cost), auc=float(auc)))
+        self.update(epoch, auc)
+        if self.patience > 0 and self.stale >= self.patience:
+            logger.display('Stopping: no improvement in AUC since epoch %d (%.4f)\n' %
+                           (self.best_epoch, self.best_auc))
+            model.finished = True
+
+    def update(self, epoch, auc):
+        if auc > self.best_auc:
+            self.best_auc = auc
+            self.best_epoch = epoch
+            self.stale = 0
+        else:
+            self.stale += 1
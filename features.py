@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+A baseline that trains a classical model per subject on a few features of
+each window, computed from the .mat files:
+
+    - the log power of each electrode in six frequency bands (Welch)
+    - the correlations between electrodes and their eigenvalues
+    - the log variance of each electrode and the mean and standard
+      deviation of its log variance over one-minute slices
+    - the fraction of samples that are zero (dropouts)
+
+The samples and labels are those of the index files used by model.py, so
+eval.N.npy and test.N.npy are written in the same format and subm.py can
+be run on the output directory. Write them to a different directory than
+the predictions of model.py.
+
+Usage:
+    ./features.py /path/to/data /path/to/output
+"""
+import os
+import time
+import argparse
+import multiprocessing
+import numpy as np
+from scipy import io, signal
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+import store
+from prep import native_fs, nwin, window, run_tasks
+from indexer import make_indexes, read_index, set_prefix
+from util import score, segment_counts
+
+
+# Frequency bands in Hz
+bands = [(0.5, 4), (4, 8), (8, 13), (13, 30), (30, 70), (70, 180)]
+
+
+def window_features(dat, fs=native_fs):
+    """
+    Return the features of dat, of shape (electrodes, samples).
+    """
+    nelecs = dat.shape[0]
+    freqs, psd = signal.welch(dat, fs=fs, nperseg=2 * fs, axis=-1)
+    powers = np.stack([psd[:, (freqs >= lo) & (freqs < hi)].sum(axis=-1)
+                       for lo, hi in bands], axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = np.nan_to_num(np.corrcoef(dat))
+    eigs = np.linalg.eigvalsh(corr)
+    slices = dat[:, :dat.shape[1] // (60 * fs) * 60 * fs].reshape(nelecs, -1, 60 * fs)
+    slice_vars = np.log(slices.var(axis=-1) + 1e-6)
+    return np.concatenate([np.log(powers + 1e-6).ravel(),
+                           corr[np.triu_indices(nelecs, 1)],
+                           eigs,
+                           np.log(dat.var(axis=-1) + 1e-6),
+                           slice_vars.mean(axis=-1),
+                           slice_vars.std(axis=-1),
+                           [np.mean(dat == 0)]]).astype(np.float32)
+
+
+def segment_features(srcfile):
+    """
+    Return srcfile along with the features of each of its windows, or None
+    if it cannot be read.
+    """
+    try:
+        mat = io.loadmat(srcfile)
+    except (IOError, ValueError):
+        print('Could not load %s' % srcfile)
+        return srcfile, None
+    dat = mat['dataStruct'][0, 0][0].T.astype(np.float32)
+    feats = []
+    for win in range(nwin):
+        beg, end = window(win, native_fs)
+        feats.append(window_features(dat[:, beg:end]))
+    return srcfile, feats
+
+
+def rows(idx_file):
+    """
+    Return the .mat file and the window of each row of an index file.
+    """
+    path = os.path.dirname(idx_file)
+    filenames = read_index(idx_file)[0]
+    result = []
+    for filename in filenames:
+        segm, win = os.path.basename(filename).split('.')[:2]
+        srcfile = os.path.join(path, os.path.dirname(filename), segm + '.mat')
+        result.append((os.path.normpath(srcfile), int(win)))
+    return result
+
+
+def compute_all(srcfiles, nprocs):
+    """
+    Return a dict from each of srcfiles to the features of its windows.
+    """
+    features = {}
+    start = time.time()
+    for srcfile, feats in run_tasks(segment_features, sorted(srcfiles), nprocs):
+        features[srcfile] = feats
+    print('Computed the features of %d files in %.1fs' % (len(features), time.time() - start))
+    return features
+
+
+def matrix(features, index_rows):
+    return np.stack([features[srcfile][win] for srcfile, win in index_rows])
+
+
+def make_classifier(name, nprocs):
+    if name == 'rf':
+        return RandomForestClassifier(n_estimators=500, min_samples_leaf=2, n_jobs=nprocs,
+                                      random_state=0)
+    return make_pipeline(StandardScaler(), LogisticRegression(C=0.1, max_iter=1000))
+
+
+def fit(clf, x, y, weights):
+    if hasattr(clf, 'steps'):
+        # Pipelines take the weights of their last step by name.
+        clf.fit(x, y, **{clf.steps[-1][0] + '__sample_weight': weights})
+    else:
+        clf.fit(x, y, sample_weight=weights)
+    return clf
+
+
+def run_subject(data_dir, out_dir, subj, clf_name, nprocs):
+    train_dir = os.path.join(data_dir, 'train_%d' % subj)
+    test_dir = os.path.join(data_dir, 'test_%d_new' % subj)
+    make_indexes(train_dir, subj, [0], use_store=len(store.available(train_dir)) > 0)
+
+    def index(path, validate_mode, training, weighted=False):
+        set_name = set_prefix(validate_mode, training) + '-%d-0' % subj
+        return os.path.join(path, set_name + ('-weighted' if weighted else '') + '-index.csv')
+
+    # The training sets list repeated samples once, with their number of uses as weights.
+    runs = [('eval.', index(train_dir, True, True, True), index(train_dir, True, False)),
+            ('test.', index(train_dir, False, True, True), index(test_dir, False, False))]
+    index_rows = dict((idx_file, rows(idx_file))
+                      for name, tain_file, test_file in runs for idx_file in [tain_file, test_file])
+    srcfiles = set(srcfile for idx_rows in index_rows.values() for srcfile, win in idx_rows)
+    features = compute_all(srcfiles, nprocs)
+
+    for preds_name, tain_file, test_file in runs:
+        filenames, labels, weights = read_index(tain_file, weights=True)
+        start = time.time()
+        clf = fit(make_classifier(clf_name, nprocs), matrix(features, index_rows[tain_file]),
+                  labels, weights)
+        preds = clf.predict_proba(matrix(features, index_rows[test_file]))[:, 1]
+        print('Trained on %d samples in %.1fs' % (len(filenames), time.time() - start))
+        if preds_name == 'eval.':
+            test_filenames, test_labels = read_index(test_file)
+            print('Eval AUC for subject %d %.4f' %
+                  (subj, score(test_labels, preds, segment_counts(test_filenames))))
+        np.save(os.path.join(out_dir, preds_name + str(subj) + '.npy'), preds.astype(np.float32))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_dir', help='directory containing train_N and test_N subdirectories')
+    parser.add_argument('out_dir', help='directory to write eval.N.npy and test.N.npy to')
+    parser.add_argument('-subj', '--subjects', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('-clf', '--classifier', choices=['rf', 'lr'], default='rf',
+                        help='random forest or logistic regression')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='number of processes')
+    args = parser.parse_args()
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    for subj in args.subjects:
+        run_subject(args.data_dir, args.out_dir, subj, args.classifier, args.jobs)
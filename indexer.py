@@ -17,25 +17,93 @@
 Generate index files required by the neon data loader.
 """
 import os
-import glob
 import numpy as np
+import catalog
+
+
+# Parsed index files, keyed by path
+loaded = {}
+
+
+def set_prefix(validate_mode, training):
+    if training:
+        return 'tain' if validate_mode else 'full'
+    return 'eval' if validate_mode else 'test'
+
+
+def fold_suffix(fold):
+    """
+    Return the part of the names of the index files that identifies a fold,
+    given as (index, number of folds), or None for the default split.
+    """
+    return '' if fold is None else '-fold%dof%d' % fold
+
+
+def read_index(idx_file, weights=False):
+    """
+    Return the file names and labels listed in an index file, and the
+    weights if requested. Index files without a weight column have a
+    weight of 1 for every sample.
+    """
+    mtime = os.stat(idx_file).st_mtime
+    if idx_file not in loaded or loaded[idx_file][0] != mtime:
+        with open(idx_file) as fd:
+            lines = fd.read().splitlines()
+        fields = [line.split(',') for line in lines[1:] if line]
+        filenames = np.array([f[0] for f in fields])
+        labels = np.array([float(f[1]) for f in fields]).astype(np.int32)
+        if lines[0].endswith(',weight'):
+            sample_weights = np.array([int(f[2]) for f in fields], dtype=np.int32)
+        else:
+            sample_weights = np.ones(len(fields), dtype=np.int32)
+        loaded[idx_file] = (mtime, (filenames, labels, sample_weights))
+    result = loaded[idx_file][1]
+    return result if weights else result[:2]
+
+
+def make_indexes(repo_dir, subj, elecs, use_store=False):
+    """
+    Create the index files of every set for all the given electrodes,
+    including the weighted index files of the training sets.
+    """
+    for validate_mode in [True, False]:
+        for training in [True, False]:
+            indexer = Indexer(repo_dir, validate_mode, training, use_store)
+            prefix = set_prefix(validate_mode, training) + '-' + str(subj) + '-'
+            for elec in elecs:
+                indexer.run(elec, prefix + str(elec))
+                if training:
+                    indexer.run(elec, prefix + str(elec), weighted=True)
+
+
+def make_fold_indexes(repo_dir, subj, elec, nfolds, use_store=False):
+    """
+    Create the index files of the training and validation sets of every
+    fold for cross-validation on the given electrode.
+    """
+    for index in range(nfolds):
+        fold = (index, nfolds)
+        for training in [True, False]:
+            indexer = Indexer(repo_dir, True, training, use_store, fold)
+            set_name = set_prefix(True, training) + '-' + str(subj) + '-' + str(elec)
+            indexer.run(elec, set_name + fold_suffix(fold), weighted=training)
 
 
 class Indexer:
-    def __init__(self, repo_dir, validate_mode, training):
+    """
+    In validation mode, the last 30% of the hours of each class are held
+    out. If fold is given as (index, number of folds), the hours of each
+    class are instead split into that many blocks of consecutive hours and
+    the block with the given index is held out.
+    """
+    def __init__(self, repo_dir, validate_mode, training, use_store=False, fold=None):
         self.repo_dir = repo_dir
         self.validate_mode = validate_mode
         self.training = training
-        if training or validate_mode:
-            self.max_rep_count = 3
-            self.safety_flags = {}
-            par_dir = os.path.dirname(os.path.normpath(repo_dir))
-            safety_file = os.path.join(par_dir, 'train_and_test_data_labels_safe.csv')
-            safety_info = np.loadtxt(safety_file, dtype=str, delimiter=',', skiprows=1)
-            self.safety_flags = {line[0].split('.')[0]: line[2] == '1' for line in safety_info}
-            self.segm_idx = 1
-        else:
-            self.segm_idx = 2
+        self.use_store = use_store
+        self.fold = fold
+        self.max_rep_count = 3
+        self.selection = None
 
     def make_filename(self, path, set_name):
         assert os.path.exists(path), 'Path not found: %s' % path
@@ -43,98 +111,125 @@ class Indexer:
         idx_file = os.path.join(path, filename)
         return idx_file
 
-    def tokenize(self, filename):
-        return filename.split('.')[0].split('_')
-
-    def get_segm(self, filename):
-        return int(self.tokenize(filename)[self.segm_idx])
+    def get_path(self):
+        tain_path = self.repo_dir
+        test_path = tain_path.replace('train', 'test') + '_new'
+        return tain_path if (self.training or self.validate_mode) else test_path
 
-    def get_label(self, filename):
-        return int(self.tokenize(filename)[-1])
+    def select(self):
+        """
+        Return the catalog, rows and repeat counts of the samples in this set.
+        The result does not depend on the electrode and is computed once.
+        """
+        if self.selection is not None:
+            return self.selection
+        cat = catalog.get(self.get_path(), self.use_store)
+        rows = np.arange(len(cat))
+        if self.training or self.validate_mode:
+            rows = rows[cat.safe]
+        rows = rows[np.lexsort((cat.sort_keys()[rows], cat.segms[rows]))]
 
-    def is_safe(self, filename):
-        assert self.training is True or self.validate_mode is True
-        key = os.path.basename(filename).split('.')[0]
-        if key in self.safety_flags:
-            return self.safety_flags[key]
-        return False
+        if self.training or self.validate_mode:
+            rows, counts = self.choose(cat, rows)
+        else:
+            counts = np.ones(len(rows), dtype=np.int32)
+        self.selection = (cat, rows, counts)
+        return self.selection
 
-    def run(self, elec, set_name):
-        tain_path = self.repo_dir
-        test_path = tain_path.replace('train', 'test') + '_new'
-        path = tain_path if (self.training or self.validate_mode) else test_path
+    def run(self, elec, set_name, weighted=False):
+        """
+        Create the index file of the set for the given electrode unless it
+        exists and return its name. Samples that are to be used several
+        times per epoch are repeated or, if weighted is set, listed once
+        with the number of uses in a weight column (see BaseLoader).
+        """
+        if weighted:
+            set_name += '-weighted'
+        path = self.get_path()
         idx_file = self.make_filename(path, set_name)
         if os.path.exists(idx_file):
             return idx_file
 
         print('Creating %s...' % idx_file)
-        pattern = '*.' + str(elec) + '.wav'
-        files = glob.glob(os.path.join(path, pattern))
-        assert len(files) > 0, 'No .wav files found in %s' % path
-        if self.training or self.validate_mode:
-            files = filter(lambda x: self.is_safe(x), files)
-        files = sorted(map(os.path.basename, files))
-        files = sorted(files, key=lambda x: self.get_segm(x))
-
+        cat, rows, counts = self.select()
+        filenames = cat.filenames(rows, elec)
         if self.training or self.validate_mode:
-            chosen_files, labels = self.choose(files)
+            labels = cat.labels[rows].astype(np.int32)
         else:
-            chosen_files, labels = files, np.zeros(len(files))
+            labels = np.zeros(len(filenames), dtype=np.int32)
 
         if self.training and not self.validate_mode:
-            self.append_old_test(chosen_files, labels, elec)
+            old_files = self.old_test_files(elec)
+            filenames = np.concatenate([filenames, old_files])
+            labels = np.concatenate([labels, np.ones(len(old_files), dtype=labels.dtype)])
+            counts = np.concatenate([counts, np.full(len(old_files), self.max_rep_count + 2,
+                                                     dtype=counts.dtype)])
 
-        with open(idx_file, 'w') as fd:
-            fd.write('filename,label\n')
-            for filename, label in zip(chosen_files, labels):
-                fd.write(filename + ',' + str(label) + '\n')
+        # Concurrent runs may create the same file.
+        tmpfile = idx_file + '.tmp.' + str(os.getpid())
+        with open(tmpfile, 'w') as fd:
+            if weighted:
+                fd.write('filename,label,weight\n')
+                for filename, label, count in zip(filenames, labels, counts):
+                    fd.write(filename + ',' + str(label) + ',' + str(count) + '\n')
+            else:
+                fd.write('filename,label\n')
+                for filename, label in zip(np.repeat(filenames, counts), np.repeat(labels, counts)):
+                    fd.write(filename + ',' + str(label) + '\n')
+        os.rename(tmpfile, idx_file)
         return idx_file
 
-    def append_old_test(self, files, labels, elec):
+    def old_test_files(self, elec):
         path = self.repo_dir.replace('train', 'test')
-        pattern = '*.' + str(elec) + '.wav'
-        test_files = glob.glob(os.path.join(path, pattern))
-        test_files = sorted(map(os.path.basename, test_files))
-        for filename in test_files:
-            if not self.is_safe(filename):
-                continue
-            filename = os.path.join(os.path.pardir, os.path.basename(path),
-                                    os.path.basename(filename))
-            for i in range(self.max_rep_count + 2):
-                files.append(filename)
-                labels.append(1)
-
-    def choose(self, files):
+        cat = catalog.get(path, self.use_store)
+        rows = np.arange(len(cat))[cat.safe]
+        rows = rows[np.argsort(cat.sort_keys()[rows], kind='mergesort')]
+        prefix = os.path.join(os.path.pardir, os.path.basename(os.path.normpath(path)), '')
+        return cat.filenames(rows, elec, prefix)
+
+    def choose(self, cat, rows):
+        if self.fold is not None:
+            return self.choose_fold(cat, rows)
         train_percent = 70 if self.validate_mode else 100
-        nfiles = []
-        pfiles = []
-        for fname in files:
-            if self.get_label(fname) == 0:
-                nfiles.append(fname)
-            else:
-                pfiles.append(fname)
-        psegms = np.unique([self.get_segm(f) for f in pfiles])
-        nsegms = np.unique([self.get_segm(f) for f in nfiles])
-        pmax = (np.max(psegms) * train_percent) // 100
-        nmax = (np.max(nsegms) * train_percent) // 100
-
-        chosen_files = []
-        labels = []
-        for filename in files:
-            label = self.get_label(filename)
-            max_hour = nmax if label == 0 else pmax
-            segm = self.get_segm(filename)
-            hour = segm - (segm - 1) % 6
-            if self.training and hour > max_hour:
-                continue
-            if not self.training and hour <= max_hour:
-                continue
-            if self.training:
-                # Repeat recent samples.
-                rep_count = ((self.max_rep_count * hour) / max_hour) + 1
-            else:
-                rep_count = 1
-            for i in range(rep_count):
-                chosen_files.append(filename)
-                labels.append(label)
-        return chosen_files, labels
+        labels = cat.labels[rows]
+        segms = cat.segms[rows]
+        hours = cat.hours[rows]
+        pmax = (np.max(segms[labels != 0]) * train_percent) // 100
+        nmax = (np.max(segms[labels == 0]) * train_percent) // 100
+        max_hours = np.where(labels == 0, nmax, pmax)
+
+        if self.training:
+            keep = hours <= max_hours
+            # Repeat recent samples.
+            counts = ((self.max_rep_count * hours) // max_hours) + 1
+        else:
+            keep = hours > max_hours
+            counts = np.ones(len(rows), dtype=np.int32)
+        return rows[keep], counts[keep]
+
+    def choose_fold(self, cat, rows):
+        index, nfolds = self.fold
+        labels = cat.labels[rows]
+        segms = cat.segms[rows]
+        hours = cat.hours[rows]
+        for label in [0, 1]:
+            nhours = len(np.unique(hours[(labels != 0) == label]))
+            assert nhours >= nfolds, 'Only %d hours with label %d for %d folds' % (
+                nhours, label, nfolds)
+        pmax = np.max(segms[labels != 0])
+        nmax = np.max(segms[labels == 0])
+        max_hours = np.where(labels == 0, nmax, pmax)
+        # Hours are numbered by their first segment, 6 segments apart.
+        folds = ((hours - 1) // 6 * nfolds) // ((max_hours - 1) // 6 + 1)
+        for label in [0, 1]:
+            missing = set(range(nfolds)) - set(folds[(labels != 0) == label])
+            # Hours missing from the catalog (unsafe segments) leave gaps.
+            assert len(missing) == 0, 'No hours with label %d in fold %d. Use fewer folds' % (
+                label, min(missing))
+        if self.training:
+            keep = folds != index
+            counts = ((self.max_rep_count * hours) // max_hours) + 1
+        else:
+            keep = folds == index
+            counts = np.ones(len(rows), dtype=np.int32)
+        return rows[keep], counts[keep]
@@ -0,0 +1,67 @@
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Run a model saved by model.py on spectrograms.
+"""
+import numpy as np
+from neon import NervanaObject
+from neon.models import Model
+from util import avg_preds, calibration, calibrate
+
+
+def model_filename(subj):
+    return 'model.' + str(subj) + '.prm'
+
+
+class Predictor(NervanaObject):
+    """
+    Compute the probability of the preictal class for batches of samples
+    of the given shape (electrodes, height, width). If ref_preds, the
+    predictions of model.py on the test set, are given, they are used to
+    calibrate the outputs the same way as subm.py.
+    """
+    def __init__(self, model_file, shape, subj=None, ref_preds=None):
+        self.model = Model(model_file)
+        self.model.initialize(shape)
+        self.shape = shape
+        self.datum_size = int(np.prod(shape))
+        self.x = self.be.iobuf(self.datum_size, dtype=np.float32)
+        self.host = np.zeros((self.datum_size, self.be.bsz), dtype=np.float32)
+        self.subj = subj
+        if ref_preds is None:
+            self.params = None
+        else:
+            self.params = calibration(subj, avg_preds(ref_preds))
+
+    def predict(self, samples):
+        """
+        Return the outputs for samples of shape (count, electrodes, height, width).
+        """
+        bsz = self.be.bsz
+        preds = np.empty(len(samples), dtype=np.float32)
+        for start in range(0, len(samples), bsz):
+            batch = samples[start:start + bsz]
+            self.host[:, :len(batch)] = batch.reshape(len(batch), -1).T
+            self.x.set(self.host)
+            outputs = self.model.fprop(self.x, inference=True).get()
+            preds[start:start + len(batch)] = outputs[1, :len(batch)]
+        return preds
+
+    def calibrate(self, preds):
+        assert self.params is not None, 'Reference predictions are needed for calibration'
+        preds = np.array(preds, dtype=np.float32)
+        calibrate(self.subj, preds, self.params)
+        return preds
@@ -16,62 +16,380 @@
 """
 Load data for all the electrodes.
 """
+import os
+import time
+import json
+import hashlib
+import collections
+from multiprocessing.pool import ThreadPool
 import numpy as np
+from scipy.io import wavfile
 from neon.data import DataLoader, AudioParams, NervanaDataIterator
-from indexer import Indexer
-from prep import ds_factor, win_dur
+from indexer import Indexer, set_prefix, read_index, fold_suffix
+from prep import nwin, window, recname, store_name, settings, manifest_name
+from spectrogram import Specgram, audio_params, fs
+from speccache import SpecCache
+import store
 
 
-# Sampling frequency
-fs = 400 // ds_factor
-# Clip duration in milliseconds
-cd = win_dur * 60 * 1000
-
-
-def init(repo_dir, validate_mode, training):
+def init(repo_dir, validate_mode, training, fs=fs):
     np.random.seed(0)
-    common_params = dict(sampling_freq=fs, clip_duration=cd, frame_duration=512)
+    common_params = audio_params(fs)
+    media_params = AudioParams(**common_params)
+    set_name = set_prefix(validate_mode, training)
     if training:
-        media_params = AudioParams(**common_params)
-        set_name = 'tain' if validate_mode else 'full'
         data_dir = repo_dir
     else:
-        media_params = AudioParams(**common_params)
-        set_name = 'eval' if validate_mode else 'test'
         data_dir = repo_dir if validate_mode else repo_dir.replace('train', 'test') + '_new'
     data_dir += '/'
     return media_params, set_name, data_dir
 
 
+def data_version(repo_dir, fs=fs, use_store=False):
+    """
+    Return a string that changes whenever prep.py rewrites the .wav files
+    or, if use_store is set, the stores of the subject of repo_dir,
+    including the test directories that other sets read, or changes where
+    the windows start.
+    """
+    train_dir = os.path.normpath(repo_dir)
+    test_dir = train_dir.replace('train', 'test')
+    mtimes = []
+    for path in [train_dir, test_dir, test_dir + '_new']:
+        if use_store:
+            filename = store.prefix(path, store_name(fs)) + '.npz'
+        else:
+            filename = os.path.join(path, manifest_name)
+        mtimes.append(os.stat(filename).st_mtime if os.path.exists(filename) else 0)
+    return json.dumps(dict(settings=settings(fs), stride=window(1, fs)[0], mtimes=mtimes),
+                      sort_keys=True)
+
+
 class SingleLoader(DataLoader):
 
-    def __init__(self, repo_dir, subj, elec, validate_mode, training):
-        media_params, set_name, data_dir = init(repo_dir, validate_mode, training)
+    def __init__(self, repo_dir, subj, elec, validate_mode, training, fs=fs):
+        assert nwin == 1, 'neon reads a file per window. Drop -neon_specgram'
+        media_params, set_name, data_dir = init(repo_dir, validate_mode, training, fs)
         indexer = Indexer(repo_dir, validate_mode, training)
         set_name = set_name + '-' + str(subj) + '-' + str(elec)
         index_file = indexer.run(elec, set_name)
         super(SingleLoader, self).__init__(
             set_name=set_name, media_params=media_params, index_file=index_file,
             repo_dir=data_dir, shuffle=training, target_size=1, nclasses=2)
+        self.index_file = index_file
+
+
+class BaseLoader(NervanaDataIterator):
+    """
+    Iterate over the index file of a set and assemble batches holding the
+    spectrograms of the given electrodes of each sample. All the electrodes
+    of a sample are read together and the samples are shuffled once per
+    epoch. Subclasses implement load_windows() to fill in samples.
+
+    Samples are windows of a segment, given by their offset into the
+    recording of the segment. The windows of a segment in a batch are loaded
+    together and their spectrograms share the frames that they have in
+    common.
+
+    The training sets are read from weighted index files, which list each
+    sample once with the number of times it is to be used per epoch. An
+    epoch has that many slots per sample and the slots are shuffled, as
+    with an index file that repeats the sample. A sample is loaded once
+    for all the slots it has in a batch; with a cache, its slots in later
+    batches read it from there.
+
+    If prefetch is nonzero, up to that many batches are assembled ahead of
+    time by a pool of threads while the model works on the current batch.
+    Reading and the FFTs release the GIL, so this overlaps I/O and
+    spectrogram computation with training. The number of times the model
+    had to wait for a batch is kept in stats. If profiler is set to a
+    profiler.Profiler, the time taken to assemble and upload each batch is
+    recorded.
+
+    If cache is set to a cache from clipcache.py (see use_cache()), loaded
+    samples are kept in memory and later epochs read them from there. When
+    a window is missing from the cache, the other windows of its segment
+    are computed along with it and cached too.
+
+    After use_shard(), the batches of the set are those of a batch size
+    that is the number of workers times larger, and this loader only yields
+    the part of each batch of its worker (see parallel.py).
+
+    fs is the sampling rate of the data, one of those written by prep.py.
+    In validation mode, fold selects a fold for cross-validation (see
+    Indexer) instead of the default split.
+    """
+
+    def __init__(self, repo_dir, subj, elecs, validate_mode, training, use_store=False,
+                 prefetch=0, fs=fs, fold=None):
+        if type(elecs) in (int, str):
+            elecs = [elecs]
+        self.elecs = [int(elec) for elec in elecs]
+        nelecs = len(self.elecs)
+        if self.elecs == list(range(self.elecs[0], self.elecs[0] + nelecs)):
+            # Slicing keeps reads from memory maps zero-copy.
+            self.elec_idx = slice(self.elecs[0], self.elecs[0] + nelecs)
+        else:
+            self.elec_idx = self.elecs
+        self.fs = fs
+        self.repo_dir = repo_dir
+        self.use_store = use_store
+        media_params, set_name, self.data_dir = init(repo_dir, validate_mode, training, fs)
+        super(BaseLoader, self).__init__(name=set_name)
+        assert fold is None or validate_mode, 'Folds are for validation only'
+        indexer = Indexer(repo_dir, validate_mode, training, use_store=use_store, fold=fold)
+        set_name = set_name + '-' + str(subj) + '-' + str(self.elecs[0]) + fold_suffix(fold)
+        self.index_file = indexer.run(self.elecs[0], set_name, weighted=training)
+        self.filenames, self.labels, self.weights = read_index(self.index_file, weights=True)
+        # Number of slots per epoch
+        self.ndata = int(self.weights.sum())
+        self.shuffle = training
+        # The sample of each slot of an epoch, before shuffling
+        self.slots = np.repeat(np.arange(len(self.filenames)), self.weights)
+        self.order = self.slots
+        self.start = 0
+        self.read_windows()
+
+        self.specgram = Specgram(**audio_params(fs))
+        self.shape = (nelecs, self.specgram.height, self.specgram.width)
+        datum_size = self.specgram.datum_size()
+        self.data = self.be.iobuf(nelecs*datum_size, dtype=np.float32)
+        self.targets = self.be.iobuf(2, dtype=np.float32)
+        # Samples are written straight into their column of a host buffer.
+        self.prefetch = prefetch
+        self.buffers = [(np.empty(self.shape + (self.be.bsz,), dtype=np.float32),
+                         np.zeros((2, self.be.bsz), dtype=np.float32))
+                        for i in range(max(prefetch, 1))]
+        self.pool = ThreadPool(prefetch) if prefetch > 0 else None
+        self.stats = dict(batches=0, starved=0, wait_time=0.0)
+        self.profiler = None
+        self.cache = None
+        self.shard = None
+        self.rng = np.random
+        # Epoch of the next pass over the set (see use_shard())
+        self.epoch = 0
+
+    def use_cache(self, budget, shared=False):
+        """
+        Create a cache of up to budget bytes for the samples of this set and
+        return it. The cache can be handed to other sets with the same
+        electrodes and rate by setting their cache attribute. Samples are
+        cached by file name, so a shared cache is also keyed on the version
+        of the data (see data_version()), and creating it removes those of
+        older versions.
+        """
+        from clipcache import create_cache
+        elecs = '-'.join(str(elec) for elec in self.elecs)
+        desc = self.specgram.key() + elecs + os.path.normpath(os.path.abspath(self.repo_dir))
+        namespace = hashlib.md5(desc.encode('utf-8')).hexdigest()[:12]
+        version = hashlib.md5(self.data_version().encode('utf-8')).hexdigest()[:8]
+        self.cache = create_cache(namespace, self.shape, budget, shared, version)
+        return self.cache
+
+    def data_version(self):
+        return data_version(self.repo_dir, self.fs, self.use_store)
+
+    def use_shard(self, rank, nworkers, seed=None):
+        """
+        Load the share of each batch of worker rank of nworkers. The order
+        of each epoch is drawn from seed and the epoch, so all the workers
+        shuffle alike, whatever else draws from np.random, and a resumed
+        run goes on with the order of the epoch it resumes at.
+        """
+        self.shard = (rank, nworkers)
+        self.seed = seed or 0
+
+    def read_windows(self):
+        """
+        Find the segment, window and offset of each sample.
+        """
+        nsamples = len(self.filenames)
+        self.segments = np.empty(nsamples, dtype=np.int32)
+        self.wins = np.empty(nsamples, dtype=np.int32)
+        self.offsets = np.empty(nsamples, dtype=np.int64)
+        # Path of each segment, without extension, and its samples
+        self.segment_names = []
+        members = []
+        segment_ids = {}
+        for i, filename in enumerate(self.filenames):
+            segm, win = os.path.basename(filename).split('.')[:2]
+            name = os.path.join(os.path.dirname(filename), segm)
+            if name not in segment_ids:
+                segment_ids[name] = len(self.segment_names)
+                self.segment_names.append(name)
+                members.append([])
+            self.segments[i] = segment_ids[name]
+            self.wins[i] = int(win)
+            self.offsets[i] = window(int(win), self.fs)[0]
+            members[segment_ids[name]].append(i)
+        self.members = [np.array(idxs) for idxs in members]
+
+    def load_windows(self, idxs, outs):
+        """
+        Fill each of outs, of shape (electrodes, height, width), with the
+        sample at the same position in idxs. The samples are windows of the
+        same segment.
+        """
+        raise NotImplementedError()
+
+    def cache_key(self, idx):
+        return os.path.normpath(os.path.join(self.data_dir, self.filenames[idx]))
+
+    def cached_load(self, idxs, outs):
+        if self.cache is None:
+            self.load_windows(idxs, outs)
+            return
+        misses = [i for i, idx in enumerate(idxs)
+                  if not self.cache.get(self.cache_key(idx), outs[i])]
+        if len(misses) == 0:
+            return
+        # The other windows of the segment share most of their frames with these.
+        others = [idx for idx in self.members[self.segments[idxs[0]]] if idx not in idxs]
+        load_idxs = [idxs[i] for i in misses] + others
+        load_outs = [outs[i] for i in misses] + list(np.empty((len(others),) + self.shape,
+                                                              dtype=np.uint8))
+        self.load_windows(load_idxs, load_outs)
+        for idx, out in zip(load_idxs, load_outs):
+            self.cache.put(self.cache_key(idx), out)
+
+    def reset(self):
+        self.start = 0
+
+    @property
+    def total_bsz(self):
+        """
+        Return the number of samples per batch over all the shards.
+        """
+        return self.be.bsz * (1 if self.shard is None else self.shard[1])
+
+    @property
+    def nbatches(self):
+        return -((self.start - self.ndata) // self.total_bsz)
+
+    def fill(self, idxs, buf):
+        start = time.time()
+        host_data, host_targets = buf
+        host_targets[:] = 0
+        # The columns of each sample and the samples of each segment
+        cols = collections.OrderedDict()
+        for col, idx in enumerate(idxs):
+            cols.setdefault(idx, []).append(col)
+            host_targets[self.labels[idx], col] = 1
+        groups = collections.OrderedDict()
+        for idx in cols:
+            groups.setdefault(self.segments[idx], []).append(idx)
+        for group in groups.values():
+            self.cached_load(group, [host_data[..., cols[idx][0]] for idx in group])
+        for idx_cols in cols.values():
+            for col in idx_cols[1:]:
+                host_data[..., col] = host_data[..., idx_cols[0]]
+        if self.profiler is not None:
+            self.profiler.add('load ' + self.name, start, time.time(), 'data')
+        return buf
+
+    def upload(self, buf):
+        start = time.time()
+        host_data, host_targets = buf
+        self.data.set(host_data.reshape(self.data.shape))
+        self.targets.set(host_targets)
+        if self.profiler is not None:
+            self.profiler.add('upload ' + self.name, start, time.time(), 'data')
+        return self.data, self.targets
+
+    def next_batch(self, idxs):
+        return self.upload(self.fill(idxs, self.buffers[0]))
+
+    def report(self):
+        return ('%d batches, waited for %d (%.2fs)' %
+                (self.stats['batches'], self.stats['starved'], self.stats['wait_time']))
+
+    def prefetched(self, batches):
+        pending = collections.deque()
+        for buf, idxs in zip(self.buffers, batches):
+            pending.append(self.pool.apply_async(self.fill, (idxs, buf)))
+        try:
+            for i in range(len(batches)):
+                result = pending.popleft()
+                if not result.ready():
+                    self.stats['starved'] += 1
+                    start = time.time()
+                    result.wait()
+                    self.stats['wait_time'] += time.time() - start
+                buf = result.get()
+                self.stats['batches'] += 1
+                batch = self.upload(buf)
+                # The buffer is free again once its contents are on the device.
+                if i + self.prefetch < len(batches):
+                    pending.append(self.pool.apply_async(
+                        self.fill, (batches[i + self.prefetch], buf)))
+                yield batch
+        finally:
+            for result in pending:
+                result.wait()
+
+    def __iter__(self):
+        if self.shard is not None:
+            self.rng = np.random.RandomState(self.seed + self.epoch)
+        if self.shuffle:
+            self.order = self.rng.permutation(self.slots)
+        bsz = self.total_bsz
+        nbatches = self.nbatches
+        # Wrap around to fill the last batch.
+        batches = [self.order[np.arange(start, start + bsz) % self.ndata]
+                   for start in range(self.start, self.ndata, bsz)]
+        if self.shard is not None:
+            rank = self.shard[0]
+            batches = [batch[rank * self.be.bsz:(rank + 1) * self.be.bsz] for batch in batches]
+        for batch in self.iterate(batches):
+            yield batch
+        if self.shard is None:
+            self.start = (self.start + nbatches * bsz) % self.ndata
+        # Otherwise every epoch starts at its first slot, so that its batches
+        # depend on the epoch alone.
+        self.epoch += 1
+
+    def iterate(self, batches):
+        """
+        Yield the device buffers for each list of sample indices in batches.
+        """
+        if self.pool is None:
+            for idxs in batches:
+                yield self.next_batch(idxs)
+        else:
+            for batch in self.prefetched(batches):
+                yield batch
 
 
 class MultiLoader(NervanaDataIterator):
+    """
+    Load the given electrodes of each sample with one neon DataLoader per
+    electrode, which computes the spectrograms. The loaders shuffle alike,
+    so the columns of their batches hold the same samples. Like
+    SingleLoader, this needs a file per window.
+    """
 
-    def __init__(self, repo_dir, subj, elecs, validate_mode, training):
-        if type(elecs) is int:
+    def __init__(self, repo_dir, subj, elecs, validate_mode, training, fs=fs):
+        assert nwin == 1, 'neon reads a file per window. Drop -neon_specgram'
+        if type(elecs) in (int, str):
             elecs = [elecs]
-        nelecs = len(elecs)
-        self.elecs = elecs
-        media_params, set_name_prefix, data_dir = init(repo_dir, validate_mode, training)
+        self.elecs = [int(elec) for elec in elecs]
+        nelecs = len(self.elecs)
+        media_params, set_name_prefix, data_dir = init(repo_dir, validate_mode, training, fs)
+        super(MultiLoader, self).__init__(name=set_name_prefix)
         indexer = Indexer(repo_dir, validate_mode, training)
         self.loaders = []
-        for elec in elecs:
+        index_files = []
+        for elec in self.elecs:
             set_name = set_name_prefix + '-' + str(subj) + '-' + str(elec)
             index_file = indexer.run(elec, set_name)
+            index_files.append(index_file)
             loader = DataLoader(set_name=set_name,
                                 media_params=media_params, index_file=index_file,
                                 repo_dir=data_dir, shuffle=training, target_size=1, nclasses=2)
             self.loaders.append(loader)
+        # The samples of the first electrode stand for those of the others.
+        self.index_file = index_files[0]
+        self.filenames, self.labels = read_index(self.index_file)
         self.shape_list = list(media_params.get_shape())
         self.shape_list[0] = nelecs
         self.shape = tuple(self.shape_list)
@@ -82,23 +400,97 @@ class MultiLoader(NervanaDataIterator):
         self.ndata = self.loaders[0].ndata
 
     def start(self):
-        map(DataLoader.start, self.loaders)
+        for loader in self.loaders:
+            loader.start()
 
     def stop(self):
-        map(DataLoader.stop, self.loaders)
+        for loader in self.loaders:
+            loader.stop()
 
     def reset(self):
-        map(DataLoader.reset, self.loaders)
+        for loader in self.loaders:
+            loader.reset()
 
     @property
     def nbatches(self):
         return self.loaders[0].nbatches
 
     def next(self, start):
-        for elec in self.elecs:
-            self.data_view[elec], targets = self.loaders[elec].next(start)
+        for i, loader in enumerate(self.loaders):
+            self.data_view[i], targets = loader.next(start)
         return self.data, targets
 
     def __iter__(self):
         for start in range(self.loaders[0].start_idx, self.ndata, self.be.bsz):
             yield self.next(start)
+
+
+class WavLoader(BaseLoader):
+    """
+    Load the given electrodes of each sample from the .wav files written by
+    prep.py, which hold the recording of one electrode each, and compute the
+    spectrograms with NumPy (see ./spectrogram.py check).
+    """
+
+    def __init__(self, repo_dir, subj, elecs, validate_mode, training, prefetch=0, fs=fs,
+                 fold=None):
+        super(WavLoader, self).__init__(repo_dir, subj, elecs, validate_mode, training,
+                                        prefetch=prefetch, fs=fs, fold=fold)
+        self.prefixes = [os.path.join(self.data_dir, name) for name in self.segment_names]
+
+    def load_windows(self, idxs, outs):
+        offsets = self.offsets[idxs]
+        end = offsets.max() + self.specgram.nsamples
+        clips = np.empty((len(self.elecs), end), dtype=np.int16)
+        prefix = self.prefixes[self.segments[idxs[0]]]
+        for i, elec in enumerate(self.elecs):
+            rate, clip = wavfile.read(recname(prefix, elec), mmap=True)
+            assert rate == self.fs, 'Sampling rate mismatch. Run prep.py -r %d' % self.fs
+            assert len(clip) >= end, 'Window missing from %s. Run prep.py' % recname(prefix, elec)
+            clips[i] = clip[:end]
+        self.specgram.windows(clips, offsets, outs)
+
+
+class StoreLoader(BaseLoader):
+    """
+    Load the given electrodes of each sample from the sample stores written
+    by prep.py -f store. Spectrograms are computed with NumPy or, if
+    spec_cache is set, read from the caches maintained by speccache.py.
+    """
+
+    def __init__(self, repo_dir, subj, elecs, validate_mode, training, spec_cache=False,
+                 prefetch=0, fs=fs, fold=None):
+        super(StoreLoader, self).__init__(repo_dir, subj, elecs, validate_mode, training,
+                                          use_store=True, prefetch=prefetch, fs=fs, fold=fold)
+        self.read_index()
+        if spec_cache:
+            self.caches = [SpecCache(samples.path, self.specgram, samples)
+                           for samples in self.stores]
+        else:
+            self.caches = None
+
+    def read_index(self):
+        self.stores = []
+        store_ids = {}
+        nsamples = len(self.filenames)
+        self.store_idx = np.empty(nsamples, dtype=np.int32)
+        self.rows = np.empty(nsamples, dtype=np.int64)
+        for i, filename in enumerate(self.filenames):
+            path = os.path.normpath(os.path.join(self.data_dir, os.path.dirname(filename)))
+            if path not in store_ids:
+                store_ids[path] = len(self.stores)
+                self.stores.append(store.Store(path, store_name(self.fs)))
+                assert self.stores[-1].fs == self.fs, 'Sampling rate mismatch in %s' % path
+            segm = os.path.basename(filename).split('.')[0]
+            self.store_idx[i] = store_ids[path]
+            self.rows[i] = self.stores[store_ids[path]].row(segm)
+
+    def load_windows(self, idxs, outs):
+        idx = idxs[0]
+        if self.caches is not None:
+            cache = self.caches[self.store_idx[idx]]
+            for idx, out in zip(idxs, outs):
+                out[:] = cache.get(self.rows[idx], self.wins[idx])[self.elec_idx]
+            return
+        segment = self.stores[self.store_idx[idx]].data[self.rows[idx]]
+        self.specgram.windows(segment[self.elec_idx], self.offsets[idxs], outs)
@@ -20,120 +20,295 @@ https://www.kaggle.com/c/melbourne-university-seizure-prediction
 
 Usage:
     ./model.py -w </path/to/data> -r 0 -z 64 -elec <electrode index or -1>
+
+To train with 4 worker processes on this machine, each taking 16 of the 64
+samples of a batch:
+    ./model.py -w </path/to/data> -r 0 -z 64 -elec -1 -store -workers 4
+
+To train on several machines, start one process per worker with its -rank
+and the address of worker 0:
+    ./model.py ... -workers 8 -rank <0 to 7> -coordinator <host of worker 0>:<port>
 """
 
 import os
 import sys
+import json
+import time
 import numpy as np
-from neon.util.argparser import NeonArgparser
-from neon.initializers import Gaussian, GlorotUniform
-from neon.layers import Conv, Pooling, GeneralizedCost, Affine
-from neon.layers import DeepBiRNN, RecurrentMean, Dropout
+from neon.backends import gen_backend
+from neon.util.argparser import NeonArgparser, extract_valid_args
+from neon.layers import GeneralizedCost
 from neon.optimizers import Adagrad
-from neon.transforms import Rectlin, Softmax, CrossEntropyBinary
+from neon.transforms import CrossEntropyBinary
 from neon.models import Model
-from neon.callbacks.callbacks import Callback, Callbacks
+from neon.callbacks.callbacks import Callbacks
 from neon import logger
-from sklearn import metrics
-from util import score
-
-
-class Evaluator(Callback):
-    def __init__(self, subj, data_dir, eval_set):
-        super(Evaluator, self).__init__()
-        self.subj = subj
-        self.data_dir = data_dir
-        self.eval_set = eval_set
-
-    def on_epoch_end(self, callback_data, model, epoch):
-        preds = model.get_outputs(self.eval_set)[:, 1]
-        idx_file = os.path.join(self.data_dir, 'eval-' + str(self.subj) + '-' + str(0) + '-index.csv')
-        labels = np.loadtxt(idx_file, delimiter=',', skiprows=1, usecols=[1])
-        logger.display('Eval AUC for subject %d epoch %d: %.4f\n' % (self.subj, epoch, score(labels, preds)))
-
-parser = NeonArgparser(__doc__)
-parser.add_argument('-elec', '--electrode', default=0, help='electrode index')
-parser.add_argument('-out', '--out_dir', default='preds', help='directory to write output files')
-parser.add_argument('-validate', '--validate_mode', action="store_true", help="validate on training data")
-
-args = parser.parse_args()
-data_dir = os.path.normpath(args.data_dir)
-out_dir = args.out_dir
-if not os.path.exists(out_dir):
-    os.makedirs(out_dir)
-subj = int(data_dir[-1])
-
-rate = 0.00001
-nepochs = {1: 8, 2: 3, 3: 6}[subj]
-logger.warn('Overriding --epochs option')
-
-if args.electrode == '-1':
-    from loader import MultiLoader as Loader
-    elecs = range(16)
-else:
-    from loader import SingleLoader as Loader
-    rate /= 10
-    elecs = args.electrode
-
-tain = Loader(data_dir, subj, elecs, args.validate_mode, training=True)
-test = Loader(data_dir, subj, elecs, args.validate_mode, training=False)
-
-gauss = Gaussian(scale=0.01)
-glorot = GlorotUniform()
-tiny = dict(str_h=1, str_w=1)
-small = dict(str_h=1, str_w=2)
-big = dict(str_h=1, str_w=4)
-common = dict(batch_norm=True, activation=Rectlin())
-layers = {1: [Conv((3, 5, 64), init=gauss, strides=big, **common),
-          Pooling(2, strides=2),
-          Conv((3, 3, 128), init=gauss, strides=small, **common),
-          Pooling(2, strides=2),
-          Conv((3, 3, 256), init=gauss, strides=small, **common),
-          Conv((2, 2, 512), init=gauss, strides=tiny, **common),
-          Conv((2, 2, 128), init=gauss, strides=tiny, **common),
-          DeepBiRNN(64, init=glorot, reset_cells=True, depth=3, **common),
-          RecurrentMean(),
-          Affine(nout=2, init=gauss, activation=Softmax())],
-          2: [Conv((3, 5, 64), init=gauss, strides=big, **common),
-          Pooling(2, strides=2),
-          Dropout(0.8),
-          Conv((3, 3, 128), init=gauss, strides=small, **common),
-          Pooling(2, strides=2),
-          Dropout(0.4),
-          Conv((3, 3, 256), init=gauss, strides=small, **common),
-          Dropout(0.2),
-          Conv((2, 2, 512), init=gauss, strides=tiny, **common),
-          Conv((2, 2, 128), init=gauss, strides=tiny, **common),
-          DeepBiRNN(64, init=glorot, reset_cells=True, depth=5, **common),
-          RecurrentMean(),
-          Affine(nout=2, init=gauss, activation=Softmax())],
-          3: [Conv((3, 5, 64), init=gauss, strides=big, **common),
-          Pooling(2, strides=2),
-          Dropout(0.8),
-          Conv((3, 3, 128), init=gauss, strides=small, **common),
-          Pooling(2, strides=2),
-          Dropout(0.4),
-          Conv((3, 3, 256), init=gauss, strides=small, **common),
-          Dropout(0.2),
-          Conv((2, 2, 512), init=gauss, strides=tiny, **common),
-          Conv((2, 2, 128), init=gauss, strides=tiny, **common),
-          DeepBiRNN(64, init=glorot, reset_cells=True, depth=5, **common),
-          RecurrentMean(),
-          Affine(nout=2, init=gauss, activation=Softmax())]}[subj]
-
-
-model = Model(layers=layers)
-opt = Adagrad(learning_rate=rate)
-callbacks = Callbacks(model, eval_set=test, **args.callback_args)
-if args.validate_mode:
-    evaluator = Evaluator(subj, data_dir, test)
-    callbacks.add_callback(evaluator)
-    preds_name = 'eval.'
-else:
-    preds_name = 'test.'
-cost = GeneralizedCost(costfunc=CrossEntropyBinary())
-
-model.fit(tain, optimizer=opt, num_epochs=nepochs, cost=cost, callbacks=callbacks)
-preds = model.get_outputs(test)[:, 1]
-preds_file = preds_name + str(subj) + '.npy'
-np.save(os.path.join(out_dir, preds_file), preds)
+from indexer import read_index
+from infer import model_filename
+from evaluator import Evaluator
+from network import defaults, make_layers
+from checkpoint import Checkpoint, file_hash, run_key
+from transport import Transport
+from spectrogram import Specgram, audio_params, save_features
+
+
+def add_arguments(parser):
+    parser.add_argument('-elec', '--electrode', default=0, help='electrode index')
+    parser.add_argument('-out', '--out_dir', default='preds', help='directory to write output files')
+    parser.add_argument('-validate', '--validate_mode', action="store_true", help="validate on training data")
+    parser.add_argument('-store', '--use_store', action="store_true",
+                        help="read samples from the stores written by prep.py -f store")
+    parser.add_argument('-cache', '--spec_cache', action="store_true",
+                        help="read spectrograms from the caches written by speccache.py (implies -store)")
+    parser.add_argument('-neon_specgram', '--neon_specgram', action="store_true",
+                        help="compute the spectrograms of .wav files with neon's DataLoader instead "
+                        "of NumPy (see ./spectrogram.py check)")
+    parser.add_argument('-prefetch', '--prefetch', type=int, default=0,
+                        help="number of batches to prepare in the background (not with -neon_specgram)")
+    parser.add_argument('-eval_fraction', '--eval_fraction', type=float, default=1.0,
+                        help="fraction of the validation segments to evaluate on (not with -neon_specgram)")
+    parser.add_argument('-profile', '--profile', action="store_true",
+                        help="record timings and save profile.<set>.N.json and trace.<set>.N.json")
+    parser.add_argument('-fs', '--sampling_freq', type=int, default=400,
+                        help="sampling rate in Hz, one of those written by prep.py -r")
+    parser.add_argument('-patience', '--patience', type=int, default=0,
+                        help="stop after this many evaluations without improvement in AUC (0 to disable)")
+    parser.add_argument('-sample_cache', '--sample_cache', type=float, default=0,
+                        help="GB of memory for keeping spectrograms across epochs (not with -neon_specgram)")
+    parser.add_argument('-shared_cache', '--shared_cache', action="store_true",
+                        help="keep the sample cache in /dev/shm, shared with concurrent runs")
+    parser.add_argument('-fold', '--fold', type=int, nargs=2, metavar=('INDEX', 'FOLDS'),
+                        help="validate on a fold for cross-validation (see crossval.py)")
+    parser.add_argument('-hparams', '--hparams', type=json.loads, default={},
+                        help="JSON object overriding the hyperparameters in network.defaults()")
+    parser.add_argument('-checkpoint', '--checkpoint',
+                        help="directory for checkpoints of the state of training, from which "
+                        "runs resume (default: <out_dir>/checkpoints)")
+    parser.add_argument('-checkpoint_freq', '--checkpoint_freq', type=int, default=1,
+                        help="epochs between checkpoints")
+    parser.add_argument('-no_checkpoint', '--no_checkpoint', action="store_true",
+                        help="neither save checkpoints nor resume from them")
+    parser.add_argument('-workers', '--workers', type=int, default=1,
+                        help="number of worker processes that share each batch (not with -neon_specgram)")
+    parser.add_argument('-rank', '--rank', type=int,
+                        help="rank of this worker (default: start all the workers on this machine)")
+    parser.add_argument('-coordinator', '--coordinator', metavar='HOST:PORT',
+                        help="address of worker 0, which the other workers connect to")
+
+
+def get_elecs(args):
+    return range(16) if args.electrode == '-1' else args.electrode
+
+
+def make_loaders(args, data_dir, subj, validate_mode, cache=None):
+    """
+    Return the training and test sets. If cache is given, it is used
+    instead of creating a new cache for -sample_cache.
+    """
+    from loader import BaseLoader
+    if args.use_store or args.spec_cache:
+        from loader import StoreLoader as Loader
+    elif not args.neon_specgram:
+        from loader import WavLoader as Loader
+    elif args.electrode == '-1':
+        from loader import MultiLoader as Loader
+    else:
+        from loader import SingleLoader as Loader
+    native = issubclass(Loader, BaseLoader)
+    elecs = get_elecs(args)
+    loader_args = dict(fs=args.sampling_freq)
+    if Loader.__name__ == 'StoreLoader':
+        loader_args['spec_cache'] = args.spec_cache
+    if args.prefetch > 0:
+        assert native, 'Prefetching is not available with -neon_specgram'
+        loader_args['prefetch'] = args.prefetch
+    if validate_mode and args.fold is not None:
+        assert native, 'Cross-validation is not available with -neon_specgram'
+        loader_args['fold'] = tuple(args.fold)
+
+    tain = Loader(data_dir, subj, elecs, validate_mode, training=True, **loader_args)
+    test = Loader(data_dir, subj, elecs, validate_mode, training=False, **loader_args)
+    if args.workers > 1:
+        assert native, 'Several workers are not available with -neon_specgram'
+        tain.use_shard(args.rank, args.workers, args.rng_seed)
+    if args.sample_cache > 0:
+        assert native, 'The sample cache is not available with -neon_specgram'
+        if cache is None:
+            cache = tain.use_cache(int(args.sample_cache * 2**30), args.shared_cache)
+        # One budget for both sets; in validation mode they come from the same segments.
+        tain.cache = test.cache = cache
+    return tain, test
+
+
+def test_index(test, data_dir, subj, elecs, validate_mode):
+    """
+    Return the filenames and labels of the test set.
+    """
+    if hasattr(test, 'filenames'):
+        return test.filenames, test.labels
+    if validate_mode:
+        return read_index(os.path.join(data_dir, 'eval-%d-%s-index.csv' % (subj, elecs)))
+    test_dir = data_dir.replace('train', 'test') + '_new'
+    return read_index(os.path.join(test_dir, 'test-%d-%s-index.csv' % (subj, elecs)))
+
+
+def make_checkpoint(args, data_dir, subj, tain, test, hparams, name, out_dir, evaluator):
+    """
+    Return the Checkpoint callback of a run. Its key covers the settings
+    that affect training or the saved outputs, except for the number of
+    epochs, which a resumed run may increase. The index files stay the same
+    when prep.py rewrites the data or another loader reads it, so the key
+    also covers the loader and the version of the data.
+    """
+    from loader import data_version
+    path = args.checkpoint or os.path.join(out_dir, 'checkpoints')
+    use_store = args.use_store or args.spec_cache
+    key = run_key(hparams=dict((k, v) for k, v in hparams.items() if k != 'epochs'),
+                  elecs=str(args.electrode), fs=args.sampling_freq, batch_size=args.batch_size,
+                  seed=args.rng_seed, fold=args.fold, workers=args.workers,
+                  eval_fraction=args.eval_fraction, patience=args.patience,
+                  index=file_hash(tain.index_file), test_index=file_hash(test.index_file),
+                  loader=type(tain).__name__, spec_cache=args.spec_cache,
+                  data=data_version(data_dir, args.sampling_freq, use_store))
+    return Checkpoint(path, name + str(subj), key, hparams['epochs'], evaluator,
+                      args.checkpoint_freq)
+
+
+def run(args, data_dir, subj, validate_mode, tain, test, out_dir, transport=None):
+    """
+    Train a model for a subject and save its predictions on the test set
+    (and, unless validating, the model) to out_dir. Returns the predictions.
+    When validating, the hyperparameters and the result of every evaluation
+    are saved to eval.N.json. Unless disabled, training is checkpointed and
+    resumes from the last checkpoint; a run that already finished only
+    loads its predictions.
+
+    If transport is given, this is one of several workers (see parallel.py).
+    Workers other than worker 0 only train and return None.
+    """
+    try:
+        os.makedirs(out_dir)
+    except OSError:
+        # The workers of a run create it at the same time.
+        if not os.path.isdir(out_dir):
+            raise
+    elecs = get_elecs(args)
+    hparams = defaults(subj, args.electrode == '-1')
+    hparams.update(args.hparams)
+    model = Model(layers=make_layers(hparams['depth'], hparams['dropout']))
+    worker = transport is not None and transport.rank > 0
+    if transport is None:
+        opt = Adagrad(learning_rate=hparams['rate'])
+    else:
+        from parallel import ParallelAdagrad
+        opt = ParallelAdagrad(transport, learning_rate=hparams['rate'])
+    profiler = None
+    if args.profile:
+        from profiler import Profiler, ProfileCallback
+        profiler = Profiler()
+        for dataset in [tain, test]:
+            # Only the loaders derived from BaseLoader have hooks.
+            if hasattr(dataset, 'profiler'):
+                dataset.profiler = profiler
+    callback_args = dict(args.callback_args)
+    if validate_mode or worker:
+        # The evaluator computes the cost along with the AUC, so the test set
+        # is not run through the model a second time.
+        interval = callback_args.pop('eval_freq', None) or 1
+        callbacks = Callbacks(model, **callback_args)
+    else:
+        callbacks = Callbacks(model, eval_set=test, **callback_args)
+    if profiler is not None:
+        callbacks.add_callback(ProfileCallback(profiler, args.batch_size))
+    evaluator = None
+    if validate_mode and not worker:
+        labels = test_index(test, data_dir, subj, elecs, validate_mode)[1]
+        evaluator = Evaluator(subj, test, labels, interval, args.eval_fraction, args.patience)
+        evaluator.profiler = profiler
+        callbacks.add_callback(evaluator)
+    preds_name = 'eval.' if validate_mode else 'test.'
+    cost = GeneralizedCost(costfunc=CrossEntropyBinary())
+    checkpoint = None
+    # Only worker 0 resumes; the others take its state (see parallel.Sync).
+    if not args.no_checkpoint and not worker:
+        checkpoint = make_checkpoint(args, data_dir, subj, tain, test, hparams, preds_name,
+                                     out_dir, evaluator)
+        callbacks.add_callback(checkpoint)
+        state = checkpoint.resume(model, tain, cost)
+        if state is not None:
+            logger.display('Resuming from %s after %d epochs' %
+                           (checkpoint.base(state['epoch']), state['epoch']))
+            if evaluator is not None:
+                evaluator.restore(state.get('history', []))
+    finished = checkpoint is not None and checkpoint.finished()
+    if transport is not None:
+        from parallel import Sync
+        finished = bool(transport.broadcast(np.array([finished], dtype=np.float32))[0])
+        callbacks.add_callback(Sync(transport, tain))
+
+    if not finished:
+        model.fit(tain, optimizer=opt, num_epochs=hparams['epochs'], cost=cost,
+                  callbacks=callbacks)
+    if worker:
+        return None
+    start = time.time()
+    preds = checkpoint.load_outputs() if finished else None
+    if preds is not None:
+        logger.display('Using the predictions saved with the checkpoint')
+    elif validate_mode and evaluator.epoch == model.epoch_index - 1:
+        preds = evaluator.preds
+    else:
+        preds = model.get_outputs(test)[:, 1]
+    if checkpoint is not None and checkpoint.state is not None:
+        checkpoint.save_outputs(preds)
+    if args.prefetch > 0:
+        logger.display('Training data: %s' % tain.report())
+        logger.display('Test data: %s' % test.report())
+    cache = getattr(tain, 'cache', None)
+    if cache is not None:
+        logger.display('Sample cache: %s' % cache.report())
+    if profiler is not None:
+        profiler.add('predict', start, time.time(), 'eval')
+        logger.display(profiler.report())
+        profile_name = preds_name + str(subj) + '.json'
+        extra = dict(loaders=dict(train=tain.stats, test=test.stats)) if args.prefetch > 0 else {}
+        if cache is not None:
+            extra['cache'] = cache.stats
+        profiler.save_summary(os.path.join(out_dir, 'profile.' + profile_name), **extra)
+        profiler.save_trace(os.path.join(out_dir, 'trace.' + profile_name))
+    preds_file = preds_name + str(subj) + '.npy'
+    np.save(os.path.join(out_dir, preds_file), preds)
+    if validate_mode:
+        with open(os.path.join(out_dir, preds_name + str(subj) + '.json'), 'w') as fd:
+            json.dump(dict(hparams=hparams, history=evaluator.history, best_auc=evaluator.best_auc,
+                           best_epoch=evaluator.best_epoch), fd, indent=2, sort_keys=True)
+    if not validate_mode:
+        model_file = os.path.join(out_dir, model_filename(subj))
+        model.save_params(model_file)
+        # server.py and stream.py compute the spectrograms with NumPy.
+        from loader import BaseLoader
+        save_features(model_file, 'numpy' if isinstance(tain, BaseLoader) else 'neon',
+                      Specgram(**audio_params(args.sampling_freq)).params)
+    return preds
+
+
+if __name__ == '__main__':
+    parser = NeonArgparser(__doc__)
+    add_arguments(parser)
+    args = parser.parse_args(gen_be=False)
+    if args.workers > 1 and args.rank is None:
+        from parallel import launch
+        sys.exit(launch(sys.argv, args.workers))
+    backend_args = extract_valid_args(args, gen_backend)
+    transport = None
+    if args.workers > 1:
+        assert args.coordinator is not None, '-rank requires -coordinator'
+        assert args.batch_size % args.workers == 0, 'The batch size must be a multiple of -workers'
+        backend_args['batch_size'] = args.batch_size // args.workers
+        transport = Transport(args.rank, args.workers, args.coordinator)
+    gen_backend(**backend_args)
+    data_dir = os.path.normpath(args.data_dir)
+    subj = int(data_dir[-1])
+    logger.warn('Overriding --epochs option')
+    tain, test = make_loaders(args, data_dir, subj, args.validate_mode)
+    run(args, data_dir, subj, args.validate_mode, tain, test, args.out_dir, transport)
@@ -0,0 +1,85 @@
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+The per-subject network, number of epochs and learning rate used by
+model.py and driver.py, and builders for other values of these
+hyperparameters (see sweep.py).
+"""
+from neon.initializers import Gaussian, GlorotUniform
+from neon.layers import Conv, Pooling, Affine
+from neon.layers import DeepBiRNN, RecurrentMean, Dropout
+from neon.transforms import Rectlin, Softmax
+
+
+def num_epochs(subj):
+    """
+    Return the maximum number of epochs for a subject; validation runs may
+    stop earlier (see -patience in model.py).
+    """
+    return {1: 8, 2: 3, 3: 6}[subj]
+
+
+def learning_rate(all_elecs):
+    """
+    Return the learning rate for models trained on all the electrodes or,
+    if all_elecs is False, on a single one.
+    """
+    rate = 0.00001
+    return rate if all_elecs else rate / 10
+
+
+def defaults(subj, all_elecs=True):
+    """
+    Return the hyperparameters of a subject's model: the learning rate, the
+    maximum number of epochs, the depth of the recurrent layers and the keep
+    probabilities of the dropout layers that follow the first three
+    convolutions (none if empty).
+    """
+    return dict(rate=learning_rate(all_elecs), epochs=num_epochs(subj),
+                depth=3 if subj == 1 else 5,
+                dropout=[] if subj == 1 else [0.8, 0.4, 0.2])
+
+
+def build_layers(subj):
+    """
+    Return a new list of layers for a subject.
+    """
+    params = defaults(subj)
+    return make_layers(params['depth'], params['dropout'])
+
+
+def make_layers(depth, dropout):
+    """
+    Return a new list of layers with the given hyperparameters (see defaults()).
+    """
+    assert len(dropout) in (0, 3), 'Expected 3 keep probabilities, got %s' % dropout
+    gauss = Gaussian(scale=0.01)
+    glorot = GlorotUniform()
+    tiny = dict(str_h=1, str_w=1)
+    small = dict(str_h=1, str_w=2)
+    big = dict(str_h=1, str_w=4)
+    common = dict(batch_norm=True, activation=Rectlin())
+    drops = [[Dropout(keep)] for keep in dropout] or [[], [], []]
+    return ([Conv((3, 5, 64), init=gauss, strides=big, **common),
+             Pooling(2, strides=2)] + drops[0] +
+            [Conv((3, 3, 128), init=gauss, strides=small, **common),
+             Pooling(2, strides=2)] + drops[1] +
+            [Conv((3, 3, 256), init=gauss, strides=small, **common)] + drops[2] +
+            [Conv((2, 2, 512), init=gauss, strides=tiny, **common),
+             Conv((2, 2, 128), init=gauss, strides=tiny, **common),
+             DeepBiRNN(64, init=glorot, reset_cells=True, depth=depth, **common),
+             RecurrentMean(),
+             Affine(nout=2, init=gauss, activation=Softmax())])
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Run the models saved by model.py with NumPy alone.
+
+export() walks the layers of a neon model and saves their parameters, and
+what is needed to apply them, to a .npz file. NumpyModel reads that file
+and computes the same outputs as the neon model in inference mode, without
+neon or a device. The weights can be stored as float16 or as int8 with a
+scale per output channel; they are expanded to float32 when loaded. The
+export command compares the outputs of the export with those of neon (see
+check()) and removes it if they differ by more than -tol.
+
+Usage:
+    ./npmodel.py export preds/model.1.prm preds/model.1.npz -dtype float16
+    ./npmodel.py check preds/model.1.prm preds/model.1.npz
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+
+nchans = 16
+dtypes = ['float32', 'float16', 'int8']
+# Default largest difference in probability allowed for each dtype
+tolerances = dict(float32=1e-3, float16=1e-2, int8=5e-2)
+
+
+def model_filename(subj):
+    return 'model.' + str(subj) + '.npz'
+
+
+def quantize(arr, dtype, axis):
+    """
+    Return arr stored as dtype and the scales that restore it, per slice
+    along axis for int8.
+    """
+    if dtype == 'float32':
+        return arr.astype(np.float32), None
+    if dtype == 'float16':
+        return arr.astype(np.float16), None
+    axes = tuple(i for i in range(arr.ndim) if i != axis % arr.ndim)
+    scale = np.abs(arr).max(axis=axes, keepdims=True) / 127.0
+    scale[scale == 0] = 1
+    return np.round(arr / scale).astype(np.int8), scale.astype(np.float32)
+
+
+def get(tensor):
+    return None if tensor is None else tensor.get().astype(np.float32)
+
+
+def transform_spec(transform):
+    name = type(transform).__name__
+    assert name in ('Rectlin', 'Softmax', 'Identity'), 'Unsupported activation %s' % name
+    return dict(name=name, slope=float(getattr(transform, 'slope', 0)))
+
+
+def layer_spec(layer):
+    """
+    Return the description of a neon layer and its parameters, as a dict and
+    a dict of arrays along with the axis of the output channels of each.
+    """
+    kind = type(layer).__name__
+    if kind == 'Convolution':
+        params = layer.convparams
+        C = layer.in_shape[0]
+        R, S, K = params['R'], params['S'], params['K']
+        weights = get(layer.W).reshape(C, R, S, K)
+        spec = dict(type='conv', strides=[params.get('str_h', 1), params.get('str_w', 1)],
+                    padding=[params.get('pad_h', 0), params.get('pad_w', 0)])
+        return spec, dict(W=(weights, -1))
+    if kind == 'Pooling':
+        params = layer.poolparams
+        assert layer.op == 'max', 'Unsupported pooling %s' % layer.op
+        spec = dict(type='pool', shape=[params['R'], params['S']],
+                    strides=[params.get('str_h', 1), params.get('str_w', 1)],
+                    padding=[params.get('pad_h', 0), params.get('pad_w', 0)])
+        return spec, {}
+    if kind == 'BatchNorm':
+        arrays = dict((name, (get(getattr(layer, name)).ravel(), 0))
+                      for name in ['gamma', 'beta', 'gmean', 'gvar'])
+        return dict(type='bn', eps=float(layer.eps)), arrays
+    if kind == 'Activation':
+        return dict(type='act', transform=transform_spec(layer.transform)), {}
+    if kind == 'Dropout':
+        return dict(type='dropout', keep=float(layer.keep)), {}
+    if kind in ('BiRNN', 'BiBNRNN'):
+        spec = dict(type='birnn', nin=int(layer.nin), nsteps=int(layer.nsteps),
+                    split_inputs=bool(getattr(layer, 'split_inputs', False)),
+                    transform=transform_spec(layer.activation))
+        arrays = {}
+        for name in ['W_input_f', 'W_input_b', 'W_recur_f', 'W_recur_b', 'b_f', 'b_b']:
+            value = get(getattr(layer, name, None))
+            if value is not None:
+                arrays[name] = (value if name.startswith('W') else value.ravel(), 0)
+        if kind == 'BiBNRNN':
+            spec['eps'] = float(layer.eps)
+            for name in ['gamma', 'beta', 'gmean', 'gvar']:
+                arrays[name] = (get(getattr(layer, name)).ravel(), 0)
+        return spec, arrays
+    if kind == 'RecurrentMean':
+        return dict(type='mean', nin=int(layer.nin), nsteps=int(layer.nsteps)), {}
+    if kind == 'Linear':
+        return dict(type='linear'), dict(W=(get(layer.W), 0))
+    if kind == 'Bias':
+        return dict(type='bias'), dict(b=(get(layer.W).ravel(), 0))
+    raise ValueError('Unsupported layer %s' % kind)
+
+
+def export(model, filename, dtype='float32', features=None):
+    """
+    Save the layers of an initialized neon model to filename. The weights
+    of convolutional, linear and recurrent layers are stored as dtype; the
+    other parameters are kept as float32. features is the record of how the
+    inputs of the model were computed (see spectrogram.load_features()).
+    """
+    assert dtype in dtypes
+    specs = []
+    arrays = {}
+    for i, layer in enumerate(model.layers.layers):
+        spec, params = layer_spec(layer)
+        specs.append(spec)
+        for name, (value, axis) in params.items():
+            key = '%d.%s' % (i, name)
+            if name.startswith('W'):
+                arrays[key], scale = quantize(value, dtype, axis)
+                if scale is not None:
+                    arrays[key + '.scale'] = scale
+            else:
+                arrays[key] = value
+    if features is not None:
+        arrays['features'] = np.array(json.dumps(features))
+    np.savez(filename, spec=np.array(json.dumps(specs)), **arrays)
+
+
+def activate(x, transform):
+    name = transform['name']
+    if name == 'Rectlin':
+        return np.where(x > 0, x, x * transform['slope']) if transform['slope'] else \
+            np.maximum(x, 0, out=x)
+    if name == 'Softmax':
+        x = np.exp(x - x.max(axis=-1, keepdims=True))
+        return x / x.sum(axis=-1, keepdims=True)
+    return x
+
+
+def normalize(x, params, eps):
+    scale = params['gamma'] / np.sqrt(params['gvar'] + eps)
+    return x * scale + (params['beta'] - params['gmean'] * scale)
+
+
+def pad(x, padding, value=0):
+    if padding == [0, 0]:
+        return x
+    ph, pw = padding
+    return np.pad(x, ((0, 0), (ph, ph), (pw, pw), (0, 0)), 'constant', constant_values=value)
+
+
+def conv(x, weights, strides, padding):
+    """
+    Correlate x, of shape (N, H, W, C), with weights of shape (C, R, S, K).
+    """
+    x = pad(x, padding)
+    C, R, S, K = weights.shape
+    sh, sw = strides
+    P = (x.shape[1] - R) // sh + 1
+    Q = (x.shape[2] - S) // sw + 1
+    out = np.zeros((x.shape[0], P, Q, K), dtype=np.float32)
+    for r in range(R):
+        for s in range(S):
+            patch = x[:, r:r + (P - 1) * sh + 1:sh, s:s + (Q - 1) * sw + 1:sw]
+            out += np.dot(patch, weights[:, r, s])
+    return out
+
+
+def pool(x, shape, strides, padding):
+    x = pad(x, padding, -np.inf)
+    R, S = shape
+    sh, sw = strides
+    P = (x.shape[1] - R) // sh + 1
+    Q = (x.shape[2] - S) // sw + 1
+    out = None
+    for r in range(R):
+        for s in range(S):
+            patch = x[:, r:r + (P - 1) * sh + 1:sh, s:s + (Q - 1) * sw + 1:sw]
+            out = patch.copy() if out is None else np.maximum(out, patch, out=out)
+    return out
+
+
+def to_steps(x, nin, nsteps):
+    """
+    Return the (steps, N, features) view that neon's recurrent layers take of
+    the output of the previous layer.
+    """
+    if x.ndim == 3:
+        return x
+    if x.ndim == 4:
+        # neon lays out the outputs of spatial layers as (C, H, W) per sample.
+        x = x.transpose(0, 3, 1, 2)
+    return x.reshape(x.shape[0], nin, nsteps).transpose(2, 0, 1)
+
+
+def recur(pre, weights, transform, reverse):
+    out = np.empty_like(pre)
+    h = np.zeros(pre.shape[1:], dtype=np.float32)
+    steps = range(len(pre) - 1, -1, -1) if reverse else range(len(pre))
+    for t in steps:
+        h = activate(pre[t] + np.dot(h, weights.T), transform)
+        out[t] = h
+    return out
+
+
+def birnn(x, spec, params):
+    x = to_steps(x, spec['nin'], spec['nsteps'])
+    if spec['split_inputs']:
+        half = x.shape[-1] // 2
+        x_f, x_b = x[..., :half], x[..., half:]
+    else:
+        x_f = x_b = x
+    pre_f = np.dot(x_f, params['W_input_f'].T)
+    pre_b = np.dot(x_b, params['W_input_b'].T)
+    if 'gamma' in params:
+        nout = pre_f.shape[-1]
+        if len(params['gamma']) == 2 * nout:
+            pre = normalize(np.concatenate([pre_f, pre_b], axis=-1), params, spec['eps'])
+            pre_f, pre_b = pre[..., :nout], pre[..., nout:]
+        else:
+            pre_f = normalize(pre_f, params, spec['eps'])
+            pre_b = normalize(pre_b, params, spec['eps'])
+    if 'b_f' in params:
+        pre_f = pre_f + params['b_f']
+        pre_b = pre_b + params['b_b']
+    out_f = recur(pre_f, params['W_recur_f'], spec['transform'], False)
+    out_b = recur(pre_b, params['W_recur_b'], spec['transform'], True)
+    return np.concatenate([out_f, out_b], axis=-1)
+
+
+class NumpyModel(object):
+    """
+    A model exported by export(). The input is a batch of samples of shape
+    (N, electrodes, height, width) and the output has the shape (N, 2).
+    """
+    def __init__(self, filename):
+        saved = np.load(filename)
+        self.specs = json.loads(str(saved['spec']))
+        self.params = [{} for spec in self.specs]
+        for key in saved.files:
+            if key in ('spec', 'features') or key.endswith('.scale'):
+                continue
+            idx, name = key.split('.', 1)
+            value = saved[key].astype(np.float32)
+            if key + '.scale' in saved.files:
+                value *= saved[key + '.scale']
+            self.params[int(idx)][name] = value
+        # Convolution weights are applied as (C, R, S, K) slices.
+        for spec, params in zip(self.specs, self.params):
+            if spec['type'] == 'conv':
+                params['W'] = np.ascontiguousarray(params['W'])
+
+    def fprop(self, x):
+        x = np.ascontiguousarray(x.transpose(0, 2, 3, 1), dtype=np.float32)
+        for spec, params in zip(self.specs, self.params):
+            kind = spec['type']
+            if kind == 'conv':
+                x = conv(x, params['W'], spec['strides'], spec['padding'])
+            elif kind == 'pool':
+                x = pool(x, spec['shape'], spec['strides'], spec['padding'])
+            elif kind == 'bn':
+                x = normalize(x, params, spec['eps'])
+            elif kind == 'act':
+                x = activate(x, spec['transform'])
+            elif kind == 'dropout':
+                # neon scales by the keep probability at inference time.
+                x = x * spec['keep']
+            elif kind == 'birnn':
+                x = birnn(x, spec, params)
+            elif kind == 'mean':
+                x = to_steps(x, spec['nin'], spec['nsteps']).mean(axis=0)
+            elif kind == 'linear':
+                x = np.dot(x.reshape(x.shape[0], -1), params['W'].T)
+            elif kind == 'bias':
+                x = x + params['b']
+        return x
+
+
+class Predictor(object):
+    """
+    Same as infer.Predictor, for models exported by export().
+    """
+    def __init__(self, model_file, shape=None, subj=None, ref_preds=None, batch_size=16):
+        self.model = NumpyModel(model_file)
+        self.batch_size = batch_size
+        self.subj = subj
+        if ref_preds is None:
+            self.params = None
+        else:
+            from util import avg_preds, calibration
+            self.params = calibration(subj, avg_preds(ref_preds))
+
+    def predict(self, samples):
+        """
+        Return the outputs for samples of shape (count, electrodes, height, width).
+        """
+        preds = np.empty(len(samples), dtype=np.float32)
+        for start in range(0, len(samples), self.batch_size):
+            batch = samples[start:start + self.batch_size]
+            preds[start:start + len(batch)] = self.model.fprop(batch)[:, 1]
+        return preds
+
+    def calibrate(self, preds):
+        from util import calibrate
+        assert self.params is not None, 'Reference predictions are needed for calibration'
+        preds = np.array(preds, dtype=np.float32)
+        calibrate(self.subj, preds, self.params)
+        return preds
+
+
+def load_neon(model_file, batch_size, backend):
+    from neon.backends import gen_backend
+    from neon.models import Model
+    from spectrogram import Specgram, audio_params
+    gen_backend(backend=backend, batch_size=batch_size)
+    specgram = Specgram(**audio_params())
+    shape = (nchans, specgram.height, specgram.width)
+    model = Model(model_file)
+    model.initialize(shape)
+    return model, shape
+
+
+def check(prm_file, npz_file, nsamples, batch_size, backend):
+    """
+    Compare the outputs of the neon model and of its export on random
+    spectrograms. Returns the largest absolute difference.
+    """
+    from infer import Predictor as NeonPredictor
+    model, shape = load_neon(prm_file, batch_size, backend)
+    del model
+    rng = np.random.RandomState(0)
+    samples = rng.randint(0, 256, size=(nsamples,) + shape).astype(np.float32)
+    start = time.time()
+    ref = NeonPredictor(prm_file, shape).predict(samples)
+    print('neon: %.2fs' % (time.time() - start))
+    start = time.time()
+    predictor = Predictor(npz_file, batch_size=batch_size)
+    print('Loaded %s in %.3fs' % (npz_file, time.time() - start))
+    start = time.time()
+    preds = predictor.predict(samples)
+    print('NumPy: %.2fs' % (time.time() - start))
+    diff = np.abs(preds - ref).max()
+    print('Largest difference %.2e' % diff)
+    return diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['export', 'check'])
+    parser.add_argument('prm_file', help='model saved by model.py')
+    parser.add_argument('npz_file', help='exported model')
+    parser.add_argument('-dtype', '--dtype', choices=dtypes, default='float32',
+                        help='storage type of the weights')
+    parser.add_argument('-n', '--nsamples', type=int, default=32,
+                        help='number of random samples to compare')
+    parser.add_argument('-z', '--batch_size', type=int, default=16)
+    parser.add_argument('-tol', '--tolerance', type=float,
+                        help='largest difference allowed between neon and the export '
+                        '(default: %s)' % ', '.join('%s for %s' % (tolerances[dtype], dtype)
+                                                    for dtype in dtypes))
+    parser.add_argument('-b', '--backend', default='cpu', help='neon backend')
+    args = parser.parse_args()
+    if args.tolerance is None:
+        args.tolerance = tolerances[args.dtype]
+    if args.command == 'export':
+        from spectrogram import load_features
+        model, shape = load_neon(args.prm_file, args.batch_size, args.backend)
+        export(model, args.npz_file, args.dtype, load_features(args.prm_file))
+        print('Wrote %s (%.1f MB)' % (args.npz_file, os.path.getsize(args.npz_file) / 2.0**20))
+        del model
+    diff = check(args.prm_file, args.npz_file, args.nsamples, args.batch_size, args.backend)
+    if diff > args.tolerance:
+        print('The difference exceeds %.2e' % args.tolerance)
+        if args.command == 'export':
+            os.remove(args.npz_file)
+            print('Removed %s' % args.npz_file)
+        sys.exit(1)
@@ -0,0 +1,125 @@
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Train a model in several worker processes (see model.py -workers).
+
+Every worker runs the model on its share of each batch of the training set
+(see BaseLoader) and the gradients are averaged over the workers through a
+transport.Transport before each Adagrad step. The workers start from the
+epoch, parameters and optimizer states of worker 0 and then apply the same
+updates, so they keep the same model. Worker 0 also resumes from and saves
+the checkpoints, evaluates and writes the outputs. The statistics of the batch norm layers are those of the share of
+each worker.
+"""
+import os
+import sys
+import time
+import subprocess
+import multiprocessing
+import numpy as np
+from neon.callbacks.callbacks import Callback
+from neon.optimizers import Adagrad
+from neon.optimizers.optimizer import get_param_list
+from transport import free_address
+
+
+def exchange(transport, tensors, broadcast=False):
+    """
+    Replace the contents of tensors with their mean over the workers or,
+    if broadcast is set, with those of worker 0.
+    """
+    host = np.concatenate([tensor.get().ravel() for tensor in tensors]).astype(np.float32)
+    if broadcast:
+        transport.broadcast(host)
+    else:
+        transport.allreduce(host)
+    pos = 0
+    for tensor in tensors:
+        size = int(np.prod(tensor.shape))
+        tensor.set(host[pos:pos + size].reshape(tensor.shape))
+        pos += size
+
+
+class ParallelAdagrad(Adagrad):
+    """
+    Adagrad with the gradients averaged over the workers of transport.
+    """
+    def __init__(self, transport, **kwargs):
+        super(ParallelAdagrad, self).__init__(**kwargs)
+        self.transport = transport
+
+    def optimize(self, layer_list, epoch):
+        grads = [grad for (param, grad), states in get_param_list(layer_list)]
+        exchange(self.transport, grads)
+        super(ParallelAdagrad, self).optimize(layer_list, epoch)
+
+
+class Sync(Callback):
+    """
+    Start the workers from the epoch, parameters and optimizer states of
+    worker 0, which is the only one that resumes from a checkpoint, and
+    have them stop after the same epoch. The epoch is also passed on to
+    dataset, so that all the workers shuffle it alike. Add it after the
+    callbacks that may stop training.
+    """
+    def __init__(self, transport, dataset):
+        super(Sync, self).__init__()
+        self.transport = transport
+        self.dataset = dataset
+
+    def on_train_begin(self, callback_data, model, epochs):
+        epoch = self.transport.broadcast(np.array([model.epoch_index], dtype=np.float32))
+        model.epoch_index = int(epoch[0])
+        self.dataset.epoch = model.epoch_index
+        params = get_param_list(model.layers_to_optimize)
+        # Optimizer states are allocated on the first update, unless resumed.
+        nstates = np.array([len(states) for (param, grad), states in params], dtype=np.float32)
+        self.transport.broadcast(nstates)
+        tensors = []
+        for ((param, grad), states), count in zip(params, nstates):
+            while len(states) < count:
+                states.append(self.be.zeros_like(param))
+            tensors += [param] + list(states)
+        exchange(self.transport, tensors, broadcast=True)
+
+    def on_epoch_end(self, callback_data, model, epoch):
+        finished = np.array([model.finished], dtype=np.float32)
+        self.transport.broadcast(finished)
+        model.finished = bool(finished[0])
+
+
+def launch(argv, nworkers):
+    """
+    Run the command line argv once per worker on this machine, with -rank
+    and -coordinator added, and return 0 if all the workers succeed. The
+    threads given by OMP_NUM_THREADS (or the cores) are split between them.
+    If a worker fails, the others are stopped.
+    """
+    env = dict(os.environ)
+    threads = int(env.get('OMP_NUM_THREADS', multiprocessing.cpu_count()))
+    env['OMP_NUM_THREADS'] = env['MKL_NUM_THREADS'] = str(max(1, threads // nworkers))
+    address = free_address()
+    procs = [subprocess.Popen([sys.executable] + argv + ['-rank', str(rank),
+                                                          '-coordinator', address], env=env)
+             for rank in range(nworkers)]
+    while any(proc.poll() is None for proc in procs):
+        if any(proc.returncode not in (None, 0) for proc in procs):
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.terminate()
+        time.sleep(0.5)
+    codes = [proc.returncode for proc in procs]
+    return next((code for code in codes if code != 0), 0)
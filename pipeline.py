@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Run the whole pipeline as a graph of jobs:
+
+    prep -> index N -> validate N, full N -> subm
+
+Jobs whose dependencies are done are started as long as their cores and
+memory fit within the budgets given on the command line, so the subjects
+and the validate and full runs of a subject train concurrently. A job is
+skipped if its outputs are newer than its inputs and its command line is
+unchanged. A failed job only stops the jobs that depend on it, and training
+jobs resume from their checkpoints when the pipeline is run again (see
+checkpoint.py). The output of each job goes to <output>/logs/<job>.log and
+the wall time of each job is saved in <output>/pipeline.json. With
+-single, the validate, full and subm jobs are replaced by one job that runs
+driver.py.
+
+Usage:
+    ./pipeline.py /path/to/data /path/to/output -cores 16 -mem 32
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+import multiprocessing
+import traceback
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+class Job(object):
+    """
+    A unit of work: either a command line or a Python callable. The job is
+    up to date if all its outputs exist and are newer than its inputs and,
+    for a command line, if it is the same as that of the last successful run
+    (recorded in <log_dir>/<name>.cmd). Jobs without outputs always run.
+    """
+    def __init__(self, name, action, deps=(), cores=1, mem=0, inputs=(), outputs=()):
+        self.name = name
+        self.action = action
+        self.deps = list(deps)
+        self.cores = cores
+        self.mem = mem
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.status = 'pending'
+        self.seconds = 0.0
+
+    def up_to_date(self, log_dir):
+        if len(self.outputs) == 0:
+            return False
+        if not all(os.path.exists(out) for out in self.outputs):
+            return False
+        if not callable(self.action):
+            cmd_file = os.path.join(log_dir, self.name + '.cmd')
+            if not os.path.exists(cmd_file):
+                return False
+            with open(cmd_file) as fd:
+                if json.load(fd) != self.action:
+                    return False
+        oldest = min(os.path.getmtime(out) for out in self.outputs)
+        return all(os.path.getmtime(inp) <= oldest for inp in self.inputs if os.path.exists(inp))
+
+    def run(self, log_dir):
+        env = dict(os.environ)
+        env['OMP_NUM_THREADS'] = env['MKL_NUM_THREADS'] = str(self.cores)
+        with open(os.path.join(log_dir, self.name + '.log'), 'w') as log:
+            if callable(self.action):
+                try:
+                    self.action()
+                    return 0
+                except Exception:
+                    log.write(traceback.format_exc())
+                    return 1
+            log.write(' '.join(self.action) + '\n')
+            log.flush()
+            code = subprocess.call(self.action, stdout=log, stderr=subprocess.STDOUT, env=env)
+        if code == 0:
+            with open(os.path.join(log_dir, self.name + '.cmd'), 'w') as fd:
+                json.dump(self.action, fd)
+        return code
+
+
+class Scheduler(object):
+    def __init__(self, jobs, cores, mem, log_dir):
+        self.jobs = jobs
+        self.cores = cores
+        self.mem = mem
+        self.log_dir = log_dir
+        self.lock = threading.Condition()
+
+    def fits(self, job, used_cores, used_mem):
+        # A job that exceeds a budget on its own runs by itself.
+        cores = min(job.cores, self.cores)
+        mem = min(job.mem, self.mem)
+        return used_cores + cores <= self.cores and used_mem + mem <= self.mem
+
+    def execute(self, job):
+        start = time.time()
+        code = job.run(self.log_dir)
+        with self.lock:
+            job.seconds = time.time() - start
+            job.status = 'done' if code == 0 else 'failed'
+            print('%s %s in %.1fs' % (job.name, job.status, job.seconds))
+            self.lock.notify()
+
+    def run(self):
+        jobs = dict((job.name, job) for job in self.jobs)
+        running = []
+        with self.lock:
+            while True:
+                for job in self.jobs:
+                    if job.status != 'pending':
+                        continue
+                    states = [jobs[dep].status for dep in job.deps]
+                    if any(state in ('failed', 'skipped') for state in states):
+                        job.status = 'skipped'
+                        print('%s skipped because a dependency failed' % job.name)
+                        continue
+                    if not all(state in ('done', 'up-to-date') for state in states):
+                        continue
+                    if job.up_to_date(self.log_dir):
+                        job.status = 'up-to-date'
+                        print('%s is up to date' % job.name)
+                        continue
+                    used_cores = sum(min(j.cores, self.cores) for j in running)
+                    used_mem = sum(min(j.mem, self.mem) for j in running)
+                    if not self.fits(job, used_cores, used_mem):
+                        continue
+                    job.status = 'running'
+                    running.append(job)
+                    print('Starting %s on %d cores' % (job.name, min(job.cores, self.cores)))
+                    thread = threading.Thread(target=self.execute, args=(job,))
+                    thread.daemon = True
+                    thread.start()
+                running = [job for job in running if job.status == 'running']
+                if all(job.status not in ('pending', 'running') for job in self.jobs):
+                    break
+                # Some job changed state or a pending job may now fit.
+                self.lock.wait(1.0)
+        return all(job.status in ('done', 'up-to-date') for job in self.jobs)
+
+    def save(self, filename):
+        record = dict((job.name, dict(status=job.status, seconds=round(job.seconds, 1),
+                                      cores=job.cores, mem=job.mem))
+                      for job in self.jobs)
+        with open(filename, 'w') as fd:
+            json.dump(record, fd, indent=2, sort_keys=True)
+
+
+def build(args):
+    """
+    Return the jobs needed to go from the .mat files to subm.csv.
+    """
+    data_dir = os.path.abspath(args.data_dir)
+    out_dir = os.path.abspath(args.out_dir)
+    use_store = args.format != 'wav'
+    # The loaders read the index files of the first electrode, except for the
+    # neon MultiLoader (-neon_specgram), which reads those of all of them.
+    elec = 0 if args.elec == -1 else args.elec
+    if args.elec == -1 and '-neon_specgram' in args.model_args:
+        index_elecs = list(range(16))
+    else:
+        index_elecs = [elec]
+    jobs = []
+    all_indexes = []
+
+    prep_cmd = [os.path.join(here, 'prep.py'), data_dir, '-j', str(args.cores),
+                '-f', 'store' if use_store else 'wav', '-r', str(args.sampling_freq)]
+    jobs.append(Job('prep', prep_cmd, cores=args.cores, mem=args.prep_mem))
+    prep_dep = 'prep'
+    if args.format == 'cache':
+        jobs.append(Job('speccache', [os.path.join(here, 'speccache.py'), data_dir,
+                                      '-j', str(args.cores), '-r', str(args.sampling_freq)],
+                        deps=['prep'], cores=args.cores, mem=args.prep_mem))
+        prep_dep = 'speccache'
+
+    model_cmd = [os.path.join(here, 'model.py'), '-r', '0', '-z', str(args.batch_size),
+                 '-v', '--no_progress_bar', '-elec', str(args.elec), '-out', out_dir,
+                 '-fs', str(args.sampling_freq)]
+    if args.backend is not None:
+        model_cmd += ['-b', args.backend]
+    if args.format == 'store':
+        model_cmd.append('-store')
+    elif args.format == 'cache':
+        model_cmd.append('-cache')
+    model_cmd += args.model_args
+
+    for subj in args.subjects:
+        train_dir = os.path.join(data_dir, 'train_%d' % subj)
+        test_dir = os.path.join(data_dir, 'test_%d_new' % subj)
+
+        def make_indexes(train_dir=train_dir, subj=subj):
+            from indexer import make_indexes
+            make_indexes(train_dir, subj, index_elecs, use_store)
+
+        def index(dirname, set_name, suffix='', subj=subj):
+            return os.path.join(dirname, '%s-%d-%d%s-index.csv' % (set_name, subj, elec, suffix))
+        # prep.py deletes the index files of subjects whose data changed.
+        indexes = [index(train_dir, set_name) for set_name in ['tain', 'eval', 'full']]
+        indexes.append(index(test_dir, 'test'))
+        # Read by the loaders other than SingleLoader
+        indexes += [index(train_dir, set_name, '-weighted') for set_name in ['tain', 'full']]
+        jobs.append(Job('index-%d' % subj, make_indexes, deps=[prep_dep], outputs=indexes))
+        all_indexes += indexes
+        if args.single:
+            continue
+        code = [os.path.join(here, 'model.py'), os.path.join(here, 'loader.py')]
+        jobs.append(Job('validate-%d' % subj,
+                        model_cmd + ['-w', train_dir, '-eval', '1', '-validate'],
+                        deps=['index-%d' % subj], cores=args.job_cores, mem=args.job_mem,
+                        inputs=code + [index(train_dir, 'tain'), index(train_dir, 'eval'),
+                                       index(train_dir, 'tain', '-weighted')],
+                        outputs=[os.path.join(out_dir, 'eval.%d.npy' % subj)]))
+        jobs.append(Job('full-%d' % subj, model_cmd + ['-w', train_dir],
+                        deps=['index-%d' % subj], cores=args.job_cores, mem=args.job_mem,
+                        inputs=code + [index(train_dir, 'full'), index(test_dir, 'test'),
+                                       index(train_dir, 'full', '-weighted')],
+                        outputs=[os.path.join(out_dir, 'test.%d.npy' % subj)]))
+
+    preds = [os.path.join(out_dir, 'eval.%d.npy' % subj) for subj in args.subjects]
+    preds += [os.path.join(out_dir, 'test.%d.npy' % subj) for subj in args.subjects]
+    if args.single:
+        # driver.py trains all the models and writes subm.csv in one process.
+        driver_cmd = [os.path.join(here, 'driver.py')] + model_cmd[1:]
+        driver_cmd += ['-w', data_dir, '-eval', '1', '-subj'] + [str(subj) for subj in args.subjects]
+        code = [os.path.join(here, name) for name in ['driver.py', 'model.py', 'loader.py']]
+        jobs.append(Job('train', driver_cmd, deps=['index-%d' % subj for subj in args.subjects],
+                        cores=args.job_cores, mem=args.job_mem, inputs=code + all_indexes,
+                        outputs=preds + ['subm.csv']))
+        return jobs
+    subm_deps = ['validate-%d' % subj for subj in args.subjects]
+    subm_deps += ['full-%d' % subj for subj in args.subjects]
+    code = [os.path.join(here, name) for name in ['subm.py', 'util.py']]
+    jobs.append(Job('subm', [os.path.join(here, 'subm.py'), data_dir, out_dir],
+                    deps=subm_deps, inputs=code + preds, outputs=['subm.csv']))
+    return jobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_dir', help='directory containing train_N and test_N subdirectories')
+    parser.add_argument('out_dir', help='directory for the predictions and logs')
+    parser.add_argument('-cores', '--cores', type=int, default=multiprocessing.cpu_count(),
+                        help='number of cores to use in total')
+    parser.add_argument('-mem', '--mem', type=float, default=16, help='GB of memory to use in total')
+    parser.add_argument('-job_cores', '--job_cores', type=int, default=4,
+                        help='cores used by each training job')
+    parser.add_argument('-job_mem', '--job_mem', type=float, default=8,
+                        help='GB of memory used by each training job')
+    parser.add_argument('-prep_mem', '--prep_mem', type=float, default=4,
+                        help='GB of memory used by preprocessing')
+    parser.add_argument('-format', '--format', choices=['wav', 'store', 'cache'], default='wav',
+                        help='data format (see run.sh)')
+    parser.add_argument('-fs', '--sampling_freq', type=int, default=400,
+                        help='sampling rate in Hz to train at')
+    parser.add_argument('-subj', '--subjects', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('-elec', '--elec', type=int, default=-1, help='electrode index or -1')
+    parser.add_argument('-z', '--batch_size', type=int, default=64)
+    parser.add_argument('-b', '--backend', help='neon backend')
+    parser.add_argument('-single', '--single', action='store_true',
+                        help='train all the models in one process with driver.py')
+    parser.add_argument('model_args', nargs=argparse.REMAINDER,
+                        help='extra arguments for model.py, after --')
+    args = parser.parse_args()
+    if args.model_args[:1] == ['--']:
+        args.model_args = args.model_args[1:]
+
+    log_dir = os.path.join(args.out_dir, 'logs')
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    sys.path.insert(0, here)
+    scheduler = Scheduler(build(args), args.cores, args.mem, log_dir)
+    start = time.time()
+    success = scheduler.run()
+    scheduler.save(os.path.join(args.out_dir, 'pipeline.json'))
+    print('Total %.1fs' % (time.time() - start))
+    for job in scheduler.jobs:
+        print('%-12s %-10s %8.1fs' % (job.name, job.status, job.seconds))
+    for job in scheduler.jobs:
+        if job.status == 'failed':
+            print('See %s for the failure of %s' % (os.path.join(log_dir, job.name + '.log'),
+                                                    job.name))
+    sys.exit(0 if success else 1)
@@ -15,75 +15,398 @@
 #   limitations under the License.
 #
 """
-Extract the data out of .mat files and save as .wav files.
+Extract the data out of .mat files and save as .wav files or as a
+memory-mapped sample store (see store.py).
+
+Files are converted in parallel and a manifest is kept in every data
+directory so that later runs only convert new or modified .mat files.
+With -f store, several sampling rates can be produced from one read of
+each .mat file. The lower rates are obtained by polyphase resampling and
+kept in separate stores next to each other (see store_name()).
+
+Windows are views into the recording of a segment, given by their offset
+and length (see window()). Each recording is stored once, whatever the
+number of windows.
 """
 
-import sys
 import os
 import glob
+import json
+import argparse
+import multiprocessing
 import numpy as np
 from scipy import io, signal
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd
 from scikits import audiolab
+import store
 
 
-# Downsampling factor
-ds_factor = 1
+# Sampling rate of the .mat files
+native_fs = 400
 # Window duration in minutes
 win_dur = 10
 # Number of windows (assuming a stride of 1 minute)
 nwin = 10 - win_dur + 1
+# Spectrogram frame duration in milliseconds and overlap in percent (see spectrogram.py)
+frame_dur = 512
+frame_overlap = 10
+# Name of the per-directory record of converted files
+manifest_name = 'prep-manifest.json'
+
+
+def settings(fs):
+    result = dict(fs=fs, win_dur=win_dur)
+    if nwin > 1:
+        # Older versions wrote a file per window.
+        result['layout'] = 'segment'
+    return result
+
+
+def store_name(fs):
+    """
+    Return the name of the sample store for the given sampling rate.
+    """
+    if fs == native_fs:
+        return store.default_name
+    return '%s-%d' % (store.default_name, fs)
+
+
+def frame_stride(fs):
+    """
+    Return the number of samples between spectrogram frames.
+    """
+    size = (frame_dur * fs) // 1000
+    return size - (size * frame_overlap) // 100
+
+
+def window(win, fs):
+    """
+    Return the first and last sample of a window of a segment. Windows are
+    about a minute apart. Their offsets are rounded down to a multiple of
+    the frame stride, so that overlapping windows have the same frames.
+    """
+    winsize = win_dur * 60 * fs
+    stride = (60 * fs) // frame_stride(fs) * frame_stride(fs)
+    beg = win * stride
+    return beg, beg + winsize
+
+
+def wavname(srcfile, win, elec):
+    return os.path.splitext(srcfile)[0] + '.' + str(win) + '.' + str(elec) + '.wav'
+
+
+def recname(srcfile, elec):
+    """
+    Return the name of the .wav file that holds the recording of an
+    electrode. It is the file of the first window, which starts at the
+    beginning of the segment; the other windows have no file of their own.
+    """
+    return wavname(srcfile, 0, elec)
 
 
-def extract(path, fs, training):
-    print('Extracting data into %s...' % path)
+def load_manifest(path, fs):
+    filename = os.path.join(path, manifest_name)
+    if os.path.exists(filename):
+        with open(filename) as fd:
+            manifest = json.load(fd)
+        if manifest.get('settings') == settings(fs):
+            return manifest
+        print('Settings changed. Ignoring %s' % filename)
+    return dict(settings=settings(fs), files={})
+
+
+def save_manifest(path, manifest):
+    filename = os.path.join(path, manifest_name)
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'w') as fd:
+        json.dump(manifest, fd, indent=0, sort_keys=True)
+    os.rename(tmpfile, filename)
+
+
+def signature(srcfile):
+    st = os.stat(srcfile)
+    return dict(mtime=st.st_mtime, size=st.st_size)
+
+
+def is_current(srcfile, entry):
+    if entry is None:
+        return False
+    sig = signature(srcfile)
+    if entry['mtime'] != sig['mtime'] or entry['size'] != sig['size']:
+        return False
+    path = os.path.dirname(srcfile)
+    return all(os.path.exists(os.path.join(path, out)) for out in entry['outputs'])
+
+
+def pending(path, manifest):
     files = glob.glob(os.path.join(path, '*.mat'))
     assert len(files) > 0, 'No .mat files found in %s' % path
-    for srcfile in files:
-        wavwrite(srcfile, fs, training)
+    return sorted(f for f in files
+                  if not is_current(f, manifest['files'].get(os.path.basename(f))))
 
 
-def wavwrite(srcfile, fs, training):
+def convert(task):
+    srcfile, fs, training = task
+    sig = signature(srcfile)
+    outputs = wavwrite(srcfile, fs, training)
+    sig['outputs'] = [os.path.basename(out) for out in outputs]
+    return srcfile, sig
+
+
+def run_tasks(func, tasks, nprocs):
+    """
+    Yield the results of func applied to the tasks in completion order.
+    """
+    if nprocs == 1:
+        for task in tasks:
+            yield func(task)
+        return
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        for result in pool.imap_unordered(func, tasks):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def extract_all(paths, fs, nprocs, save_every=100):
+    """
+    Convert the pending files of all the given directories using a pool
+    of nprocs worker processes. paths is a list of (path, training) tuples.
+    Returns the set of paths in which files were converted.
+    """
+    manifests = {}
+    tasks = []
+    for path, training in paths:
+        manifests[path] = load_manifest(path, fs)
+        files = pending(path, manifests[path])
+        print('%d of %d files to be converted in %s' % (
+            len(files), len(glob.glob(os.path.join(path, '*.mat'))), path))
+        tasks.extend((srcfile, fs, training) for srcfile in files)
+
+    changed = set()
+    try:
+        for count, (srcfile, entry) in enumerate(run_tasks(convert, tasks, nprocs)):
+            path = os.path.dirname(srcfile)
+            manifests[path]['files'][os.path.basename(srcfile)] = entry
+            changed.add(path)
+            if (count + 1) % save_every == 0:
+                print('Converted %d of %d files' % (count + 1, len(tasks)))
+                for path in changed:
+                    save_manifest(path, manifests[path])
+    finally:
+        # Whatever got converted is recorded even if a worker failed.
+        for path in changed:
+            save_manifest(path, manifests[path])
+    return changed
+
+
+def storewrite(task):
+    srcfile, rates, training, path, row, nrows = task
+    sig = signature(srcfile)
+    loaded = load_rates(srcfile, rates, training)
+    if loaded is None:
+        return path, row, sig, None
+    scales = []
+    for fs, (dat, scale) in zip(rates, loaded):
+        shape = (nrows, 16, int(10 * 60 * fs))
+        assert dat.shape == shape[:0:-1], 'Unexpected shape %s in %s' % (dat.shape, srcfile)
+        store.write_row(path, shape, row, dat.T, store_name(fs))
+        scales.append(scale)
+    return path, row, sig, scales
+
+
+def store_all(paths, rates, nprocs):
+    """
+    Build the sample store of each of the given directories at each of the
+    given sampling rates. Segments that are already in up to date stores
+    are copied over instead of being converted again. The stores of other
+    rates that do not match the .mat files are deleted, so that all the
+    stores of a directory hold the same segments. Returns the set of paths
+    in which files were converted.
+    """
+    headers = {}
+    tasks = []
+    changed_paths = set()
+    for path, training in paths:
+        files = sorted(glob.glob(os.path.join(path, '*.mat')))
+        assert len(files) > 0, 'No .mat files found in %s' % path
+        names = [os.path.splitext(os.path.basename(f))[0] for f in files]
+        sigs = [signature(f) for f in files]
+        for name in store.available(path):
+            other = store.Store(path, name)
+            if other.fs in rates:
+                continue
+            if len(other.names) != len(names) or not all(
+                    other.is_current(segm, sig['mtime'], sig['size'])
+                    for segm, sig in zip(names, sigs)):
+                print('Removing stale %s' % store.prefix(path, name))
+                store.remove(path, name)
+                changed_paths.add(path)
+        olds = {}
+        for fs in rates:
+            old = store.Store(path, store_name(fs)) if store.exists(path, store_name(fs)) else None
+            olds[fs] = old if old is not None and old.fs == fs else None
+        current = [all(old is not None and old.is_current(name, sig['mtime'], sig['size'])
+                       for old in olds.values())
+                   for name, sig in zip(names, sigs)]
+        print('%d of %d files to be converted in %s' % (current.count(False), len(files), path))
+        if all(current) and all(len(names) == len(old.names) for old in olds.values()):
+            continue
+
+        for fs in rates:
+            shape = (len(files), 16, int(10 * 60 * fs))
+            store.create(path, shape, store_name(fs))
+            header = dict(shape=shape, names=names, valid=[True] * len(files),
+                          scales=[1.0] * len(files),
+                          mtimes=[sig['mtime'] for sig in sigs],
+                          sizes=[sig['size'] for sig in sigs])
+            old = olds[fs]
+            for row, name in enumerate(names):
+                if current[row]:
+                    old_row = old.all_rows[name]
+                    header['valid'][row] = bool(old.valid[old_row])
+                    header['scales'][row] = float(old.scales[old_row])
+                    store.write_row(path, shape, row, old.data[old_row], store_name(fs))
+            headers[(path, fs)] = header
+        tasks.extend((files[row], rates, training, path, row, len(files))
+                     for row in range(len(files)) if not current[row])
+
+    changed = changed_paths
+    for count, (path, row, sig, scales) in enumerate(run_tasks(storewrite, tasks, nprocs)):
+        for i, fs in enumerate(rates):
+            header = headers[(path, fs)]
+            header['valid'][row] = scales is not None
+            header['scales'][row] = 1.0 if scales is None else scales[i]
+            header['mtimes'][row] = sig['mtime']
+            header['sizes'][row] = sig['size']
+        changed.add(path)
+        if (count + 1) % 100 == 0:
+            print('Converted %d of %d files' % (count + 1, len(tasks)))
+    for (path, fs), header in headers.items():
+        store.commit(path, fs=fs, name=store_name(fs), **header)
+        changed.add(path)
+    return changed
+
+
+def remove_indexes(path):
+    for idx_file in glob.glob(os.path.join(path, '*-index.csv')):
+        print('Removing stale %s' % idx_file)
+        os.remove(idx_file)
+
+
+def load(srcfile, fs, training):
+    """
+    Return the normalized int16 samples of srcfile as a (samples, electrodes)
+    array along with the scale factor that was applied, or None if the file
+    is to be skipped.
+    """
+    loaded = load_rates(srcfile, [fs], training)
+    return None if loaded is None else loaded[0]
+
+
+def load_rates(srcfile, rates, training):
+    """
+    Read srcfile once and return what load() would for each of the given
+    sampling rates, or None if the file is to be skipped.
+    """
     try:
         mat = io.loadmat(srcfile)
     except ValueError:
         print('Could not load %s' % srcfile)
-        return
+        return None
 
     dat = mat['dataStruct'][0, 0][0]
-    if ds_factor != 1:
-        dat = signal.decimate(dat, ds_factor, axis=0, zero_phase=True)
+    if training and scale_factor(dat) is None:
+        print('skipping %s' % srcfile)
+        return None
+    results = []
+    for fs in rates:
+        resampled = resample(dat, fs)
+        scale = scale_factor(resampled)
+        if scale is None:
+            results.append((np.int16(resampled), 1.0))
+        else:
+            results.append((np.int16(resampled * scale), scale))
+    return results
+
+
+def resample(dat, fs):
+    """
+    Resample dat, of shape (samples, electrodes), from native_fs to fs with
+    a polyphase filter.
+    """
+    if fs == native_fs:
+        return dat
+    div = gcd(fs, native_fs)
+    return signal.resample_poly(dat, fs // div, native_fs // div, axis=0)
+
 
+def scale_factor(dat):
+    """
+    Return the factor that scales dat to the range of int16 or None if dat
+    is all zeros.
+    """
     mn = dat.min()
     mx = dat.max()
     mx = float(max(abs(mx), abs(mn)))
-    if training and mx == 0:
-        print('skipping %s' % srcfile)
-        return
-    if mx != 0:
-        dat *= 0x7FFF / mx
-    dat = np.int16(dat)
+    if mx == 0:
+        return None
+    return 0x7FFF / mx
 
-    winsize = win_dur * 60 * fs
-    stride = 60 * fs
+
+def wavwrite(srcfile, fs, training):
+    loaded = load(srcfile, fs, training)
+    if loaded is None:
+        return []
+    dat = loaded[0]
+
+    outputs = []
     for elec in range(16):
-        aud = dat[:, elec]
-        for win in range(nwin):
-            dstfile = srcfile.replace('mat', str(win) + '.' + str(elec) + '.wav')
-            beg = win * stride
-            end = beg + winsize
-            clip = aud[beg:end]
-            audiolab.wavwrite(clip, dstfile, fs=fs, enc='pcm16')
+        dstfile = recname(srcfile, elec)
+        audiolab.wavwrite(dat[:, elec], dstfile, fs=fs, enc='pcm16')
+        outputs.append(dstfile)
+        for win in range(1, nwin):
+            stale = wavname(srcfile, win, elec)
+            if os.path.exists(stale):
+                os.remove(stale)
+    return outputs
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print('Usage %s /path/to/data' % sys.argv[0])
-        sys.exit(0)
-
-    fs = 400
-    if ds_factor != 1:
-        fs /= ds_factor
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('data_dir', help='directory containing train_N and test_N subdirectories')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes (1 to convert serially)')
+    parser.add_argument('-f', '--format', choices=['wav', 'store'], default='wav',
+                        help='write one .wav file per electrode and window or '
+                        'one memory-mapped sample store per directory')
+    parser.add_argument('-r', '--rates', type=int, nargs='+', default=[native_fs],
+                        help='sampling rates in Hz (several rates need -f store)')
+    args = parser.parse_args()
+    assert args.format == 'store' or len(args.rates) == 1, 'Use -f store for several rates'
+    paths = []
     for subj_id in range(1, 4):
         for template in ['train_%d', 'test_%d', 'test_%d_new']:
-            path = os.path.join(sys.argv[1], template % subj_id)
-            extract(path, fs, template == 'train_%d')
+            path = os.path.join(args.data_dir, template % subj_id)
+            paths.append((path, template == 'train_%d'))
+
+    if args.format == 'store':
+        changed = store_all(paths, args.rates, args.jobs)
+    else:
+        changed = extract_all(paths, args.rates[0], args.jobs)
+
+    # Index files are derived from the .wav files. Drop the ones that are out of date.
+    for subj_id in range(1, 4):
+        subj_paths = [os.path.join(args.data_dir, template % subj_id)
+                      for template in ['train_%d', 'test_%d', 'test_%d_new']]
+        if any(path in changed for path in subj_paths):
+            remove_indexes(subj_paths[0])
+            remove_indexes(subj_paths[2])
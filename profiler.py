@@ -0,0 +1,126 @@
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Record where the time goes during training.
+
+A Profiler collects timed spans from ProfileCallback (waiting for data
+and computing each minibatch), from the loaders (assembling each batch,
+in whichever thread does it) and from the Evaluator. Recording a span
+costs two calls to time.time(), a lock and an append, so it can be left
+on.
+Totals are kept for every span, but only the first max_events spans are
+kept for the trace.
+
+The summary is saved as JSON. The trace can be opened in chrome://tracing
+or https://ui.perfetto.dev.
+"""
+import os
+import json
+import time
+import threading
+from neon.callbacks.callbacks import Callback
+
+
+class Profiler(object):
+    def __init__(self, max_events=1000000):
+        self.max_events = max_events
+        self.origin = time.time()
+        # name -> [count, total, max]
+        self.totals = {}
+        self.events = []
+        self.samples = 0
+        # Spans are added from the prefetching threads of the loaders too.
+        self.lock = threading.Lock()
+
+    def add(self, name, start, end, cat='train'):
+        duration = end - start
+        with self.lock:
+            entry = self.totals.get(name)
+            if entry is None:
+                entry = self.totals[name] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] = max(entry[2], duration)
+            if len(self.events) < self.max_events:
+                self.events.append((name, cat, threading.current_thread().ident, start, duration))
+
+    def summary(self):
+        with self.lock:
+            totals = dict((name, tuple(entry)) for name, entry in self.totals.items())
+        result = dict((name, dict(count=count, seconds=total, mean=total / count, max=peak))
+                      for name, (count, total, peak) in totals.items())
+        busy = sum(result[name]['seconds'] for name in ['wait', 'compute'] if name in result)
+        result['samples'] = self.samples
+        result['samples_per_sec'] = self.samples / busy if busy > 0 else 0
+        if 'wait' in result:
+            result['wait_fraction'] = result['wait']['seconds'] / busy
+        return result
+
+    def report(self):
+        summary = self.summary()
+        lines = ['%-12s %8s %10s %10s %10s' % ('', 'count', 'total (s)', 'mean (ms)', 'max (ms)')]
+        for name in sorted(self.totals):
+            entry = summary[name]
+            lines.append('%-12s %8d %10.2f %10.2f %10.2f' % (
+                name, entry['count'], entry['seconds'], entry['mean'] * 1000, entry['max'] * 1000))
+        lines.append('%.1f samples/s, %.1f%% of the time waiting for data' % (
+            summary['samples_per_sec'], 100 * summary.get('wait_fraction', 0)))
+        return '\n'.join(lines)
+
+    def save_summary(self, filename, **extra):
+        result = self.summary()
+        result.update(extra)
+        with open(filename, 'w') as fd:
+            json.dump(result, fd, indent=2, sort_keys=True)
+
+    def save_trace(self, filename):
+        pid = os.getpid()
+        events = [dict(name=name, cat=cat, ph='X', pid=pid, tid=tid,
+                       ts=round((start - self.origin) * 1e6, 1), dur=round(duration * 1e6, 1))
+                  for name, cat, tid, start, duration in self.events]
+        with open(filename, 'w') as fd:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), fd)
+
+
+class ProfileCallback(Callback):
+    """
+    Record the time spent waiting for each minibatch (from the end of the
+    previous one) and computing it. With asynchronous backends, work that
+    is still pending at the end of a minibatch shows up as waiting time of
+    the next one.
+    """
+    def __init__(self, profiler, batch_size):
+        super(ProfileCallback, self).__init__()
+        self.profiler = profiler
+        self.batch_size = batch_size
+        self.mark = None
+
+    def on_epoch_begin(self, callback_data, model, epoch):
+        self.epoch_start = self.mark = time.time()
+
+    def on_minibatch_begin(self, callback_data, model, epoch, minibatch):
+        now = time.time()
+        self.profiler.add('wait', self.mark, now)
+        self.mark = now
+
+    def on_minibatch_end(self, callback_data, model, epoch, minibatch):
+        now = time.time()
+        self.profiler.add('compute', self.mark, now)
+        self.profiler.samples += self.batch_size
+        self.mark = now
+
+    def on_epoch_end(self, callback_data, model, epoch):
+        self.profiler.add('epoch', self.epoch_start, time.time())
@@ -28,19 +28,18 @@ fi
 data_dir=$1
 out_dir=$2
 bsz=64
-prep_file=$data_dir/prepdone
 elec=-1
+# Set to "store" to keep each data directory in one memory-mapped file
+# or to "cache" to also precompute the spectrograms.
+format=wav
+# Number of models to train at a time. With a single GPU, keep this at 1.
+# On a CPU-only machine, up to 6 (3 subjects, validate and full runs) can
+# train concurrently given enough memory.
+jobs=1
+cores=`nproc`
+mem_gb=`free -g | awk '/^Mem:/ {print $2}'`
 set -x
 
-if [ -f $prep_file ]
-then
-    echo $prep_file exists. Skipping prep...
-else
-    ./clear.sh $data_dir
-    ./prep.py $data_dir
-    touch $prep_file
-fi
-
 for subj in `seq 1 3`
 do
     train_dir=$data_dir/train_$subj/
@@ -50,12 +49,8 @@ do
         echo $train_dir not found!
         exit
     fi
-
-    echo Processing subject $subj...
-    # Validate
-    ./model.py -w $train_dir -r 0 -z $bsz -v --no_progress_bar -elec $elec -out $out_dir -eval 1 -validate
-    # Test
-    ./model.py -w $train_dir -r 0 -z $bsz -v --no_progress_bar -elec $elec -out $out_dir
 done
 
-./subm.py $data_dir $out_dir
+mkdir -p $out_dir
+./pipeline.py $data_dir $out_dir -format $format -z $bsz -elec $elec -cores $cores \
+    -job_cores $(( (cores + jobs - 1) / jobs )) -mem $mem_gb
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Serve predictions of the trained subject models over HTTP.
+
+The models saved by model.py are loaded once. Segments sent by concurrent
+clients are converted to spectrograms in the request threads and then
+collected into micro-batches of up to -z windows, or whatever has arrived
+when the -deadline expires, for the model of their subject. With -numpy,
+the models exported to model.N.npz by npmodel.py are run without neon.
+The spectrograms are computed with NumPy, so models trained with
+model.py -neon_specgram or at another sampling rate are refused.
+
+Usage:
+    ./server.py -out /path/to/output -z 64 -port 8000
+
+    curl --data-binary @segment.npy localhost:8000/predict/1
+    curl -d '{"mat": "/path/to/data/test_1_new/new_1_1.mat"}' localhost:8000/predict/1
+    curl localhost:8000/stats
+
+A segment is a .npy array of shape (samples, 16) or the path of a .mat
+file. The response holds the raw and calibrated probability of the
+preictal class, averaged over the windows of the segment as in subm.py.
+"""
+import os
+import io
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import numpy as np
+from scipy import io as sio
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    import queue
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    import Queue as queue
+from prep import nwin, window, scale_factor
+from spectrogram import Specgram, audio_params, fs, check_features
+from util import avg_preds
+
+
+nchans = 16
+
+
+class Request(object):
+    def __init__(self, subj, specs):
+        self.subj = subj
+        self.specs = specs
+        self.preds = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Batcher(object):
+    """
+    Run the predictors on batches of windows from pending requests. All the
+    model computation happens in a single thread.
+    """
+    def __init__(self, predictors, bsz, deadline):
+        self.predictors = predictors
+        self.bsz = bsz
+        self.deadline = deadline
+        self.pending = queue.Queue()
+        self.stats = dict(requests=0, batches=0, windows=0)
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, subj, specs):
+        request = Request(subj, specs)
+        self.pending.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.preds
+
+    def collect(self):
+        requests = [self.pending.get()]
+        nwindows = len(requests[0].specs)
+        expiry = time.time() + self.deadline
+        while nwindows < self.bsz:
+            timeout = expiry - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            requests.append(request)
+            nwindows += len(request.specs)
+        return requests
+
+    def loop(self):
+        while True:
+            requests = self.collect()
+            for subj in set(request.subj for request in requests):
+                group = [request for request in requests if request.subj == subj]
+                try:
+                    specs = np.concatenate([request.specs for request in group])
+                    preds = self.predictors[subj].predict(specs)
+                except Exception as error:
+                    for request in group:
+                        request.error = error
+                        request.done.set()
+                    continue
+                self.stats['batches'] += -(-len(specs) // self.bsz)
+                self.stats['windows'] += len(specs)
+                start = 0
+                for request in group:
+                    request.preds = preds[start:start + len(request.specs)]
+                    start += len(request.specs)
+                    request.done.set()
+            self.stats['requests'] += len(requests)
+
+
+def segment_specs(specgram, dat):
+    """
+    Normalize a segment of shape (samples, channels) as prep.py does and
+    return the spectrograms of its windows.
+    """
+    assert dat.ndim == 2 and dat.shape[1] == nchans, 'Expected (samples, %d) array' % nchans
+    dat = np.array(dat, dtype=np.float32)
+    scale = scale_factor(dat)
+    if scale is not None:
+        dat *= scale
+    clips = np.int16(dat).T
+    end = window(nwin - 1, fs)[1]
+    assert end <= clips.shape[1], 'Segment too short: %d samples' % clips.shape[1]
+    return specgram.windows(clips, [window(win, fs)[0] for win in range(nwin)])
+
+
+class Handler(BaseHTTPRequestHandler):
+    def reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            self.reply(200, self.server.batcher.stats)
+        else:
+            self.reply(404, dict(error='Not found'))
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'predict' or not parts[1].isdigit():
+            self.reply(404, dict(error='Use /predict/<subject>'))
+            return
+        subj = int(parts[1])
+        if subj not in self.server.predictors:
+            self.reply(404, dict(error='No model for subject %d' % subj))
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if body[:1] == b'{':
+                filename = json.loads(body.decode('utf-8'))['mat']
+                dat = sio.loadmat(filename)['dataStruct'][0, 0][0]
+            else:
+                dat = np.load(io.BytesIO(body))
+            specs = segment_specs(self.server.specgram, dat)
+        except Exception as error:
+            self.reply(400, dict(error=str(error)))
+            return
+        try:
+            preds = self.server.batcher.submit(subj, specs)
+        except Exception as error:
+            self.reply(500, dict(error=str(error)))
+            return
+        prob = avg_preds(preds)
+        predictor = self.server.predictors[subj]
+        result = dict(probability=float(prob[0]))
+        if predictor.params is not None:
+            result['calibrated'] = float(predictor.calibrate(prob)[0])
+        self.reply(200, result)
+
+    def log_message(self, fmt, *args):
+        sys.stderr.write('%s %s\n' % (time.strftime('%H:%M:%S'), fmt % args))
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UnixServer(Server):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        HTTPServer.server_bind(self)
+        self.server_name = self.server_address
+        self.server_port = 0
+
+    def get_request(self):
+        conn, _ = self.socket.accept()
+        return conn, ('local', 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-out', '--out_dir', default='preds',
+                        help='directory with the models and predictions written by model.py')
+    parser.add_argument('-subj', '--subjects', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('-z', '--batch_size', type=int, default=64, help='maximum batch size')
+    parser.add_argument('-deadline', '--deadline', type=float, default=20,
+                        help='milliseconds to wait for a batch to fill up')
+    parser.add_argument('-port', '--port', type=int, default=8000, help='TCP port on localhost')
+    parser.add_argument('-unix', '--unix_socket', help='listen on this unix socket instead')
+    parser.add_argument('-b', '--backend', default='cpu', help='neon backend')
+    parser.add_argument('-numpy', '--numpy', action='store_true',
+                        help='run the models exported by npmodel.py without neon')
+    args = parser.parse_args()
+
+    if args.numpy:
+        from npmodel import Predictor, model_filename
+    else:
+        from neon.backends import gen_backend
+        from infer import Predictor, model_filename
+        gen_backend(backend=args.backend, batch_size=args.batch_size)
+    specgram = Specgram(**audio_params())
+    shape = (nchans, specgram.height, specgram.width)
+    predictors = {}
+    for subj in args.subjects:
+        ref_file = os.path.join(args.out_dir, 'test.' + str(subj) + '.npy')
+        ref_preds = np.load(ref_file) if os.path.exists(ref_file) else None
+        print('Loading the model for subject %d...' % subj)
+        model_file = os.path.join(args.out_dir, model_filename(subj))
+        check_features(model_file, specgram)
+        predictors[subj] = Predictor(model_file, shape, subj, ref_preds)
+
+    if args.unix_socket is not None:
+        server = UnixServer(args.unix_socket, Handler)
+    else:
+        server = Server(('localhost', args.port), Handler)
+    server.specgram = specgram
+    server.predictors = predictors
+    server.batcher = Batcher(predictors, args.batch_size, args.deadline / 1000.0)
+    print('Serving on %s' % (args.unix_socket or 'localhost:%d' % args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
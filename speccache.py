@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Precompute the spectrograms of the windows in the sample stores.
+
+The spectrograms of all the electrodes of a window are computed together
+and saved as uint8 in a memory-mapped file of shape
+(segments, windows, electrodes, height, width) next to the store of the
+same sampling rate. The file name contains a hash of the spectrogram
+parameters. Caches of the store made with other parameters or from an
+older version of the store are deleted.
+Entries that have not been precomputed are filled in on first use. All
+the windows of a segment are computed together, from shared frames.
+"""
+import os
+import glob
+import json
+import argparse
+import multiprocessing
+import numpy as np
+from prep import nwin, window, run_tasks, native_fs, store_name
+from spectrogram import Specgram, audio_params
+import store
+
+
+def signature(path, name=store.default_name):
+    st = os.stat(store.prefix(path, name) + '.dat')
+    return dict(mtime=st.st_mtime, size=st.st_size)
+
+
+class SpecCache(object):
+    def __init__(self, path, specgram, samples=None):
+        self.path = path
+        self.specgram = specgram
+        if samples is None:
+            samples = store.Store(path, store_name(specgram.params['sampling_freq']))
+        self.samples = samples
+        assert samples.fs == specgram.params['sampling_freq']
+        self.shape = (self.samples.shape[0], nwin, self.samples.shape[1],
+                      specgram.height, specgram.width)
+        self.prefix = store.prefix(path, samples.name) + '.specs-'
+        base = self.prefix + specgram.key()
+        header = dict(params=specgram.params, nwin=nwin, store=signature(path, samples.name))
+        if nwin > 1:
+            # Older versions did not align the windows with the frames.
+            header['stride'] = window(1, samples.fs)[0]
+        if not self.is_valid(base, header):
+            self.create(base, header)
+        self.data = np.memmap(base + '.dat', dtype=np.uint8, mode='r+', shape=self.shape)
+        self.done = np.memmap(base + '.done', dtype=np.uint8, mode='r+', shape=self.shape[:2])
+
+    def is_valid(self, base, header):
+        if not os.path.exists(base + '.json'):
+            return False
+        with open(base + '.json') as fd:
+            return json.load(fd) == json.loads(json.dumps(header))
+
+    def create(self, base, header):
+        for filename in glob.glob(self.prefix + '*'):
+            print('Removing stale %s' % filename)
+            os.remove(filename)
+        print('Creating %s.dat...' % base)
+        data = np.memmap(base + '.dat', dtype=np.uint8, mode='w+', shape=self.shape)
+        done = np.memmap(base + '.done', dtype=np.uint8, mode='w+', shape=self.shape[:2])
+        del data, done
+        with open(base + '.json', 'w') as fd:
+            json.dump(header, fd)
+
+    def compute(self, row):
+        offsets = [window(win, self.samples.fs)[0] for win in range(nwin)]
+        self.specgram.windows(self.samples.data[row], offsets, out=self.data[row])
+        self.done[row] = 1
+
+    def get(self, row, win):
+        """
+        Return the spectrograms of all the electrodes of a window.
+        """
+        if not self.done[row, win]:
+            self.compute(row)
+        return self.data[row, win]
+
+    def fill(self, rows=None):
+        rows = range(self.shape[0]) if rows is None else rows
+        for row in rows:
+            if not self.samples.valid[row]:
+                continue
+            if not self.done[row].all():
+                self.compute(row)
+        self.data.flush()
+        self.done.flush()
+
+
+def fill(task):
+    path, fs, rows = task
+    cache = SpecCache(path, Specgram(**audio_params(fs)))
+    cache.fill(rows)
+    return path, len(rows)
+
+
+def fill_all(paths, nprocs, fs=native_fs, chunk=16):
+    tasks = []
+    for path in paths:
+        # Create or validate the cache before forking.
+        cache = SpecCache(path, Specgram(**audio_params(fs)))
+        rows = range(cache.shape[0])
+        tasks.extend((path, fs, rows[i:i + chunk]) for i in range(0, len(rows), chunk))
+    for count, (path, nrows) in enumerate(run_tasks(fill, tasks, nprocs)):
+        if (count + 1) % 10 == 0:
+            print('Processed %d of %d chunks' % (count + 1, len(tasks)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('data_dir', help='directory containing train_N and test_N subdirectories')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('-r', '--rates', type=int, nargs='+', default=[native_fs],
+                        help='sampling rates in Hz of the stores to cache')
+    args = parser.parse_args()
+
+    paths = []
+    for subj_id in range(1, 4):
+        for template in ['train_%d', 'test_%d', 'test_%d_new']:
+            path = os.path.join(args.data_dir, template % subj_id)
+            for fs in args.rates:
+                assert store.exists(path, store_name(fs)), \
+                    'No %d Hz sample store found in %s. Run prep.py -f store -r %d' % (fs, path, fs)
+            paths.append(path)
+    for fs in args.rates:
+        fill_all(paths, args.jobs, fs)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Compute spectrograms with NumPy using the same parameters as neon's AudioParams.
+
+Run this file to compare them with those computed by neon's DataLoader on
+the .wav files of the validation set of a subject, e.g.
+    ./spectrogram.py check /path/to/data/train_1 -elec 0 -n 4
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from prep import native_fs, win_dur, frame_dur, frame_overlap
+
+
+# Default sampling frequency
+fs = native_fs
+# Clip duration in milliseconds
+cd = win_dur * 60 * 1000
+
+
+def audio_params(sampling_freq=fs):
+    return dict(sampling_freq=sampling_freq, clip_duration=cd, frame_duration=frame_dur)
+
+
+class Specgram(object):
+    """
+    Log magnitude spectrograms scaled to the range of uint8, one per clip.
+    The output of a clip has shape (height, width) where height is the
+    number of frequency bins and width is the number of frames.
+    """
+    def __init__(self, sampling_freq, clip_duration, frame_duration,
+                 overlap_percent=frame_overlap):
+        self.params = dict(sampling_freq=sampling_freq, clip_duration=clip_duration,
+                           frame_duration=frame_duration, overlap_percent=overlap_percent)
+        self.window_size = (frame_duration * sampling_freq) // 1000
+        self.overlap = (self.window_size * overlap_percent) // 100
+        self.stride = self.window_size - self.overlap
+        self.nsamples = (clip_duration * sampling_freq) // 1000
+        self.width = (self.nsamples - self.window_size) // self.stride + 1
+        self.height = self.window_size // 2 + 1
+        self.window = np.hanning(self.window_size).astype(np.float32)
+
+    def key(self):
+        """
+        Return a short string that identifies the parameters.
+        """
+        desc = ','.join('%s=%s' % item for item in sorted(self.params.items()))
+        return hashlib.md5(desc.encode('ascii')).hexdigest()[:12]
+
+    def get_shape(self):
+        return (1, self.height, self.width)
+
+    def datum_size(self):
+        return self.height * self.width
+
+    def frames(self, clips, width=None):
+        """
+        Return a strided view of shape (..., width, window_size) over clips.
+        """
+        width = self.width if width is None else width
+        assert clips.shape[-1] >= (width - 1) * self.stride + self.window_size
+        clips = np.asarray(clips)
+        step = clips.strides[-1]
+        shape = clips.shape[:-1] + (width, self.window_size)
+        strides = clips.strides[:-1] + (self.stride * step, step)
+        return as_strided(clips, shape=shape, strides=strides)
+
+    def magnitude(self, frames):
+        """
+        Return the log magnitude of the frames as (..., width, height).
+        """
+        spec = np.fft.rfft(frames * self.window, axis=-1)
+        return np.log1p(np.abs(spec)).astype(np.float32)
+
+    def scale(self, mag, out=None):
+        """
+        Scale each spectrogram in mag of shape (..., width, height) to the
+        range [0, 255] and return it as (..., height, width) in uint8.
+        """
+        lead = mag.shape[:-2]
+        flat = mag.reshape(lead + (-1,))
+        mn = flat.min(axis=-1)[..., np.newaxis, np.newaxis]
+        rng = flat.max(axis=-1)[..., np.newaxis, np.newaxis] - mn
+        rng[rng == 0] = 1
+        scaled = (mag - mn) * (255.0 / rng)
+        if out is None:
+            out = np.empty(lead + (self.height, self.width), dtype=np.uint8)
+        np.copyto(out, np.swapaxes(scaled, -1, -2), casting='unsafe')
+        return out
+
+    def __call__(self, clips, out=None):
+        """
+        Compute the spectrograms of clips with shape (..., samples). All the
+        leading dimensions (electrodes, for instance) are processed at once.
+        """
+        return self.scale(self.magnitude(self.frames(clips)), out)
+
+    def windows(self, clips, offsets, out=None):
+        """
+        Compute the spectrograms of the windows of clips, of shape
+        (..., samples), that start at the given offsets and return them as
+        (windows, ..., height, width). The offsets are multiples of stride
+        (see prep.window()), so windows that overlap have frames in common.
+        Each frame is transformed once.
+        """
+        assert all(offset % self.stride == 0 for offset in offsets)
+        starts = [offset // self.stride for offset in offsets]
+        first = min(starts)
+        mag = self.magnitude(self.frames(clips[..., first * self.stride:],
+                                         max(starts) - first + self.width))
+        if out is None:
+            out = np.empty((len(offsets),) + mag.shape[:-2] + (self.height, self.width),
+                           dtype=np.uint8)
+        for i, start in enumerate(starts):
+            self.scale(mag[..., start - first:start - first + self.width, :], out[i])
+        return out
+
+
+def features_name(model_file):
+    return os.path.splitext(model_file)[0] + '.features.json'
+
+
+def save_features(model_file, backend, params):
+    """
+    Record next to a saved model that its inputs were spectrograms computed
+    by backend ('numpy' or 'neon') with the given audio parameters.
+    """
+    with open(features_name(model_file), 'w') as fd:
+        json.dump(dict(backend=backend, params=params), fd, sort_keys=True)
+
+
+def load_features(model_file):
+    """
+    Return the record of save_features() for a model saved by model.py or
+    exported by npmodel.py, or None if there is none.
+    """
+    if model_file.endswith('.npz'):
+        saved = np.load(model_file)
+        return json.loads(str(saved['features'])) if 'features' in saved.files else None
+    filename = features_name(model_file)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as fd:
+        return json.load(fd)
+
+
+def check_features(model_file, specgram):
+    """
+    Make sure that a model was trained on spectrograms like those of
+    specgram, which differ from neon's (see check()).
+    """
+    features = load_features(model_file)
+    assert features is not None, \
+        '%s does not record how its spectrograms were computed. Retrain it' % model_file
+    assert features['backend'] == 'numpy', \
+        '%s was trained on neon spectrograms. Retrain it without -neon_specgram' % model_file
+    assert features['params'] == specgram.params, \
+        '%s was trained on spectrograms with %s' % (model_file, features['params'])
+
+
+def check(repo_dir, elec, nbatches, batch_size, sampling_freq, backend):
+    """
+    Compare the spectrograms of neon's DataLoader with those of Specgram on
+    the first batches of the validation set. Returns the largest difference
+    in levels of uint8.
+    """
+    from scipy.io import wavfile
+    from neon.backends import gen_backend
+    from indexer import Indexer, read_index
+    from loader import SingleLoader
+    gen_backend(backend=backend, batch_size=batch_size)
+    repo_dir = os.path.normpath(repo_dir)
+    subj = int(repo_dir[-1])
+    # The validation set is not shuffled, so batches follow its index file.
+    data = SingleLoader(repo_dir, subj, elec, True, False, sampling_freq)
+    index_file = Indexer(repo_dir, True, False).run(elec, 'eval-%d-%d' % (subj, elec))
+    filenames = read_index(index_file)[0]
+    specgram = Specgram(**audio_params(sampling_freq))
+    diffs = []
+    flipped = []
+    for i, (x, t) in enumerate(data):
+        if i == nbatches:
+            break
+        ref = x.get().T.reshape((-1, specgram.height, specgram.width))
+        rows = np.arange(i * batch_size, (i + 1) * batch_size) % len(filenames)
+        clips = np.empty((batch_size, specgram.nsamples), dtype=np.int16)
+        for j, row in enumerate(rows):
+            clips[j] = wavfile.read(os.path.join(repo_dir, filenames[row]))[1][:specgram.nsamples]
+        ours = specgram(clips).astype(np.float32)
+        diffs.append(np.abs(ref - ours))
+        flipped.append(np.abs(ref - ours[:, ::-1]))
+        print('Batch %d: largest difference %d, mean %.3f' %
+              (i, diffs[-1].max(), diffs[-1].mean()))
+    diffs = np.concatenate(diffs)
+    flipped = np.concatenate(flipped)
+    print('%d spectrograms: largest difference %d, mean %.3f, %.2f%% of the values equal' %
+          (len(diffs), diffs.max(), diffs.mean(), 100.0 * np.mean(diffs == 0)))
+    print('With the frequencies reversed: largest difference %d, mean %.3f' %
+          (flipped.max(), flipped.mean()))
+    return diffs.max()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['check'])
+    parser.add_argument('repo_dir', help='train_N directory with the .wav files of prep.py')
+    parser.add_argument('-elec', '--elec', type=int, default=0, help='electrode index')
+    parser.add_argument('-n', '--nbatches', type=int, default=4,
+                        help='number of batches to compare')
+    parser.add_argument('-z', '--batch_size', type=int, default=32)
+    parser.add_argument('-fs', '--sampling_freq', type=int, default=fs,
+                        help='sampling rate in Hz, one of those written by prep.py -r')
+    parser.add_argument('-tol', '--tolerance', type=int, default=1,
+                        help='largest difference in levels of uint8 allowed')
+    parser.add_argument('-b', '--backend', default='cpu', help='neon backend')
+    args = parser.parse_args()
+    diff = check(args.repo_dir, args.elec, args.nbatches, args.batch_size,
+                 args.sampling_freq, args.backend)
+    print('PASS' if diff <= args.tolerance else 'FAIL')
+    sys.exit(0 if diff <= args.tolerance else 1)
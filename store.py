@@ -0,0 +1,121 @@
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Multichannel sample store.
+
+All the segments of a data directory are kept in one contiguous int16
+array of shape (segments, channels, samples) that is read through
+np.memmap. A small header holds the segment names, the scale factor that
+was applied to each segment and the size and mtime of the source files.
+"""
+import os
+import glob
+import numpy as np
+
+
+default_name = 'store'
+
+
+def prefix(path, name=default_name):
+    return os.path.join(path, name)
+
+
+def exists(path, name=default_name):
+    base = prefix(path, name)
+    return os.path.exists(base + '.dat') and os.path.exists(base + '.npz')
+
+
+def available(path):
+    """
+    Return the names of the stores in path, the default one first.
+    """
+    names = set(os.path.basename(filename)[:-len('.npz')]
+                for filename in glob.glob(prefix(path) + '*.npz'))
+    names = [name for name in names if not name.endswith('.tmp') and exists(path, name)]
+    return sorted(names, key=lambda name: (name != default_name, name))
+
+
+class Store(object):
+    def __init__(self, path, name=default_name):
+        self.path = path
+        self.name = name
+        base = prefix(path, name)
+        header = np.load(base + '.npz')
+        self.names = [str(x) for x in header['names']]
+        self.valid = header['valid']
+        self.scales = header['scales']
+        self.mtimes = header['mtimes']
+        self.sizes = header['sizes']
+        self.fs = int(header['fs'])
+        self.shape = tuple(header['shape'])
+        self.data = np.memmap(base + '.dat', dtype=np.int16, mode='r', shape=self.shape)
+        self.all_rows = {name: row for row, name in enumerate(self.names)}
+        self.rows = {name: row for name, row in self.all_rows.items() if self.valid[row]}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def segment_names(self):
+        return sorted(self.rows.keys())
+
+    def row(self, name):
+        return self.rows[name]
+
+    def segment(self, name):
+        return self.data[self.rows[name]]
+
+    def is_current(self, name, mtime, size):
+        if name not in self.all_rows:
+            return False
+        row = self.all_rows[name]
+        return self.mtimes[row] == mtime and self.sizes[row] == size
+
+
+def remove(path, name=default_name):
+    """
+    Delete a store along with the files derived from it.
+    """
+    for filename in glob.glob(prefix(path, name) + '.*'):
+        os.remove(filename)
+
+
+def create(path, shape, name=default_name):
+    base = prefix(path, name)
+    data = np.memmap(base + '.tmp.dat', dtype=np.int16, mode='w+', shape=shape)
+    del data
+
+
+def write_row(path, shape, row, dat, name=default_name):
+    base = prefix(path, name)
+    data = np.memmap(base + '.tmp.dat', dtype=np.int16, mode='r+', shape=shape)
+    data[row] = dat
+    data.flush()
+    del data
+
+
+def commit(path, shape, fs, names, valid, scales, mtimes, sizes, name=default_name):
+    base = prefix(path, name)
+    with open(base + '.tmp.npz', 'wb') as fd:
+        np.savez(fd, names=np.array(names), valid=np.array(valid, dtype=bool),
+                 scales=np.array(scales, dtype=np.float32),
+                 mtimes=np.array(mtimes, dtype=np.float64),
+                 sizes=np.array(sizes, dtype=np.int64),
+                 fs=fs, shape=np.array(shape))
+    os.rename(base + '.tmp.dat', base + '.dat')
+    os.rename(base + '.tmp.npz', base + '.npz')
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Run a trained subject model on a continuous stream of 16 channel EEG.
+
+Samples are read in chunks from .mat files or from a socket. The spectrogram
+frames of each channel are computed as soon as their samples arrive and a
+calibrated prediction is made every -stride seconds on the last window of
+win_dur minutes. The time taken by each update and each prediction is
+reported. The spectrograms match those of model.py without -neon_specgram,
+and models trained on others are refused.
+
+Usage:
+    ./stream.py -m /path/to/output/model.1.prm -ref /path/to/output/test.1.npy \
+        -subj 1 -mat /path/to/data/test_1_new/new_1_*.mat
+
+To replay .mat files over a socket in real time:
+    ./stream.py -replay /tmp/eeg.sock -mat /path/to/data/test_1_new/new_1_*.mat
+and in another terminal:
+    ./stream.py -m ... -ref ... -subj 1 -socket /tmp/eeg.sock
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import numpy as np
+from scipy import io
+from prep import scale_factor
+from spectrogram import Specgram, audio_params, fs, check_features
+
+
+nchans = 16
+
+
+class StreamingSpecgram(object):
+    """
+    Keep the samples of the last window in a ring buffer per channel along
+    with the linear magnitude of its spectrogram frames. Each frame is
+    transformed once, when its last sample arrives. Because the FFT is
+    linear, the per-window normalization of prep.py can be applied to the
+    magnitudes afterwards.
+    """
+    def __init__(self, specgram, nchans=nchans):
+        self.specgram = specgram
+        self.nsamples = specgram.nsamples
+        self.samples = np.zeros((nchans, self.nsamples), dtype=np.float32)
+        self.mags = np.zeros((nchans, specgram.width, specgram.height), dtype=np.float32)
+        # Number of samples and frames seen so far
+        self.count = 0
+        self.nframes = 0
+
+    def update(self, chunk):
+        """
+        Append chunk, of shape (samples, channels), to the stream.
+        """
+        spec = self.specgram
+        # Frames must be computed before the ring buffer wraps over them.
+        for beg in range(0, chunk.shape[0], spec.stride):
+            piece = chunk[beg:beg + spec.stride]
+            pos = np.arange(self.count, self.count + piece.shape[0]) % self.nsamples
+            self.samples[:, pos] = piece.T
+            self.count += piece.shape[0]
+            nframes = max(0, (self.count - spec.window_size) // spec.stride + 1)
+            if nframes > self.nframes:
+                self.add_frames(self.nframes, nframes)
+
+    def add_frames(self, first, last):
+        spec = self.specgram
+        starts = np.arange(first, last) * spec.stride
+        idx = (starts[:, np.newaxis] + np.arange(spec.window_size)) % self.nsamples
+        frames = self.samples[:, idx]
+        mags = np.abs(np.fft.rfft(frames * spec.window, axis=-1))
+        self.mags[:, np.arange(first, last) % spec.width] = mags
+        self.nframes = last
+
+    def ready(self):
+        return self.count >= self.nsamples
+
+    def window(self):
+        """
+        Return the spectrograms of the last nsamples samples with shape
+        (channels, height, width). The stream must be at a frame boundary.
+        """
+        spec = self.specgram
+        start = self.count - self.nsamples
+        assert start % spec.stride == 0
+        first = start // spec.stride
+        mags = self.mags[:, (np.arange(spec.width) + first) % spec.width]
+        scale = scale_factor(self.samples)
+        if scale is not None:
+            mags = mags * scale
+        return spec.scale(np.log1p(mags))
+
+
+class Stats(object):
+    def __init__(self, name):
+        self.name = name
+        self.times = []
+
+    def add(self, elapsed):
+        self.times.append(elapsed)
+
+    def report(self):
+        if len(self.times) == 0:
+            return '%s: none' % self.name
+        times = np.array(self.times) * 1000
+        return ('%s: %d, mean %.2fms, median %.2fms, 99th percentile %.2fms, max %.2fms' %
+                (self.name, len(times), times.mean(), np.median(times),
+                 np.percentile(times, 99), times.max()))
+
+
+def read_mat(filename):
+    mat = io.loadmat(filename)
+    return mat['dataStruct'][0, 0][0].astype(np.float32)
+
+
+def mat_source(filenames, chunk_size):
+    for filename in filenames:
+        dat = read_mat(filename)
+        for beg in range(0, dat.shape[0], chunk_size):
+            yield dat[beg:beg + chunk_size]
+
+
+def connect(address):
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((host, int(port)))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    return sock
+
+
+def listen(address):
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, int(port)))
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+    sock.listen(1)
+    return sock
+
+
+def socket_source(address, chunk_size):
+    """
+    Yield chunks of samples sent as little-endian float32 values with the
+    channels interleaved.
+    """
+    sock = connect(address)
+    frame_bytes = 4 * nchans
+    pending = b''
+    try:
+        while True:
+            data = sock.recv(chunk_size * frame_bytes)
+            if not data:
+                break
+            pending += data
+            usable = len(pending) - len(pending) % frame_bytes
+            if usable == 0:
+                continue
+            chunk = np.frombuffer(pending[:usable], dtype='<f4').reshape(-1, nchans)
+            pending = pending[usable:]
+            yield chunk
+    finally:
+        sock.close()
+
+
+def replay(address, filenames, chunk_size, speed):
+    """
+    Send the samples in the given .mat files to the first client that
+    connects to address, speed times faster than real time.
+    """
+    server = listen(address)
+    print('Waiting for a connection on %s...' % address)
+    conn, _ = server.accept()
+    interval = chunk_size / float(fs) / speed
+    try:
+        deadline = time.time()
+        for chunk in mat_source(filenames, chunk_size):
+            conn.sendall(chunk.astype('<f4').tobytes())
+            deadline += interval
+            delay = deadline - time.time()
+            if delay > 0:
+                time.sleep(delay)
+    finally:
+        conn.close()
+        server.close()
+
+
+def run(source, predictor, stride, out=sys.stdout):
+    """
+    Feed the chunks from source to the streaming spectrogram and make a
+    prediction every stride samples once a full window is available.
+    """
+    specgram = Specgram(**audio_params())
+    assert stride % specgram.stride == 0, \
+        'The stride must be a multiple of %d samples' % specgram.stride
+    stream = StreamingSpecgram(specgram)
+    updates = Stats('Updates')
+    predictions = Stats('Predictions')
+    next_emit = specgram.nsamples
+    out.write('seconds,probability,calibrated\n')
+    for chunk in source:
+        beg = 0
+        while beg < chunk.shape[0]:
+            # Split the chunk at prediction points.
+            end = min(chunk.shape[0], beg + next_emit - stream.count)
+            start = time.time()
+            stream.update(chunk[beg:end])
+            updates.add(time.time() - start)
+            beg = end
+            if stream.count != next_emit:
+                continue
+            start = time.time()
+            specs = stream.window()
+            prob = predictor.predict(specs[np.newaxis])
+            calibrated = predictor.calibrate(prob) if predictor.params is not None else prob
+            predictions.add(time.time() - start)
+            out.write('%.2f,%.6f,%.6f\n' % (stream.count / float(fs), prob[0], calibrated[0]))
+            out.flush()
+            next_emit += stride
+    return updates, predictions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-m', '--model_file',
+                        help='model saved by model.py or exported by npmodel.py (.npz)')
+    parser.add_argument('-ref', '--ref_preds',
+                        help='predictions of model.py on the test set, used for calibration')
+    parser.add_argument('-subj', '--subject', type=int, default=1, help='subject id')
+    parser.add_argument('-mat', '--mat_files', nargs='+', help='.mat files to replay in order')
+    parser.add_argument('-socket', '--socket', help='read samples from a unix socket or host:port')
+    parser.add_argument('-replay', '--replay', help='serve the .mat files on this socket instead')
+    parser.add_argument('-speed', '--speed', type=float, default=1.0,
+                        help='replay speed relative to real time')
+    parser.add_argument('-chunk', '--chunk_size', type=int, default=fs // 10,
+                        help='number of samples per chunk')
+    parser.add_argument('-stride', '--stride', type=float, default=60,
+                        help='seconds between predictions')
+    parser.add_argument('-b', '--backend', default='cpu', help='neon backend')
+    args = parser.parse_args()
+
+    if args.replay is not None:
+        assert args.mat_files, '-replay needs -mat'
+        replay(args.replay, args.mat_files, args.chunk_size, args.speed)
+        sys.exit(0)
+
+    assert args.model_file is not None, '-m is required'
+    if args.model_file.endswith('.npz'):
+        from npmodel import Predictor
+    else:
+        from neon.backends import gen_backend
+        from infer import Predictor
+        gen_backend(backend=args.backend, batch_size=1)
+    specgram = Specgram(**audio_params())
+    check_features(args.model_file, specgram)
+    ref_preds = np.load(args.ref_preds) if args.ref_preds else None
+    predictor = Predictor(args.model_file, (nchans, specgram.height, specgram.width),
+                          args.subject, ref_preds)
+    # Round the stride to a whole number of spectrogram frames.
+    stride = int(round(args.stride * fs / specgram.stride)) * specgram.stride
+    if args.socket is not None:
+        source = socket_source(args.socket, args.chunk_size)
+    else:
+        assert args.mat_files, 'Either -mat or -socket is required'
+        source = mat_source(args.mat_files, args.chunk_size)
+    updates, predictions = run(source, predictor, max(stride, specgram.stride))
+    sys.stderr.write(updates.report() + '\n')
+    sys.stderr.write(predictions.report() + '\n')
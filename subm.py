@@ -21,73 +21,85 @@ import sys
 import os
 import numpy as np
 from prep import nwin
-from util import auc, avg, avg_preds
+from util import auc, avg, avg_preds, calibrate, normalize, segment_counts
+from indexer import read_index
 from sklearn import metrics
 
 
-def calibrate(subjid, preds):
-    length = preds.shape[0]
-    sorted_preds = sorted(preds)
-    # These numbers are from the training set.
-    if subjid == 1:
-        sel = length * 1152 / (1152 + 150)
-    elif subjid == 2:
-        sel = length * 2196 / (2196 + 150)
-    else:
-        sel = length * 2244 / (2244 + 150)
-    val = sorted_preds[sel]
-    std = preds.std()
-    preds -= val
-    preds /= std
+def load_results(data_dir, output_dir, subjects=(1, 2, 3)):
+    """
+    Return the predictions saved by model.py for the validation sets, as a
+    list of (subject, labels, preds, segment counts), and for the test sets,
+    as a list of (subject, preds, segment counts).
+    """
+    eval_results = []
+    test_results = []
+    for subjid in subjects:
+        subj = str(subjid)
+        preds = np.load(os.path.join(output_dir, 'eval.' + subj + '.npy'))
+        eval_filename = 'eval-' + subj + '-' + str(0) + '-index.csv'
+        idx_file = os.path.join(data_dir, 'train_' + subj, eval_filename)
+        filenames, labels = read_index(idx_file)
+        eval_results.append((subjid, labels, preds, segment_counts(filenames)))
 
+        vals = np.load(os.path.join(output_dir, 'test.' + subj + '.npy'))
+        test_filename = 'test-' + subj + '-' + str(0) + '-index.csv'
+        idx_file = os.path.join(data_dir, 'test_' + subj + '_new', test_filename)
+        test_results.append((subjid, vals, segment_counts(read_index(idx_file)[0])))
+    return eval_results, test_results
 
-def normalize(preds):
-    preds -= preds.min()
-    preds /= preds.max()
 
+def validate(eval_results):
+    """
+    Print the AUC of each subject and the overall AUC, which is returned.
+    """
+    all_labels = []
+    all_preds = []
+    for subjid, labels, preds, counts in eval_results:
+        labels, preds = avg(labels, preds, counts)
+        calibrate(subjid, preds)
+        print('Eval AUC for subject %d %.4f\n' % (subjid, auc(labels, preds)))
+        all_labels.append(labels)
+        all_preds.append(preds)
+    eval_labels = np.hstack(all_labels)
+    eval_preds = np.hstack(all_preds)
+    normalize(eval_preds)
+    overall = auc(eval_labels, eval_preds)
+    print('Overall AUC %.4f\n' % overall)
+    return overall
 
-if len(sys.argv) < 3:
-    print('Usage: %s <data_dir> <output_dir>' % sys.argv[0])
-    sys.exit(0)
 
-data_dir = sys.argv[1]
-output_dir = sys.argv[2]
+def submit(data_dir, test_results, filename='subm.csv'):
+    """
+    Write the submission file from the predictions for the test sets, which
+    must be in the order of sample_submission.csv.
+    """
+    all_preds = []
+    for subjid, vals, counts in test_results:
+        vals = avg_preds(vals, counts)
+        calibrate(subjid, vals)
+        all_preds.append(vals)
+    preds = np.hstack(all_preds)
+    normalize(preds)
+    sample_subm = os.path.join(data_dir, 'sample_submission.csv')
+    assert os.path.exists(sample_subm)
+    files = np.loadtxt(sample_subm, dtype=str, delimiter=',', skiprows=1, usecols=[0])
 
-# Validate
-eval_preds = None
-eval_labels = None
-for subjid in range(1, 4):
-        subj = str(subjid)
-        path = os.path.join(output_dir, 'eval.' + subj + '.npy')
-        preds = np.load(path)
-        eval_filename = 'eval-' + subj + '-' + str(0) + '-index.csv'
-        idx_file = os.path.join(data_dir, 'train_' + subj, eval_filename)
-        labels = np.loadtxt(idx_file, delimiter=',', skiprows=1, usecols=[1])
-        labels, preds = avg(labels, preds)
-        calibrate(subjid, preds)
-        print('Eval AUC for subject %d %.4f\n' % (subjid, auc(labels, preds)))
-        eval_preds = preds if subjid == 1 else np.hstack((eval_preds, preds))
-        eval_labels = labels if subjid == 1 else np.hstack((eval_labels, labels))
-normalize(eval_preds)
+    with open(filename, 'w') as fd:
+        fd.write('File,Class\n')
+        for i in range(len(files)):
+            fd.write(files[i])
+            fd.write(',%.6e\n' % preds[i])
+    print('Wrote ' + filename)
 
-print('Overall AUC %.4f\n' % auc(eval_labels, eval_preds))
 
-# Test
-preds = None
-for subjid in range(1, 4):
-    path = os.path.join(output_dir, 'test.' + str(subjid) + '.npy')
-    vals = np.load(path)
-    vals = avg_preds(vals)
-    calibrate(subjid, vals)
-    preds = vals if subjid == 1 else np.hstack((preds, vals))
-normalize(preds)
-sample_subm = os.path.join(data_dir, 'sample_submission.csv')
-assert os.path.exists(sample_subm)
-files = np.loadtxt(sample_subm, dtype=str, delimiter=',', skiprows=1, usecols=[0])
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: %s <data_dir> <output_dir>' % sys.argv[0])
+        sys.exit(0)
 
-with open('subm.csv', 'w') as fd:
-    fd.write('File,Class\n')
-    for i in range(len(files)):
-        fd.write(files[i])
-        fd.write(',%.6e\n' % preds[i])
-print('Wrote subm.csv')
+    data_dir = sys.argv[1]
+    output_dir = sys.argv[2]
+    eval_results, test_results = load_results(data_dir, output_dir)
+    validate(eval_results)
+    submit(data_dir, test_results)
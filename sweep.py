@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Search the hyperparameters of a subject's model by successive halving.
+
+Trials are drawn from a search space over the hyperparameters of
+network.defaults(), given as a JSON object that maps each name to a list
+of values, e.g.
+
+    {"rate": [3e-6, 1e-5, 3e-5], "depth": [3, 5], "dropout": [[], [0.8, 0.4, 0.2]]}
+
+All trials are trained for -min_epochs epochs and evaluated on the
+validation set. The best 1/eta of them are trained for eta times as many
+epochs, and so on until the survivors reach -max_epochs. Each trial is a
+model.py process that keeps checkpoints in its directory, so a promoted
+trial continues where it stopped. The trials of a round run concurrently within the core
+and memory budgets.
+
+The results are saved in <output>/sweep.json after every round. Running
+the same command again skips the rounds that are done and resumes the
+rest.
+
+Usage:
+    ./sweep.py /path/to/data/train_1 /path/to/output -trials 9 -cores 16 -- -store
+"""
+import os
+import json
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+from pipeline import Job, Scheduler, here
+
+
+default_space = {'rate': [3e-6, 1e-5, 3e-5], 'depth': [3, 5],
+                 'dropout': [[], [0.8, 0.4, 0.2], [0.9, 0.7, 0.5]]}
+
+
+def sample(space, ntrials, seed=0):
+    """
+    Return up to ntrials distinct points of the grid defined by space.
+    """
+    names = sorted(space)
+    grid = [dict(zip(names, values))
+            for values in itertools.product(*[space[name] for name in names])]
+    if ntrials >= len(grid):
+        return grid
+    picks = np.random.RandomState(seed).choice(len(grid), ntrials, replace=False)
+    return [grid[i] for i in sorted(picks)]
+
+
+def rounds(min_epochs, max_epochs, eta):
+    """
+    Return the number of epochs of each round.
+    """
+    epochs = [min_epochs]
+    while epochs[-1] < max_epochs:
+        epochs.append(min(epochs[-1] * eta, max_epochs))
+    return epochs
+
+
+class Sweep(object):
+    def __init__(self, args):
+        self.args = args
+        self.data_dir = os.path.abspath(args.data_dir)
+        self.out_dir = os.path.abspath(args.out_dir)
+        self.subj = int(os.path.normpath(self.data_dir)[-1])
+        self.state_file = os.path.join(self.out_dir, 'sweep.json')
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as fd:
+                self.state = json.load(fd)
+            print('Resuming the sweep in %s' % self.out_dir)
+        else:
+            space = default_space
+            if args.space is not None:
+                with open(args.space) as fd:
+                    space = json.load(fd)
+            trials = [dict(params=params, results={})
+                      for params in sample(space, args.trials, args.seed)]
+            self.state = dict(space=space, trials=trials)
+
+    def save(self):
+        with open(self.state_file + '.tmp', 'w') as fd:
+            json.dump(self.state, fd, indent=2, sort_keys=True)
+        os.rename(self.state_file + '.tmp', self.state_file)
+
+    def trial_dir(self, index):
+        return os.path.join(self.out_dir, 'trial-%d' % index)
+
+    def job(self, index, epochs):
+        args = self.args
+        trial_dir = self.trial_dir(index)
+        hparams = dict(self.state['trials'][index]['params'], epochs=epochs)
+        cmd = [os.path.join(here, 'model.py'), '-r', '0', '-z', str(args.batch_size),
+               '-v', '--no_progress_bar', '-elec', str(args.elec), '-w', self.data_dir,
+               '-fs', str(args.sampling_freq), '-validate', '-eval', '1',
+               '-hparams', json.dumps(hparams), '-out', trial_dir]
+        if args.backend is not None:
+            cmd += ['-b', args.backend]
+        if args.format == 'store':
+            cmd.append('-store')
+        elif args.format == 'cache':
+            cmd.append('-cache')
+        cmd += args.model_args
+        return Job('trial-%d-%d' % (index, epochs), cmd, cores=args.job_cores, mem=args.job_mem)
+
+    def result(self, index):
+        """
+        Return the AUC of the last evaluation of a trial.
+        """
+        filename = os.path.join(self.trial_dir(index), 'eval.%d.json' % self.subj)
+        with open(filename) as fd:
+            history = json.load(fd)['history']
+        return history[-1]['auc'] if len(history) > 0 else 0
+
+    def run(self):
+        args = self.args
+        log_dir = os.path.join(self.out_dir, 'logs')
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        # Create the index files once rather than in every trial. The loaders
+        # read those of the first electrode, except for the neon MultiLoader
+        # (-neon_specgram), which reads those of all of them.
+        from indexer import make_indexes
+        if args.elec == -1 and '-neon_specgram' in args.model_args:
+            elecs = list(range(16))
+        else:
+            elecs = [0 if args.elec == -1 else args.elec]
+        make_indexes(self.data_dir, self.subj, elecs, args.format != 'wav')
+        trials = self.state['trials']
+        alive = list(range(len(trials)))
+        for epochs in rounds(args.min_epochs, args.max_epochs, args.eta):
+            key = str(epochs)
+            pending = [index for index in alive if key not in trials[index]['results']]
+            jobs = [self.job(index, epochs) for index in pending]
+            print('Training %d of %d trials for %d epochs' % (len(jobs), len(alive), epochs))
+            scheduler = Scheduler(jobs, args.cores, args.mem, log_dir)
+            scheduler.run()
+            for index, job in zip(pending, jobs):
+                # A failed trial drops out of the sweep.
+                auc = self.result(index) if job.status == 'done' else 0
+                trials[index]['results'][key] = auc
+            self.save()
+            alive.sort(key=lambda index: trials[index]['results'][key], reverse=True)
+            for index in alive:
+                print('trial-%-3d AUC %.4f %s' % (index, trials[index]['results'][key],
+                                                  json.dumps(trials[index]['params'])))
+            alive = alive[:max(1, len(alive) // args.eta)]
+        best = alive[0]
+        self.state['best'] = dict(trial=best, params=trials[best]['params'],
+                                  auc=trials[best]['results'][str(args.max_epochs)])
+        self.save()
+        print('Best: trial-%d AUC %.4f %s' % (best, self.state['best']['auc'],
+                                              json.dumps(trials[best]['params'])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_dir', help='train_N directory of a subject')
+    parser.add_argument('out_dir', help='directory for the trials and logs')
+    parser.add_argument('-space', '--space', help='JSON file with the search space')
+    parser.add_argument('-trials', '--trials', type=int, default=18,
+                        help='number of trials drawn from the search space')
+    parser.add_argument('-seed', '--seed', type=int, default=0)
+    parser.add_argument('-min_epochs', '--min_epochs', type=int, default=1,
+                        help='epochs of the first round')
+    parser.add_argument('-max_epochs', '--max_epochs', type=int, default=9,
+                        help='epochs of the last round')
+    parser.add_argument('-eta', '--eta', type=int, default=3,
+                        help='factor by which the trials are cut and the epochs grow each round')
+    parser.add_argument('-cores', '--cores', type=int, default=multiprocessing.cpu_count(),
+                        help='number of cores to use in total')
+    parser.add_argument('-mem', '--mem', type=float, default=16, help='GB of memory to use in total')
+    parser.add_argument('-job_cores', '--job_cores', type=int, default=4,
+                        help='cores used by each trial')
+    parser.add_argument('-job_mem', '--job_mem', type=float, default=2,
+                        help='GB of memory used by each trial')
+    parser.add_argument('-format', '--format', choices=['wav', 'store', 'cache'], default='wav',
+                        help='data format (see run.sh)')
+    parser.add_argument('-fs', '--sampling_freq', type=int, default=400,
+                        help='sampling rate in Hz to train at')
+    parser.add_argument('-elec', '--elec', type=int, default=-1, help='electrode index or -1')
+    parser.add_argument('-z', '--batch_size', type=int, default=64)
+    parser.add_argument('-b', '--backend', default='cpu', help='neon backend')
+    parser.add_argument('model_args', nargs=argparse.REMAINDER,
+                        help='extra arguments for model.py, after --')
+    args = parser.parse_args()
+    if args.model_args[:1] == ['--']:
+        args.model_args = args.model_args[1:]
+    assert args.eta > 1 and 0 < args.min_epochs <= args.max_epochs
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    Sweep(args).run()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+#   Copyright 2016 Anil Thomas
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Exchange arrays between worker processes over TCP sockets.
+
+Worker 0 listens on the coordinator address and the other workers connect
+to it, from the same machine or from others. allreduce() sends the array of
+every worker to worker 0, which adds them up in the order of the ranks, so
+that the result does not depend on timing, and sends the mean back.
+
+Run this file to check the transport with local workers, e.g.
+    ./transport.py -workers 4 -size 1000000
+"""
+import time
+import socket
+import struct
+import argparse
+import multiprocessing
+import numpy as np
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def free_address(host='127.0.0.1'):
+    """
+    Return an address on host with a port that is free at the moment.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return '%s:%d' % (host, port)
+
+
+def recv_exact(conn, view):
+    pos = 0
+    while pos < len(view):
+        count = conn.recv_into(view[pos:], len(view) - pos)
+        if count == 0:
+            raise IOError('Connection closed by a worker')
+        pos += count
+
+
+class Transport(object):
+    """
+    Connect worker rank of nworkers to the others through the coordinator
+    at address (host:port), where worker 0 listens. The other workers retry
+    until timeout seconds have passed.
+    """
+    def __init__(self, rank, nworkers, address, timeout=300):
+        self.rank = rank
+        self.nworkers = nworkers
+        host, port = parse_address(address)
+        if nworkers == 1:
+            self.peers = []
+        elif rank == 0:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((host, port))
+            server.listen(nworkers)
+            server.settimeout(timeout)
+            peers = {}
+            while len(peers) < nworkers - 1:
+                conn = server.accept()[0]
+                conn.settimeout(None)
+                header = bytearray(4)
+                recv_exact(conn, memoryview(header))
+                peers[struct.unpack('!i', bytes(header))[0]] = conn
+            server.close()
+            # Ranks 1 to nworkers - 1, in order
+            self.peers = [peers[peer] for peer in range(1, nworkers)]
+        else:
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    conn = socket.create_connection((host, port))
+                    break
+                except socket.error:
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.1)
+            conn.sendall(struct.pack('!i', rank))
+            self.peers = [conn]
+        for conn in self.peers:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buf = None
+
+    def send(self, conn, arr):
+        conn.sendall(np.ascontiguousarray(arr).data)
+
+    def recv(self, conn, arr):
+        """
+        Return an array like arr with the contents sent by conn.
+        """
+        if self.buf is None or len(self.buf) != arr.nbytes:
+            self.buf = bytearray(arr.nbytes)
+        recv_exact(conn, memoryview(self.buf))
+        return np.frombuffer(self.buf, dtype=arr.dtype).reshape(arr.shape)
+
+    def allreduce(self, arr):
+        """
+        Replace arr, which has the same shape and type in all the workers,
+        with the mean of the arrays of all the workers.
+        """
+        if self.nworkers == 1:
+            return arr
+        if self.rank == 0:
+            for conn in self.peers:
+                arr += self.recv(conn, arr)
+            arr /= self.nworkers
+            for conn in self.peers:
+                self.send(conn, arr)
+        else:
+            self.send(self.peers[0], arr)
+            arr[:] = self.recv(self.peers[0], arr)
+        return arr
+
+    def broadcast(self, arr):
+        """
+        Replace arr with the array of worker 0.
+        """
+        if self.rank == 0:
+            for conn in self.peers:
+                self.send(conn, arr)
+        elif self.nworkers > 1:
+            arr[:] = self.recv(self.peers[0], arr)
+        return arr
+
+    def barrier(self):
+        """
+        Wait until all the workers get here.
+        """
+        self.allreduce(np.zeros(1, dtype=np.float32))
+
+    def close(self):
+        for conn in self.peers:
+            conn.close()
+        self.peers = []
+
+
+def check(task):
+    rank, nworkers, address, size, steps = task
+    transport = Transport(rank, nworkers, address)
+
+    def values(step, rank):
+        return np.random.RandomState(step * nworkers + rank).randn(size).astype(np.float32)
+
+    seconds = 0
+    for step in range(steps):
+        arr = values(step, rank)
+        start = time.time()
+        transport.allreduce(arr)
+        seconds += time.time() - start
+    # Worker 0 adds the arrays up in the order of the ranks.
+    expected = values(steps - 1, 0)
+    for peer in range(1, nworkers):
+        expected += values(steps - 1, peer)
+    expected /= nworkers
+    transport.close()
+    return rank, np.array_equal(arr, expected), seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-workers', '--workers', type=int, default=4)
+    parser.add_argument('-size', '--size', type=int, default=10**6,
+                        help='number of float32 values per array')
+    parser.add_argument('-steps', '--steps', type=int, default=20)
+    args = parser.parse_args()
+    address = free_address()
+    pool = multiprocessing.Pool(args.workers)
+    tasks = [(rank, args.workers, address, args.size, args.steps) for rank in range(args.workers)]
+    for rank, correct, seconds in sorted(pool.map(check, tasks)):
+        print('Worker %d: %s, %.2fms per allreduce of %.1f MB' %
+              (rank, 'correct' if correct else 'WRONG', 1000.0 * seconds / args.steps,
+               args.size * 4 / 2.0**20))
+    pool.close()
+    pool.join()
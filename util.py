@@ -21,30 +21,148 @@ from sklearn import metrics
 from prep import nwin
 
 
-def avg(labels, preds):
-    assert preds.shape[0] % nwin == 0
-    preds_len = preds.shape[0] // nwin
-    post_preds = np.zeros(preds_len, np.float32)
-    post_labels = np.zeros(preds_len, np.float32)
-    for i in range(preds_len):
-        post_preds[i] = np.mean(preds[nwin*i:nwin*(i+1)])
-        post_labels[i] = labels[nwin*i]
-        assert post_labels[i] == np.mean(labels[nwin*i:nwin*(i+1)])
-    return (post_labels, post_preds)
-
-
-def avg_preds(preds):
-    assert preds.shape[0] % nwin == 0
-    preds_len = preds.shape[0] // nwin
-    post_preds = np.zeros(preds_len, np.float32)
-    for i in range(preds_len):
-        post_preds[i] = np.mean(preds[nwin*i:nwin*(i+1)])
-    return post_preds
+reducers = ['mean', 'max', 'logodds', 'trimmed']
+
+
+def segment_counts(filenames):
+    """
+    Return the number of consecutive windows of each segment in filenames,
+    as listed in an index file.
+    """
+    names = np.char.rpartition(np.asarray(filenames, dtype=str), '/')[:, 2]
+    names = np.char.partition(names, '.')[:, 0]
+    starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1]])
+    return np.diff(np.r_[starts, len(names)])
+
+
+def logit(preds):
+    preds = np.clip(preds, 1e-7, 1 - 1e-7)
+    return np.log(preds) - np.log1p(-preds)
+
+
+def reduce_rows(mat, reducer, trim):
+    if reducer == 'mean':
+        return mat.mean(axis=1)
+    if reducer == 'max':
+        return mat.max(axis=1)
+    if reducer == 'logodds':
+        return 1 / (1 + np.exp(-logit(mat).mean(axis=1)))
+    ncut = int(trim * mat.shape[1])
+    return np.sort(mat, axis=1)[:, ncut:mat.shape[1] - ncut].mean(axis=1)
+
+
+def reduce_ragged(preds, counts, reducer, trim):
+    nsegs = len(counts)
+    ids = np.repeat(np.arange(nsegs), counts)
+    if reducer == 'max':
+        result = np.full(nsegs, np.nan)
+        nonempty = counts > 0
+        starts = np.r_[0, np.cumsum(counts)[:-1]]
+        result[nonempty] = np.maximum.reduceat(preds, starts[nonempty])
+        return result
+    if reducer == 'logodds':
+        sums = np.bincount(ids, weights=logit(preds), minlength=nsegs)
+        return 1 / (1 + np.exp(-sums / counts))
+    if reducer == 'trimmed':
+        # Rank the windows within each segment and drop both tails.
+        order = np.lexsort((preds, ids))
+        starts = np.r_[0, np.cumsum(counts)[:-1]]
+        ranks = np.arange(len(preds)) - starts[ids]
+        ncut = (trim * counts).astype(int)[ids]
+        keep = (ranks >= ncut) & (ranks < counts[ids] - ncut)
+        preds, ids = preds[order][keep], ids[keep]
+        counts = np.bincount(ids, minlength=nsegs)
+    return np.bincount(ids, weights=preds, minlength=nsegs) / counts
+
+
+def aggregate(preds, counts=None, reducer='mean', trim=0.1):
+    """
+    Reduce the predictions for the windows of each segment to one value
+    per segment with the given reducer: mean, max, logodds (mean in the
+    logit domain) or trimmed (mean without the fraction trim of the lowest
+    and the highest values). The windows of a segment must be consecutive.
+    counts holds the number of windows of each segment; by default every
+    segment has nwin windows. Segments without windows get NaN.
+    """
+    assert reducer in reducers, 'Unknown reducer %s' % reducer
+    preds = np.asarray(preds)
+    if counts is None:
+        assert preds.shape[0] % nwin == 0
+        counts = np.full(preds.shape[0] // nwin, nwin)
+    counts = np.asarray(counts)
+    assert counts.sum() == preds.shape[0], 'Window counts do not match predictions'
+    if len(counts) == 0:
+        return np.zeros(0, np.float32)
+    if np.all(counts == counts[0]) and counts[0] > 0:
+        result = reduce_rows(preds.reshape(len(counts), counts[0]), reducer, trim)
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = reduce_ragged(preds, counts, reducer, trim)
+    return result.astype(np.float32)
+
+
+def segment_labels(labels, counts=None):
+    """
+    Return the label of each segment after checking that all its windows
+    have the same label.
+    """
+    labels = np.asarray(labels)
+    if counts is None:
+        assert labels.shape[0] % nwin == 0
+        counts = np.full(labels.shape[0] // nwin, nwin)
+    counts = np.asarray(counts)
+    starts = np.r_[0, np.cumsum(counts)[:-1]][counts > 0]
+    ids = np.repeat(np.arange(len(starts)), counts[counts > 0])
+    bad = np.flatnonzero(labels != labels[starts][ids])
+    assert len(bad) == 0, 'Inconsistent labels in segment %d' % ids[bad[0]]
+    result = np.zeros(len(counts), labels.dtype)
+    result[counts > 0] = labels[starts]
+    return result
+
+
+def avg(labels, preds, counts=None, reducer='mean'):
+    return (segment_labels(labels, counts).astype(np.float32),
+            aggregate(preds, counts, reducer))
+
+
+def avg_preds(preds, counts=None, reducer='mean'):
+    return aggregate(preds, counts, reducer)
+
+
+def calibration(subjid, preds):
+    """
+    Return the offset and the scale that calibrate() would apply to preds.
+    """
+    length = preds.shape[0]
+    sorted_preds = np.sort(preds)
+    # These numbers are from the training set.
+    if subjid == 1:
+        sel = length * 1152 // (1152 + 150)
+    elif subjid == 2:
+        sel = length * 2196 // (2196 + 150)
+    else:
+        sel = length * 2244 // (2244 + 150)
+    return sorted_preds[sel], preds.std()
+
+
+def calibrate(subjid, preds, params=None):
+    """
+    Calibrate preds in place. The offset and the scale are derived from
+    preds itself unless they are given as params.
+    """
+    val, std = calibration(subjid, preds) if params is None else params
+    preds -= val
+    preds /= std
+
+
+def normalize(preds):
+    preds -= preds.min()
+    preds /= preds.max()
 
 
 def auc(labels, preds):
     return metrics.roc_auc_score(labels, preds)
 
 
-def score(labels, preds):
-    return auc(*avg(labels, preds))
+def score(labels, preds, counts=None, reducer='mean'):
+    return auc(*avg(labels, preds, counts, reducer))